@@ -0,0 +1,172 @@
+#!/usr/bin/python
+
+"""
+Copyright (c) 2010, Jeff Darcy <jeff@pl.atyp.us>
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""
+
+# Sequential write/read throughput for a range of block sizes.
+#
+#	bench.py [-m megabytes] [-i io_size] [-p ptrs] [-l latency_ms] [sizes]
+#
+# With the fake store nearly everything is CPU, so -l adds a fixed delay
+# per round trip to stand in for the network.  Round trips and bytes
+# moved are reported too, since those don't depend on the store.
+#
+# With -t, it instead measures how operations per second scale from one
+# thread up to the given number, each thread creating a file in a shared
+# directory and then writing and reading it (-n times, -i bytes each).
+# Without -l this mostly measures the GIL.
+
+import getopt
+import os
+import sys
+import threading
+import time
+
+db = __import__(os.getenv("VOLDFS_DB","voldemort"))
+
+import vfs_base
+import vfs_dir
+
+class CountingStore:
+	def __init__ (self, store, latency):
+		self.store = store
+		self.latency = latency
+		self.auto_mkfs = store.auto_mkfs
+		self.trips = 0
+		self.bytes = 0
+		if hasattr(store,"get_many"):
+			self.get_many = self.count_get_many
+		if hasattr(store,"put_many"):
+			self.put_many = self.count_put_many
+	def trip (self):
+		self.trips += 1
+		if self.latency:
+			time.sleep(self.latency)
+	def get (self, key):
+		self.trip()
+		versions = self.store.get(key)
+		for data, vector in versions:
+			self.bytes += len(data)
+		return versions
+	def put (self, key, data, version):
+		self.trip()
+		self.bytes += len(data)
+		return self.store.put(key,data,version)
+	def count_get_many (self, keys):
+		self.trip()
+		result = self.store.get_many(keys)
+		for versions in result.values():
+			for data, vector in versions:
+				self.bytes += len(data)
+		return result
+	def count_put_many (self, items):
+		self.trip()
+		for key, data in items:
+			self.bytes += len(data)
+		return self.store.put_many(items)
+
+def run (block_sz, ptrs, total, io_size, latency):
+	store = CountingStore(db.StoreClient("bench%d"%block_sz,
+		[("localhost",6666)]),latency)
+	fs = vfs_base.FS(store,block_sz,ptrs)
+	key = "bench%d" % block_sz
+	fs.create_inode(key,0644)
+	buf = os.urandom(io_size)
+	start = time.time()
+	offset = 0
+	while offset < total:
+		fs.put_data(key,offset,buf)
+		offset += io_size
+	w_time = time.time() - start
+	w_trips, w_bytes = store.trips, store.bytes
+	store.trips = store.bytes = 0
+	start = time.time()
+	offset = 0
+	while offset < total:
+		fs.get_range(key,offset,io_size)
+		offset += io_size
+	r_time = time.time() - start
+	mb = float(total) / (1 << 20)
+	print "%8d %10.2f %8d %10d %10.2f %8d %10d" % (block_sz,
+		mb/w_time, w_trips, w_bytes, mb/r_time, store.trips,
+		store.bytes)
+
+def scale (max_threads, block_sz, ptrs, count, io_size, latency):
+	def new_store ():
+		return CountingStore(db.StoreClient("scale",
+			[("localhost",6666)]),latency)
+	fs = vfs_base.FS(new_store(),block_sz,ptrs,new_store=new_store)
+	vfs_dir.mkdir(fs,"scale",0755)
+	buf = os.urandom(io_size)
+	def worker (key):
+		fs.create_inode(key,0644)
+		vfs_dir.link(fs,"scale",key,key)
+		for i in range(count):
+			fs.put_data(key,i*io_size,buf)
+			fs.get_range(key,i*io_size,io_size)
+	print "%8s %10s %10s" % ("threads","ops/s","speedup")
+	base = None
+	for nthreads in range(1,max_threads+1):
+		threads = []
+		for i in range(nthreads):
+			key = "scale%d.%d" % (nthreads,i)
+			threads.append(threading.Thread(target=worker,
+				args=(key,)))
+		start = time.time()
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		rate = nthreads * (count * 2 + 1) / (time.time() - start)
+		if not base:
+			base = rate
+		print "%8d %10.1f %10.2f" % (nthreads, rate, rate/base)
+	for name, stats in fs.retry_stats.items():
+		print "%s: %s" % (name, stats)
+
+if __name__ == "__main__":
+	total = 16 << 20
+	io_size = 0
+	ptrs = vfs_base.PTRS_PER_BLOCK
+	latency = 0
+	max_threads = 0
+	count = 50
+	opts, args = getopt.getopt(sys.argv[1:],"m:i:p:l:t:n:")
+	for opt, value in opts:
+		if opt == "-m":
+			total = int(value) << 20
+		elif opt == "-i":
+			io_size = int(value)
+		elif opt == "-p":
+			ptrs = int(value)
+		elif opt == "-l":
+			latency = float(value) / 1000
+		elif opt == "-t":
+			max_threads = int(value)
+		elif opt == "-n":
+			count = int(value)
+	if max_threads:
+		scale(max_threads,vfs_base.BLOCK_SZ,ptrs,count,
+			io_size or 4096,latency)
+		sys.exit(0)
+	io_size = io_size or (128 << 10)
+	sizes = [int(x) for x in args]
+	if not sizes:
+		sizes = [1<<10, 4<<10, 16<<10, 64<<10, 256<<10, 1<<20]
+	print "%8s %10s %8s %10s %10s %8s %10s" % ("bsize",
+		"write MB/s","trips","bytes","read MB/s","trips","bytes")
+	for block_sz in sizes:
+		run(block_sz,ptrs,total,io_size,latency)
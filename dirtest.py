@@ -19,6 +19,7 @@ OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 import os
 import struct
 import sys
+import time
 import traceback
 
 db = __import__(os.getenv("VOLDFS_DB","voldemort"))
@@ -47,7 +48,12 @@ for i in range(1000):
 
 print "adding file0 AGAIN"
 key = struct.pack(vfs_base.PTR_FMT,1,1,0)
-vfs_dir.link(fs,"root","file0",key)
+try:
+	vfs_dir.link(fs,"root","file0",key)
+	print "duplicate add of file0 wasn't caught"
+	status = "FAILED"
+except vfs_dir.DupFileExc:
+	pass
 
 for i in range(1000):
 	path = "/file%d" % i
@@ -70,16 +76,16 @@ if status != "OK":
 vfs_dir.mkdir(fs,"multi",0755)
 
 # Create a couple of levels of directories.
-sd1_key = vfs_base.get_new_key()
+sd1_key = fs.new_key()
 vfs_dir.mkdir(fs,sd1_key,0755)
 vfs_dir.link(fs,"multi","a",sd1_key)
 
-sd2_key = vfs_base.get_new_key()
+sd2_key = fs.new_key()
 vfs_dir.mkdir(fs,sd2_key,0755)
 vfs_dir.link(fs,sd1_key,"b",sd2_key)
 
 # Create an actual file in the lower subdirectory.
-a_key = vfs_base.get_new_key()
+a_key = fs.new_key()
 a_file = fs.create_inode(a_key,0644)
 fs.put_data(a_key,0,"hello world")
 vfs_dir.link(fs,sd2_key,"cde",a_key)
@@ -153,4 +159,407 @@ if a_key != None:
 	print "got key %s for deleted file" % repr(a_key)
 	status = "FAILED"
 
+# Streaming through readdir in batches as big as the cursor history, where
+# only part of each batch is actually used (the way voldfs and FUSE do it),
+# should see everything exactly once, resume a cursor every time, and never
+# fetch a sub-block twice.
+fetched = []
+real_get_values = fs.get_values
+def counting_get_values (keys):
+	fetched.extend(keys)
+	return real_get_values(keys)
+fs.get_values = counting_get_values
+seen = []
+offset = 0
+resumes = 0
+old_hits = vfs_dir.cursors.hits
+while True:
+	batch = []
+	for item in vfs_dir.readdir(fs,"enum",offset):
+		batch.append(item)
+		if len(batch) >= vfs_dir.READDIR_BATCH:
+			break
+	if len(batch) < vfs_dir.READDIR_BATCH:
+		seen.extend(batch)
+		break
+	used = len(batch) - (resumes % len(batch))
+	seen.extend(batch[:used])
+	offset = batch[used-1][2]
+	resumes += 1
+fs.get_values = real_get_values
+names = [name for name, ptr, cookie in seen]
+expected = [name for name in et.seen if name != "file0"]
+if sorted(names) != sorted(expected):
+	print "readdir saw %d entries, expected %d" % (len(names),len(expected))
+	status = "FAILED"
+if len(fetched) != len(dict.fromkeys(fetched)):
+	print "readdir fetched %d sub-blocks more than once" % (
+		len(fetched) - len(dict.fromkeys(fetched)))
+	status = "FAILED"
+if (vfs_dir.cursors.hits - old_hits) != resumes:
+	print "readdir resumed %d of %d cursors" % (
+		vfs_dir.cursors.hits - old_hits, resumes)
+	status = "FAILED"
+# If FUSE takes none of a batch, the resume is from the end of the batch
+# before, which was read before this one.
+walk = vfs_dir.readdir(fs,"enum")
+first = [walk.next() for i in range(vfs_dir.READDIR_BATCH)]
+second = [walk.next() for i in range(vfs_dir.READDIR_BATCH)]
+walk.close()
+old_hits = vfs_dir.cursors.hits
+resumed = []
+for item in vfs_dir.readdir(fs,"enum",first[-1][2]):
+	resumed.append(item)
+	if len(resumed) >= len(second):
+		break
+if vfs_dir.cursors.hits == old_hits:
+	print "resume at a batch boundary didn't find its cursor"
+	status = "FAILED"
+if resumed != second:
+	print "resume at a batch boundary gave the wrong entries"
+	status = "FAILED"
+
+# A listing should leave its entries in the dentry cache.
+vfs_dir.dcache.clear()
+for item in vfs_dir.readdir(fs,"enum"):
+	pass
+hit, ptr = vfs_dir.dcache.get("enum","file5")
+if (not hit) or (ptr != struct.pack(vfs_base.PTR_FMT,1,2,5)):
+	print "readdir didn't fill the dentry cache"
+	status = "FAILED"
+
+### TEST SET 4: dentry cache
+
+# Negative entries must not survive our own link.
+if vfs_dir.lookup(fs,"enum","/newfile") != None:
+	print "found newfile before it was created"
+	status = "FAILED"
+key = struct.pack(vfs_base.PTR_FMT,1,3,1)
+vfs_dir.link(fs,"enum","newfile",key)
+if vfs_dir.lookup(fs,"enum","/newfile") != key:
+	print "stale negative entry for newfile"
+	status = "FAILED"
+
+# A lookup that fetched the directory before our link, but got to the
+# cache after it, mustn't take the cache back to before the link.
+race_fs = vfs_base.FS(db.StoreClient("test",[]))
+race_key = struct.pack(vfs_base.PTR_FMT,1,3,2)
+raced = []
+real_race_get = race_fs.get_value
+def racing_get (key):
+	result = real_race_get(key)
+	if (key == "enum") and not raced:
+		raced.append(key)
+		vfs_dir.link(fs,"enum","racefile",race_key)
+	return result
+race_fs.get_value = racing_get
+vfs_dir.lookup(race_fs,"enum","/racefile")
+if vfs_dir.lookup(fs,"enum","/racefile") != race_key:
+	print "stale fetch rolled back the dentry cache"
+	status = "FAILED"
+vfs_dir.unlink(fs,"enum","racefile")
+
+# Nor should positive entries survive our own unlink.
+vfs_dir.unlink(fs,"enum","newfile")
+if vfs_dir.lookup(fs,"enum","/newfile") != None:
+	print "stale positive entry for newfile"
+	status = "FAILED"
+
+# Entries for other names in the same directory should stay valid.
+vfs_dir.lookup(fs,"enum","/file1")
+hit, ptr = vfs_dir.dcache.get("enum","file1")
+if not hit:
+	print "lost cache entry for file1"
+	status = "FAILED"
+
+# Negative entries can expire sooner than positive ones.
+vfs_dir.dcache.configure(neg_ttl=0.5)
+vfs_dir.lookup(fs,"enum","/nothere")
+stamp = vfs_dir.dcache.dirs.get("enum")[1]
+if vfs_dir.dcache.get("enum","nothere",stamp+0.75)[0]:
+	print "negative entry outlived negative_timeout"
+	status = "FAILED"
+if not vfs_dir.dcache.get("enum","file1",stamp+0.75)[0]:
+	print "positive entry expired with negative_timeout"
+	status = "FAILED"
+vfs_dir.dcache.configure(neg_ttl=vfs_dir.DCACHE_TTL)
+
+### TEST SET 5: compact directory format
+
+# Same names as "enum", so the two formats can be compared directly.
+vfs_dir.mkdir(fs,"compact",0755,vfs_base.FLAG_COMPACT_DIR)
+for i in range(1000):
+	key = struct.pack(vfs_base.PTR_FMT,1,2,i)
+	vfs_dir.link(fs,"compact","file%d"%i,key)
+for i in range(1000):
+	key = struct.pack(vfs_base.PTR_FMT,1,2,i)
+	if vfs_dir.DirOp(fs,"compact").lookup("file%d"%i) != key:
+		print "compact lookup(file%d) FAILED" % i
+		status = "FAILED"
+vfs_dir.unlink(fs,"compact","file0")
+if vfs_dir.DirOp(fs,"compact").lookup("file0") != None:
+	print "compact unlink(file0) FAILED"
+	status = "FAILED"
+def count_blocks (key):
+	fetched[:] = []
+	fs.get_values = counting_get_values
+	names = [name for name, ptr, cookie in vfs_dir.readdir(fs,key)]
+	fs.get_values = real_get_values
+	return names, len(fetched)
+c_names, c_blocks = count_blocks("compact")
+e_names, e_blocks = count_blocks("enum")
+if sorted(c_names) != sorted(e_names):
+	print "compact directory lists differently"
+	status = "FAILED"
+if c_blocks >= e_blocks:
+	print "compact directory has %d sub-blocks, old one %d" % (
+		c_blocks, e_blocks)
+	status = "FAILED"
+
+# Once most of the entries are gone, both kinds of directory should
+# collapse back down to no sub-blocks at all.
+for dname in ("compact","enum"):
+	for i in range(1,997):
+		vfs_dir.unlink(fs,dname,"file%d"%i)
+	names, blocks = count_blocks(dname)
+	if sorted(names) != [".","..","file997","file998","file999"]:
+		print "wrong entries %s left in %s" % (repr(names), dname)
+		status = "FAILED"
+	if blocks:
+		print "%s still has %d sub-blocks" % (dname, blocks)
+		status = "FAILED"
+	for i in range(997,1000):
+		key = struct.pack(vfs_base.PTR_FMT,1,2,i)
+		if vfs_dir.DirOp(fs,dname).lookup("file%d"%i) != key:
+			print "lost file%d from %s after collapse" % (i, dname)
+			status = "FAILED"
+
+### TEST SET 6: threads linking into one directory
+
+import threading
+tfs = vfs_base.FS(s,new_store=lambda: db.StoreClient("test",[]))
+vfs_dir.mkdir(tfs,"threads",0755)
+def add_files (t):
+	for i in range(50):
+		key = struct.pack(vfs_base.PTR_FMT,1,4,t*1000+i)
+		vfs_dir.link(tfs,"threads","t%d.%d"%(t,i),key)
+threads = [threading.Thread(target=add_files,args=(t,)) for t in range(8)]
+for t in threads:
+	t.start()
+for t in threads:
+	t.join()
+for t in range(8):
+	for i in range(50):
+		key = struct.pack(vfs_base.PTR_FMT,1,4,t*1000+i)
+		if vfs_dir.lookup(tfs,"threads","t%d.%d"%(t,i)) != key:
+			print "lost t%d.%d from threaded links" % (t, i)
+			status = "FAILED"
+
+### TEST SET 7: sharded directory
+
+# Separate clients (so no shared locks) adding to one directory through a
+# slow store.  With the buckets in separate values, only adds that land in
+# the same shard should ever conflict.
+class SlowStore:
+	def __init__ (self, store):
+		self.store = store
+	def get (self, key):
+		time.sleep(0.001)
+		return self.store.get(key)
+	def put (self, key, data, version):
+		return self.store.put(key,data,version)
+def add_files (dname, t, conflicts):
+	my_fs = vfs_base.FS(SlowStore(db.StoreClient("test",[])))
+	my_fs.dir_shift = 5
+	for i in range(20):
+		key = struct.pack(vfs_base.PTR_FMT,1,5,t*1000+i)
+		vfs_dir.DirOp(my_fs,dname).add("s%d.%d"%(t,i),key)
+	conflicts.append(my_fs.retry_stats["dir"].conflicts)
+sfs = vfs_base.FS(s)
+sfs.dir_shift = 5
+for dname, flags in (("unsharded",0),
+		     ("sharded",vfs_base.FLAG_SHARDED_DIR)):
+	vfs_dir.mkdir(sfs,dname,0755,flags)
+	conflicts = []
+	threads = [threading.Thread(target=add_files,args=(dname,t,conflicts))
+		for t in range(8)]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	print "%s: %d conflicts" % (dname, sum(conflicts))
+	if dname == "unsharded":
+		unsharded = sum(conflicts)
+	elif sum(conflicts) * 2 > unsharded:
+		print "sharding didn't reduce conflicts"
+		status = "FAILED"
+root, vector = sfs.get_value("sharded")
+if len(root) != vfs_base.INODE_SZ:
+	print "sharded directory has buckets in its inode"
+	status = "FAILED"
+vfs_dir.dcache.clear()
+wanted = ["s%d.%d"%(t,i) for t in range(8) for i in range(20)]
+names = [item[0] for item in vfs_dir.readdir(sfs,"sharded")]
+if sorted(names) != sorted([".",".."]+wanted):
+	print "wrong listing for sharded directory"
+	status = "FAILED"
+for t in range(8):
+	for i in range(20):
+		key = struct.pack(vfs_base.PTR_FMT,1,5,t*1000+i)
+		if vfs_dir.lookup(sfs,"sharded","s%d.%d"%(t,i)) != key:
+			print "lost s%d.%d from sharded directory" % (t, i)
+			status = "FAILED"
+# The listing filled the dentry cache, shard by shard.
+get_count = [0]
+real_get_value = sfs.get_value
+def counting_get_value (key):
+	get_count[0] += 1
+	return real_get_value(key)
+sfs.get_value = counting_get_value
+vfs_dir.DirOp(sfs,"sharded").lookup_cached("s3.3")
+sfs.get_value = real_get_value
+if get_count[0]:
+	print "cached lookup in sharded directory went to the store"
+	status = "FAILED"
+for name in wanted:
+	vfs_dir.unlink(sfs,"sharded",name)
+names = [item[0] for item in vfs_dir.readdir(sfs,"sharded")]
+if names != [".",".."]:
+	print "sharded directory not empty: %s" % repr(names)
+	status = "FAILED"
+
+### TEST SET 8: group commit
+
+# Threads linking into one directory through a slow store should end up
+# sharing commits, and when they all race to create the same name exactly
+# one of them should win.
+def group_files (t, commits, dups):
+	my_fs = vfs_base.FS(SlowStore(db.StoreClient("test",[])))
+	for i in range(50):
+		key = struct.pack(vfs_base.PTR_FMT,1,6,t*1000+i)
+		vfs_dir.link(my_fs,"group","g%d.%d"%(t,i),key)
+	try:
+		vfs_dir.link(my_fs,"group","dup",my_fs.new_key())
+	except vfs_dir.DupFileExc:
+		dups.append(t)
+	commits.append(my_fs.retry_stats["dir"].commits)
+vfs_dir.mkdir(fs,"group",0755)
+commits = []
+dups = []
+threads = [threading.Thread(target=group_files,args=(t,commits,dups))
+	for t in range(8)]
+for t in threads:
+	t.start()
+for t in threads:
+	t.join()
+print "group: %d commits for %d links" % (sum(commits), 8 * 51)
+if sum(commits) * 4 > 8 * 51:
+	print "links weren't batched"
+	status = "FAILED"
+if len(dups) != 7:
+	print "%d threads got DupFileExc for the same name" % len(dups)
+	status = "FAILED"
+for t in range(8):
+	for i in range(50):
+		key = struct.pack(vfs_base.PTR_FMT,1,6,t*1000+i)
+		if vfs_dir.lookup(fs,"group","g%d.%d"%(t,i)) != key:
+			print "lost g%d.%d from group commit" % (t, i)
+			status = "FAILED"
+
+### TEST SET 9: garbage collection
+
+# Splits, collapses and unlinks with a GC attached shouldn't take away
+# anything that's still linked, or leave anything that isn't.  With the
+# GC detached, a sweep should find exactly what a rewrite left behind.
+# Sweeping deletes everything not under the root it's given, so this gets
+# a store of its own.
+import vfs_gc
+gs = db.StoreClient("gctest",[("localhost",6666)])
+if hasattr(gs,"keys"):
+	gfs = vfs_base.FS(gs)
+	gfs.gc = vfs_gc.Collector(vfs_base.FS(gs),delay=0)
+	vfs_dir.mkdir(gfs,"gcroot",0755)
+	subs = []
+	for flags in (0, vfs_base.FLAG_COMPACT_DIR, vfs_base.FLAG_SHARDED_DIR):
+		key = gfs.new_key()
+		vfs_dir.mkdir(gfs,key,0755,flags)
+		vfs_dir.link(gfs,"gcroot","sub%d"%flags,key)
+		subs.append(key)
+	files = {}
+	for i in range(300):
+		key = gfs.new_key()
+		gfs.create_inode(key,0644)
+		if i % 10 == 0:
+			gfs.put_data(key,0,os.urandom(gfs.block_sz*3))
+		vfs_dir.link(gfs,subs[i%3],"f%d"%i,key)
+		files[i] = (subs[i%3], key)
+	for i in range(300):
+		if i % 4:
+			sub, key = files.pop(i)
+			vfs_dir.unlink(gfs,sub,"f%d"%i)
+			gfs.free_file(key)
+	gfs.gc.drain()
+	for i, (sub, key) in files.items():
+		if vfs_dir.lookup(gfs,sub,"f%d"%i) != key:
+			print "lost f%d after GC" % i
+			status = "FAILED"
+	live = vfs_gc.mark(gfs,"gcroot")
+	missing = [key for key in live if not gs.get(key)]
+	if missing:
+		print "GC deleted %d live keys" % len(missing)
+		status = "FAILED"
+	garbage = vfs_gc.sweep(gfs,live,True)
+	if garbage:
+		print "GC left %d unreachable keys" % len(garbage)
+		status = "FAILED"
+	# A listing that's resumed after the GC has had time to delete what
+	# it hadn't got to yet has to start over.
+	walked = []
+	for item in vfs_dir.readdir(gfs,subs[0]):
+		walked.append(item)
+		if len(walked) >= 4:
+			break
+	for i in range(300,400):
+		key = gfs.new_key()
+		gfs.create_inode(key,0644)
+		vfs_dir.link(gfs,subs[0],"f%d"%i,key)
+		files[i] = (subs[0], key)
+	for i in range(300,400):
+		sub, key = files.pop(i)
+		vfs_dir.unlink(gfs,sub,"f%d"%i)
+		gfs.free_file(key)
+	gfs.gc.drain()
+	time.sleep(0.01)
+	try:
+		for item in vfs_dir.readdir(gfs,subs[0],walked[-1][2]):
+			walked.append(item)
+	except RuntimeError:
+		print "resumed readdir hit a deleted block"
+		status = "FAILED"
+	# A directory that loses the race for its name leaves nothing behind
+	# once it's freed.
+	before = set(gs.keys())
+	for flags in (0, vfs_base.FLAG_SHARDED_DIR):
+		key = gfs.new_key()
+		vfs_dir.mkdir(gfs,key,0755,flags)
+		vfs_dir.free_dir(gfs,key)
+	gfs.gc.drain()
+	if set(gs.keys()) - before:
+		print "free_dir left %d keys" % len(set(gs.keys()) - before)
+		status = "FAILED"
+	gfs.gc = None
+	sub, key = files[0]
+	gdata = os.urandom(gfs.block_sz*3)
+	gfs.put_data(key,0,gdata)
+	garbage = vfs_gc.mark_and_sweep(gfs,"gcroot")
+	if len(garbage) != 3:
+		print "sweep found %d blocks instead of 3" % len(garbage)
+		status = "FAILED"
+	if vfs_gc.mark_and_sweep(gfs,"gcroot",True):
+		print "second sweep found more garbage"
+		status = "FAILED"
+	if gfs.get_range(key,0,len(gdata)) != gdata:
+		print "WRONG DATA after sweep"
+		status = "FAILED"
+
 print "status = %s" % status
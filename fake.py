@@ -14,21 +14,87 @@ ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 """
 
+import threading
+
 class FakeVersion:
-	def __init__ (self):
-		self.version = 0
+	def __init__ (self, n):
+		self.version = n
 
 class FakeVector:
-	def __init__ (self, v):
-		self.value = v
-		self.entries = [FakeVersion()]
+	def __init__ (self, n=0):
+		self.entries = [FakeVersion(n)]
+
+# Clients for the same store name share data, like they would with a real
+# back end, so that e.g. a read-ahead thread with its own client sees the
+# same blocks.
+stores = {}
+# Clients for the same store share data, so the check and the update in a
+# conditional put have to be atomic across all of them.
+lock = threading.Lock()
 
 class StoreClient:
 	def __init__ (self, store_name, bootstrap_urls):
+		self.store_name = store_name
 		self.auto_mkfs = True
-		self.data = {}
+		self.data = stores.setdefault(store_name,{})
+	# Like Voldemort, a missing key gives an empty version list.  Each
+	# get hands out a new vector, because callers increment it in place.
 	def get (self, key):
-		return self.data[key]
+		try:
+			data, n = self.data[key]
+		except KeyError:
+			return []
+		return [[data,FakeVector(n)]]
+	# Also like Voldemort, a put with a version only works if that version
+	# is newer than the stored one.  No version means an unconditional put.
 	def put (self, key, data, version):
-		self.data[key] = [[data,FakeVector(version)]]
-		return True
+		lock.acquire()
+		try:
+			try:
+				current = self.data[key][1]
+			except KeyError:
+				current = 0
+			if version == None:
+				n = current + 1
+			else:
+				n = version.entries[0].version
+				if n <= current:
+					return False
+			self.data[key] = (data, n)
+			return True
+		finally:
+			lock.release()
+	# Only works if there's nothing there yet.
+	def add (self, key, data):
+		lock.acquire()
+		try:
+			if key in self.data:
+				return False
+			self.data[key] = (data, 1)
+			return True
+		finally:
+			lock.release()
+	def get_many (self, keys):
+		result = {}
+		for key in keys:
+			versions = self.get(key)
+			if versions:
+				result[key] = versions
+		return result
+	def put_many (self, items):
+		for key, data in items:
+			self.put(key,data,None)
+	# Deleting a key that isn't there is fine, as with the real ones.
+	def delete (self, key):
+		lock.acquire()
+		try:
+			return self.data.pop(key,None) != None
+		finally:
+			lock.release()
+	# Voldemort can't do this, but the GC's sweep needs it.
+	def keys (self):
+		lock.acquire()
+		try:
+			return self.data.keys()
+		finally:
+			lock.release()
@@ -59,15 +59,17 @@ class StoreClient:
 			# TBD: deal with port defaults properly
 			s_list.append("%s:%d"%(host,11211))
 		self.mc = memcache.Client(s_list)
+		self.store_name = store_name
 		self.auto_mkfs = False
 		self.log_ops = True
 		self.ops = []
 	def get (self, key):
 		k2 = encode(key)
 		data = self.mc.gets(k2)
-		if not data:
-			print "get(%s) FAILED" % k2
-			raise RuntimeError, "bad get"
+		if data == None:
+			# Same as Voldemort: no versions at all.
+			self.log(("get",k2,None))
+			return []
 		self.log(("get",k2,len(data)))
 		version = self.mc.cas_ids[k2]
 		del self.mc.cas_ids[k2]
@@ -81,16 +83,48 @@ class StoreClient:
 		else:
 			result = self.mc.set(k2,data)
 		self.log(("cas",k2,result))
-		if result or not version:
-			return result
-		print "cas(%s,%d) FAILED" % (k2, len(data))
-		# TBD: figure out why
-		self.dump_log()
-		self.mc.set(k2,data)
-		result = self.mc.set(k2,data)
-		self.log(("set",k2,result))
-		if not result:
-			print "set(%s,%d) FAILED" % (k2, len(data))
+		if version and not result:
+			# Someone else changed it since we read it, and it's up
+			# to the caller to retry.
+			return False
+		return result
+	def add (self, key, data):
+		k2 = encode(key)
+		result = self.mc.add(k2,data)
+		self.log(("add",k2,result))
+		return bool(result)
+	# We don't get CAS IDs back from get_multi, so the versions here are
+	# only good for things that are never updated in place (i.e. COW
+	# blocks).  Same goes for set_multi, which is unconditional.
+	def get_many (self, keys):
+		k2s = {}
+		for key in keys:
+			k2s[encode(key)] = key
+		found = self.mc.get_multi(k2s.keys())
+		self.log(("get_multi",len(k2s),len(found)))
+		result = {}
+		for k2, data in found.items():
+			result[k2s[k2]] = [(data,FakeVector(0))]
+		return result
+	def put_many (self, items):
+		mapping = {}
+		for key, data in items:
+			mapping[encode(key)] = data
+		failed = self.mc.set_multi(mapping)
+		self.log(("set_multi",len(mapping),failed))
+		if failed:
+			raise RuntimeError, "set_multi failed for %d keys" % (
+				len(failed))
+	# There's no way to list keys, so the GC's sweep can't run here.
+	def delete (self, key):
+		k2 = encode(key)
+		result = self.mc.delete(k2)
+		self.log(("delete",k2,result))
+		return result
+	def delete_many (self, keys):
+		k2s = [encode(key) for key in keys]
+		result = self.mc.delete_multi(k2s)
+		self.log(("delete_multi",len(k2s),result))
 		return result
 	def log (self, info):
 		if not self.log_ops:
@@ -16,6 +16,7 @@ ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 """
 
+import getopt
 import os
 import struct
 import sys
@@ -23,9 +24,45 @@ import sys
 db = __import__(os.getenv("VOLDFS_DB","voldemort"))
 
 import vfs_base
+import vfs_codec
 import vfs_dir
 
+# -b	data block size (default vfs_base.BLOCK_SZ)
+# -p	pointers per pointer block (default: enough to fill 1KB)
+# -d	directory bucket shift (default vfs_dir.BUCKET_SHIFT)
+# -c	use compact directory buckets for the root
+# -s	store the root's top-level buckets under separate keys
+# -z	compress values with the named codec (e.g. zlib; see vfs_codec)
+# -i	allow single-block updates in place (see vfs_base.update_block)
+block_sz = vfs_base.BLOCK_SZ
+ptrs = vfs_base.PTRS_PER_BLOCK
+dir_shift = vfs_dir.BUCKET_SHIFT
+dir_flags = 0
+codec = vfs_codec.CODEC_NONE
+in_place = False
+opts, args = getopt.getopt(sys.argv[1:],"b:p:d:csz:i")
+for opt, value in opts:
+	if opt == "-b":
+		block_sz = int(value)
+	elif opt == "-p":
+		ptrs = int(value)
+	elif opt == "-d":
+		dir_shift = int(value)
+	elif opt == "-c":
+		dir_flags |= vfs_base.FLAG_COMPACT_DIR
+	elif opt == "-s":
+		dir_flags |= vfs_base.FLAG_SHARDED_DIR
+	elif opt == "-z":
+		codec = vfs_codec.by_name(value)
+	elif opt == "-i":
+		in_place = True
+
 s = db.StoreClient("test",[("localhost",6666)])
-fs = vfs_base.FS(s)
+fs = vfs_base.FS(s,block_sz,ptrs)
+fs.dir_shift = dir_shift
+fs.set_codec(codec)
+fs.update_in_place = in_place
+fs.write_super()
+fs.allocator.create_record()
 
-vfs_dir.mkdir(fs,"root",0755)
+vfs_dir.mkdir(fs,"root",0755,dir_flags)
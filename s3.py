@@ -15,6 +15,7 @@ OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 """
 
 import boto
+import boto.exception
 import os
 
 class FakeVersion:
@@ -33,8 +34,15 @@ def encode (istr):
 		ostr += '%02x' % ord(c)
 	return ostr
 
+def decode (istr):
+	ostr = ""
+	for i in range(0,len(istr),2):
+		ostr += chr(int(istr[i:i+2],16))
+	return ostr
+
 class StoreClient:
 	def __init__ (self, store_name, bootstrap_urls):
+		self.store_name = store_name
 		self.auto_mkfs = False
 		self.key = os.getenv("VOLDFS_KEY")
 		self.secret = os.getenv("VOLDFS_SECRET")
@@ -43,8 +51,21 @@ class StoreClient:
 		self.bucket = self.conn.get_bucket(self.bucket)
 	def get (self, key):
 		a_key = self.bucket.new_key(encode(key))
-		data = a_key.get_contents_as_string()
+		try:
+			data = a_key.get_contents_as_string()
+		except boto.exception.S3ResponseError, e:
+			if e.status != 404:
+				raise
+			# Same as Voldemort: no versions at all.
+			return []
 		return [[data,FakeVector(0)]]
 	def put (self, key, data, version):
 		a_key = self.bucket.new_key(encode(key))
 		a_key.set_contents_from_string(data)
+		# TBD: conditional update, so this always "succeeds"
+		return True
+	def delete (self, key):
+		self.bucket.delete_key(encode(key))
+		return True
+	def keys (self):
+		return [decode(a_key.name) for a_key in self.bucket.list()]
@@ -19,6 +19,7 @@ OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 import os
 import random
 import struct
+import time
 
 db = __import__(os.getenv("VOLDFS_DB","voldemort"))
 
@@ -89,6 +90,103 @@ for t in tests:
 		continue
 	print "  buffer OK"
 
+# The same again, but with a single ranged read for each.
+for t in tests:
+	offset, length = t
+	if fs.get_range("test",offset,length) != read_loop("test",offset,length):
+		print "RANGE READ MISMATCH offset = %u, length = %u" % t
+		status = "FAILED"
+
+# Reading across the whole file has to zero-fill the holes in between.
+whole = fs.get_range("test",0,cursor)
+if whole != read_loop("test",0,cursor):
+	print "WRONG DATA on whole-file range read"
+	status = "FAILED"
+
+# Reads so far have filled the block cache, so reading the whole file
+# again shouldn't need any blocks from the store.
+fetches = [0]
+real_get_values = fs.get_values
+def counting_get_values (keys):
+	fetches[0] += len(keys)
+	return real_get_values(keys)
+fs.get_values = counting_get_values
+hits = vfs_base.block_cache.hits
+if fs.get_range("test",0,cursor) != whole:
+	print "WRONG DATA from block cache"
+	status = "FAILED"
+if fetches[0] or (vfs_base.block_cache.hits == hits):
+	print "block cache not used (%d fetches)" % fetches[0]
+	status = "FAILED"
+fs.get_values = real_get_values
+# It's bounded in bytes.
+vfs_base.block_cache.limit = fs.block_sz * 4
+vfs_base.block_cache.trim()
+fs.get_range("test",0,cursor)
+if vfs_base.block_cache.used > fs.block_sz * 4:
+	print "block cache over its limit"
+	status = "FAILED"
+vfs_base.block_cache.limit = vfs_base.BLOCK_CACHE
+# Another store hands out the same keys, and its blocks mustn't come from
+# this one's cache entries (or the other way around).
+other = vfs_base.FS(db.StoreClient("other",[]),fs.block_sz*4)
+other.create_inode("test",0644)
+odata = os.urandom(fs.block_sz*8)
+other.put_data("test",0,odata)
+if (other.get_range("test",0,len(odata)) != odata) or \
+   (fs.get_range("test",0,cursor) != whole):
+	print "block cache mixed up two stores"
+	status = "FAILED"
+# Leaves that can be updated in place aren't cached at all.
+fs.update_in_place = True
+vfs_base.block_cache.clear()
+fs.get_range("test",0,cursor)
+if vfs_base.block_cache.used > fs.block_sz * 4:
+	print "cached leaves that might be updated in place"
+	status = "FAILED"
+fs.update_in_place = False
+
+# Sequential reads should get blocks prefetched into the pool, and reads
+# that come out of the pool should still be right.  Start with an empty
+# block cache so they don't just come from there.
+vfs_base.block_cache.clear()
+import vfs_readahead
+ra = vfs_readahead.ReadAhead(vfs_base.FS(db.StoreClient("test",[])),8)
+ra.start()
+fs.pool = ra.pool
+offset = 0
+while offset < cursor:
+	ra.note("test",offset,4096)
+	if offset == 0:
+		ra.wait()
+	if fs.get_range("test",offset,4096) != whole[offset:offset+4096]:
+		print "WRONG DATA on read-ahead at %u" % offset
+		status = "FAILED"
+	offset += 4096
+ra.wait()
+if not ra.pool.hits:
+	print "read-ahead never used"
+	status = "FAILED"
+fs.pool = None
+
+# Lots of small writes through a write-back buffer, out of order and
+# overlapping, should come out the same as writing directly.
+import vfs_writeback
+fs.create_inode("wb1",0755)
+fs.create_inode("wb2",0755)
+wb = vfs_writeback.WriteBuffer(fs,"wb1",10000)
+pieces = []
+for i in range(200):
+	pieces.append((i*77,"<%05u>" % i * 10))
+random.shuffle(pieces)
+for offset, data in pieces:
+	wb.write(offset,data)
+	fs.put_data("wb2",offset,data)
+wb.flush()
+if fs.get_range("wb1",0,20000) != fs.get_range("wb2",0,20000):
+	print "WRONG DATA after write-back"
+	status = "FAILED"
+
 fs.create_inode("overlap",0755)
 
 # Test overlap within an embedded block.
@@ -132,4 +230,471 @@ else:
 	print "WRONG DATA on fourth overlap test"
 	status = "FAILED"
 
+# A small overwrite inside an existing block shouldn't move the block.
+def leaf_for (name, bnum):
+	idata, vector = fs.get_inode(name)
+	depth = struct.unpack(vfs_base.INODE_FMT,idata[:vfs_base.INODE_SZ])[11]
+	return fs.get_leaves(idata,depth,bnum,bnum)
+fs.update_in_place = True
+before = leaf_for("test",0)
+fs.get_range("test",0,fs.block_sz)	# make sure it's cached
+fs.put_data("test",10,"in place")
+if leaf_for("test",0) != before:
+	print "single-block update was not done in place"
+	status = "FAILED"
+if fs.get_range("test",10,8) != "in place":
+	print "WRONG DATA after in-place update"
+	status = "FAILED"
+# With a stale inode, the leaf might not be in the file any more, so the
+# update has to go the slow way.
+fs.create_inode("stale",0644)
+fs.put_data("stale",0,"x"*(fs.block_sz*2))
+stale = fs.get_inode("stale")
+fs.put_data("stale",0,"y"*(fs.block_sz*2))
+fs.put_extents("stale",[(20,"stale")],stale)
+if fs.get_range("stale",20,5) != "stale":
+	print "in-place update used a stale inode"
+	status = "FAILED"
+# A COW writer that merged its data with the block before an in-place
+# update has to merge again instead of linking its copy over the update.
+fs.create_inode("merge",0644)
+fs.put_data("merge",0,os.urandom(fs.block_sz*3))
+in_place_fs = vfs_base.FS(db.StoreClient("test",[]))
+in_place_fs.update_in_place = True
+real_put = fs.put_value
+updated = []
+def updating_put (key, data, version=None):
+	if (key == "merge") and (version != None) and not updated:
+		updated.append(key)
+		in_place_fs.put_data("merge",fs.block_sz+300,"u"*10)
+	return real_put(key,data,version)
+fs.put_value = updating_put
+fs.put_extents("merge",[(fs.block_sz+100,"w"*10),(fs.block_sz*2,"w"*10)])
+fs.put_value = real_put
+mdata = fs.get_range("merge",fs.block_sz,fs.block_sz)
+if (not updated) or (mdata[100:110] != "w"*10) or (mdata[300:310] != "u"*10):
+	print "COW write lost an in-place update"
+	status = "FAILED"
+fs.update_in_place = False
+# The flag comes from the superblock, the way mkfs -i leaves it.
+ifs = vfs_base.FS(db.StoreClient("inplace",[]),fs.block_sz,fs.ptrs_per_block)
+ifs.update_in_place = True
+ifs.write_super()
+if not vfs_base.FS(db.StoreClient("inplace",[])).update_in_place:
+	print "in-place flag lost on remount"
+	status = "FAILED"
+# A value fetched before its key was discarded mustn't go into the cache.
+stamp = vfs_base.block_cache.stamp()
+vfs_base.block_cache.discard("stamped")
+vfs_base.block_cache.put("stamped","old",stamp)
+if "stamped" in vfs_base.block_cache:
+	print "cache took a value from before a discard"
+	status = "FAILED"
+whole = fs.get_range("test",0,cursor)
+
+# Extent-mapped files should read back exactly like pointer-tree ones.
+fs.create_inode("ext",0755,flags=vfs_base.FLAG_EXTENTS)
+for t in tests:
+	offset, length = t
+	fs.put_data("ext",offset,fs.get_range("test",offset,length))
+if fs.get_range("ext",0,cursor) != whole:
+	print "WRONG DATA in extent-mapped file"
+	status = "FAILED"
+
+# Enough scattered writes to push the extent map a couple of levels down,
+# with some overwrites thrown in to split existing extents.
+fs.create_inode("ext2",0755,flags=vfs_base.FLAG_EXTENTS)
+fs.create_inode("tree2",0755)
+writes = []
+for i in range(3000):
+	writes.append((i*100,"<%u>" % i))
+for i in range(0,3000,7):
+	writes.append((i*100+2,"[%u]" % (i*i)))
+random.shuffle(writes)
+for offset, data in writes:
+	fs.put_data("ext2",offset,data)
+	fs.put_data("tree2",offset,data)
+if fs.get_range("ext2",0,300000) != fs.get_range("tree2",0,300000):
+	print "WRONG DATA in deep extent-mapped file"
+	status = "FAILED"
+idata, vector = fs.get_inode("ext2")
+if struct.unpack(vfs_base.INODE_FMT,idata[:vfs_base.INODE_SZ])[11] < 2:
+	print "extent map never got deep"
+	status = "FAILED"
+
+# Sequential appends should coalesce into block-sized chunks.
+fs.create_inode("ext3",0755,flags=vfs_base.FLAG_EXTENTS)
+for i in range(100):
+	fs.put_data("ext3",i*100,"%100u" % i)
+idata, vector = fs.get_inode("ext3")
+found = fs.emap_find(idata[vfs_base.INODE_SZ:],0,0,10000)
+if len(found) > (10000 / fs.block_sz + 1):
+	print "too many extents (%d) for sequential writes" % len(found)
+	status = "FAILED"
+
+# Two clients on the same node (and another thread in one of them) must
+# never get the same key, and leases have to survive a remount.
+fs2 = vfs_base.FS(db.StoreClient("test",[]))
+fs2.allocator.lease_sz = 10
+fs.allocator.lease_sz = 10
+keys = {}
+def take_keys (a_fs, count):
+	for i in range(count):
+		keys[a_fs.new_key()] = True
+take_keys(fs,25)
+take_keys(fs2,25)
+import threading
+thr = threading.Thread(target=take_keys,args=(fs,25))
+thr.start()
+thr.join()
+take_keys(vfs_base.FS(db.StoreClient("test",[])),25)
+if len(keys) != 100:
+	print "key allocator handed out %d duplicates" % (100 - len(keys))
+	status = "FAILED"
+# Two clients can both find the allocator record missing, but only one of
+# them gets to create it.
+race = [vfs_base.FS(db.StoreClient("race",[])) for i in range(2)]
+raced = []
+real_race_get = race[1].get_value
+def racing_get (key):
+	try:
+		return real_race_get(key)
+	finally:
+		if (key == race[1].allocator.key) and not raced:
+			raced.append(race[0].new_key())
+race[1].get_value = racing_get
+if race[1].new_key() in raced:
+	print "two clients created the same allocator record"
+	status = "FAILED"
+
+# Separate clients writing different blocks of one file have to retry
+# each other's conflicts without losing anything.  Errors other than
+# conflicts mustn't be retried at all.
+# A short sleep on every get lets the writers interleave.
+class SlowStore:
+	def __init__ (self, store):
+		self.store = store
+	def get (self, key):
+		time.sleep(0.001)
+		return self.store.get(key)
+	def put (self, key, data, version):
+		return self.store.put(key,data,version)
+fs.create_inode("hot",0755)
+fs.put_data("hot",0,struct.pack("%ds"%(fs.block_sz*8),""))
+def hot_writer (n):
+	my_fs = vfs_base.FS(SlowStore(db.StoreClient("test",[])))
+	for i in range(10):
+		my_fs.put_data("hot",n*fs.block_sz+i,chr(ord("a")+n))
+	hot_stats.append(my_fs.retry_stats["write"])
+hot_stats = []
+threads = [threading.Thread(target=hot_writer,args=(n,)) for n in range(8)]
+for t in threads:
+	t.start()
+for t in threads:
+	t.join()
+hot = fs.get_range("hot",0,fs.block_sz*8)
+for n in range(8):
+	if hot[n*fs.block_sz:n*fs.block_sz+10] != chr(ord("a")+n)*10:
+		print "lost write from hot writer %d" % n
+		status = "FAILED"
+if sum([stats.commits for stats in hot_stats]) != 80:
+	print "wrong commit count for hot file"
+	status = "FAILED"
+if not sum([stats.conflicts for stats in hot_stats]):
+	print "no conflicts on hot file (test is broken)"
+	status = "FAILED"
+# A partial block that comes out all zeroes is left as a hole, but if the
+# retry after a conflict merges it with someone else's data, it needs a
+# block of its own after all.
+fs.create_inode("holey",0644)
+fs.put_data("holey",0,"a"*fs.block_sz)
+fs.put_data("holey",fs.block_sz*2,"c"*fs.block_sz)
+other_fs = vfs_base.FS(db.StoreClient("test",[]))
+real_put = fs.put_value
+conflicts = []
+def conflicting_put (key, data, version=None):
+	if (key == "holey") and (version != None) and not conflicts:
+		conflicts.append(key)
+		other_fs.put_data("holey",fs.block_sz+200,"b"*10)
+	return real_put(key,data,version)
+fs.put_value = conflicting_put
+fs.put_data("holey",fs.block_sz+100,"\0"*10)
+fs.put_value = real_put
+hdata = fs.get_range("holey",fs.block_sz,fs.block_sz)
+if (not conflicts) or (hdata[200:210] != "b"*10):
+	print "lost a write merged into a hole"
+	status = "FAILED"
+
+try:
+	fs.put_data("no such file",0,"x")
+	print "write to missing file succeeded"
+	status = "FAILED"
+except vfs_base.NoSuchKeyExc:
+	pass
+
+# With a codec, the padding in inodes and blocks shouldn't reach the store,
+# but data that doesn't compress should go in as is.  This FS gets its own
+# allocator record, since ours isn't encoded.
+import vfs_codec
+zfs = vfs_base.FS(store,fs.block_sz,fs.ptrs_per_block)
+zfs.set_codec(vfs_codec.CODEC_ZLIB)
+zfs.allocator = vfs_base.KeyAllocator(zfs,7)
+zfs.create_inode("zfile",0644)
+zdata = "compress me " * (fs.block_sz / 2) + os.urandom(fs.block_sz)
+zfs.put_data("zfile",0,zdata)
+if zfs.get_range("zfile",0,len(zdata)) != zdata:
+	print "WRONG DATA through codec"
+	status = "FAILED"
+if len(store.get("zfile")[0][0]) >= vfs_base.INODE_SZ:
+	print "inode wasn't compressed"
+	status = "FAILED"
+noise = os.urandom(fs.block_sz)
+if zfs.codec.encode(noise) != struct.pack(vfs_codec.HDR_FMT,0) + noise:
+	print "incompressible data wasn't stored raw"
+	status = "FAILED"
+big = [("a","x"*vfs_codec.POOL_MIN),("b","y"),("c","z"*vfs_codec.POOL_MIN)]
+packed = zfs.codec.encode_many(big)
+if [(k, zfs.codec.decode(v)) for k, v in packed] != big:
+	print "WRONG DATA from parallel encode"
+	status = "FAILED"
+
+# With dedup on, the same full blocks written to two files (or twice in
+# one) should be stored once, and changing one file mustn't change the
+# other even though they share blocks.  The zero block shouldn't be stored
+# at all.
+dfs = vfs_base.FS(store)
+dfs.dedup = True
+ddata = ("dedup me" * (fs.block_sz / 8)) * 2 + os.urandom(fs.block_sz)
+for name in ("dd1","dd2"):
+	dfs.create_inode(name,0644)
+	dfs.put_data(name,0,ddata)
+	dfs.put_data(name,fs.block_sz*8,"\0"*fs.block_sz)
+leaves = []
+for name in ("dd1","dd2"):
+	idata, vector = dfs.get_inode(name)
+	depth = struct.unpack(vfs_base.INODE_FMT,idata[:vfs_base.INODE_SZ])[11]
+	leaves.append(dfs.get_leaves(idata,depth,0,8))
+if (leaves[0] != leaves[1]) or (leaves[0][0][1] != leaves[0][1][1]):
+	print "identical blocks weren't shared"
+	status = "FAILED"
+if [struct.unpack(vfs_base.PTR_FMT,ptr)[0] for bnum, ptr in leaves[0]] != \
+   [vfs_base.DEDUP_NODE] * 3:
+	print "dedup blocks don't have content keys"
+	status = "FAILED"
+dfs.put_data("dd1",5,"changed")
+if dfs.get_range("dd2",0,len(ddata)) != ddata:
+	print "write to a shared block changed another file"
+	status = "FAILED"
+if dfs.get_range("dd1",0,16) != ddata[:5] + "changed" + ddata[12:16]:
+	print "WRONG DATA after write to shared block"
+	status = "FAILED"
+# Different blocks with the same content key mustn't get mixed up.
+real_content_key = vfs_base.content_key
+vfs_base.content_key = lambda data: \
+	struct.pack(vfs_base.PTR_FMT,vfs_base.DEDUP_NODE,1,1)
+dfs.create_inode("dd3",0644)
+dfs.put_data("dd3",0,"a"*fs.block_sz+"b"*fs.block_sz)
+dfs.put_data("dd3",fs.block_sz*2,"c"*fs.block_sz)
+vfs_base.content_key = real_content_key
+if dfs.get_range("dd3",0,fs.block_sz*3) != \
+   "a"*fs.block_sz + "b"*fs.block_sz + "c"*fs.block_sz:
+	print "WRONG DATA after content key collision"
+	status = "FAILED"
+
+# Sparse files.  Zero blocks become holes, and holes (including whole
+# pointer blocks' worth) are read without going to the store.
+bs = fs.block_sz
+span = bs * fs.ptrs_per_block
+fs.create_inode("sparse",0644)
+fs.put_data("sparse",0,"x"*bs)
+fs.put_data("sparse",span*3,"y"*100)
+fs.put_data("sparse",span*2,"\0"*bs)
+fs.put_data("sparse",span,"z"*bs)
+fs.put_data("sparse",span,"\0"*bs)
+idata, vector = fs.get_inode("sparse")
+depth = struct.unpack(vfs_base.INODE_FMT,idata[:vfs_base.INODE_SZ])[11]
+if [bnum for bnum, ptr in fs.get_leaves(idata,depth,0,span*4/bs)] != \
+   [0, span*3/bs]:
+	print "zero blocks weren't left as holes"
+	status = "FAILED"
+if depth != 2:
+	print "sparse file has depth %d (test is broken)" % depth
+	status = "FAILED"
+ptr_sz = vfs_base.PTR_SZ
+for p_off in (vfs_base.INODE_SZ+ptr_sz, vfs_base.INODE_SZ+ptr_sz*2):
+	if not vfs_base.is_hole(idata[p_off:p_off+ptr_sz]):
+		print "empty pointer block was kept"
+		status = "FAILED"
+gets = [0]
+real_get_value = fs.get_value
+def counting_get_value (key):
+	gets[0] += 1
+	return real_get_value(key)
+fs.get_value = counting_get_value
+hole = fs.get_data("sparse",span+bs,bs)
+fs.get_value = real_get_value
+if (hole != "\0"*bs) or (gets[0] != 1):
+	print "hole read wrong or went to the store (%d gets)" % gets[0]
+	status = "FAILED"
+try:
+	fs.get_data("missing",0,1)
+	print "read of missing file succeeded"
+	status = "FAILED"
+except vfs_base.NoSuchKeyExc:
+	pass
+seeks = [
+	(fs.seek_data,0,0), (fs.seek_hole,0,bs),
+	(fs.seek_data,bs,span*3), (fs.seek_hole,span*3,span*3+100),
+	(fs.seek_data,span*3+50,span*3+50), (fs.seek_hole,span*3+100,None),
+	(fs.seek_data,span*3+100,None),
+]
+for func, offset, want in seeks:
+	if func("sparse",offset) != want:
+		print "%s(%d) gave %s instead of %s" % (func.__name__, offset,
+			func("sparse",offset), want)
+		status = "FAILED"
+
+# Truncating should keep what's before the new EOF, zero what's after it
+# if the file grows again, and bring the tree back down to the depth the
+# new size needs.
+def depth_of (name):
+	idata, vector = fs.get_inode(name)
+	return struct.unpack(vfs_base.INODE_FMT,idata[:vfs_base.INODE_SZ])[11]
+for flags in (0, vfs_base.FLAG_EXTENTS):
+	name = "trunc%d" % flags
+	fs.create_inode(name,0644,flags=flags)
+	tdata = os.urandom(span+bs*3)
+	fs.put_data(name,0,tdata)
+	checks = [(span+bs*3,span+bs*3), (span+bs/2,span+bs/2),
+		(bs*2+10,bs*2+10), (20,20), (0,0), (bs*5,0)]
+	for new_size, kept in checks:
+		fs.truncate(name,new_size)
+		want = tdata[:kept] + "\0"*(new_size-kept)
+		if fs.get_range(name,0,new_size+10) != want:
+			print "WRONG DATA after truncating %s to %d" % (
+				name, new_size)
+			status = "FAILED"
+		tdata = want
+		if flags:
+			continue
+		if depth_of(name) != fs.depth_for(new_size):
+			print "%s has depth %d at size %d" % (name,
+				depth_of(name), new_size)
+			status = "FAILED"
+
+# A truncate that grows the file and loses to someone else's shrink has to
+# grow the tree again on the retry.
+fs.create_inode("regrow",0644)
+fs.put_data("regrow",0,os.urandom(bs*3))
+real_put = fs.put_value
+conflicts = []
+def conflicting_put (key, data, version=None):
+	if (key == "regrow") and (version != None) and not conflicts:
+		inode = struct.unpack(vfs_base.INODE_FMT,data[:vfs_base.INODE_SZ])
+		if inode[6] == span*2:
+			conflicts.append(key)
+			other_fs.truncate("regrow",10)
+	return real_put(key,data,version)
+fs.put_value = conflicting_put
+fs.truncate("regrow",span*2)
+fs.put_value = real_put
+if (not conflicts) or (depth_of("regrow") != fs.depth_for(span*2)):
+	print "regrow has depth %d at size %d" % (depth_of("regrow"),
+		span*2)
+	status = "FAILED"
+else:
+	fs.put_data("regrow",span*2-5,"x"*5)
+	rdata = fs.get_range("regrow",span*2-bs,bs)
+	if rdata != "\0"*(bs-5) + "x"*5:
+		print "WRONG DATA at the end of regrow"
+		status = "FAILED"
+
+# With a GC attached, overwriting and truncating shouldn't leave anything
+# behind that the file doesn't use, or take away anything it does.  Once
+# the file itself is freed, everything it ever had should be gone.
+import vfs_gc
+if hasattr(store,"keys"):
+	fs.gc = vfs_gc.Collector(vfs_base.FS(store),delay=0)
+	for flags in (0, vfs_base.FLAG_EXTENTS):
+		name = "gc%d" % flags
+		before = set(store.keys())
+		fs.create_inode(name,0644,flags=flags)
+		gdata = os.urandom(span+bs*3)
+		ops = [(0,gdata), (bs/2,"x"*bs), (span,"y"*10),
+			(bs*2,"\0"*bs), (None,span+bs), (None,bs*2+10)]
+		for offset, data in ops:
+			if offset == None:
+				fs.truncate(name,data)
+				gdata = gdata[:data]
+			else:
+				fs.put_data(name,offset,data)
+				gdata = gdata[:offset] + data + \
+					gdata[offset+len(data):]
+			fs.gc.drain()
+			if fs.get_range(name,0,len(gdata)) != gdata:
+				print "WRONG DATA in %s after GC" % name
+				status = "FAILED"
+		# Nor should a write or truncate that loses its first attempt
+		# leave behind what that attempt wrote.
+		real_put = fs.put_value
+		conflicts = []
+		def conflicting_put (key, data, version=None):
+			if (key == name) and (version != None) and not conflicts:
+				conflicts.append(key)
+				raise vfs_base.ConflictExc(key)
+			return real_put(key,data,version)
+		fs.put_value = conflicting_put
+		fs.put_data(name,bs,"z"*(bs*2))
+		gdata = gdata[:bs] + "z"*(bs*2) + gdata[bs*3:]
+		del conflicts[:]
+		fs.truncate(name,bs*2+5)
+		gdata = gdata[:bs*2+5]
+		fs.put_value = real_put
+		fs.gc.drain()
+		if (not conflicts) or \
+		   (fs.get_range(name,0,len(gdata)) != gdata):
+			print "WRONG DATA in %s after a retried write" % name
+			status = "FAILED"
+		idata, vector = fs.get_inode(name)
+		extra = set(store.keys()) - before - set([name])
+		extra -= set(fs.file_keys(idata))
+		if extra:
+			print "%d superseded blocks left in %s" % (
+				len(extra), name)
+			status = "FAILED"
+		fs.free_file(name)
+		fs.gc.drain()
+		left = set(store.keys()) - before
+		if left:
+			print "%s not completely freed" % name
+			status = "FAILED"
+	if not fs.gc.deleted:
+		print "GC never deleted anything"
+		status = "FAILED"
+	fs.gc = None
+
+# A batch put that fails has to stop the write before the inode points at
+# anything that might not be there.
+class FailingStore:
+	def __init__ (self, store):
+		self.store = store
+		self.store_name = store.store_name
+	def get (self, key):
+		return self.store.get(key)
+	def put (self, key, data, version):
+		return self.store.put(key,data,version)
+	def put_many (self, items):
+		raise RuntimeError, "put_many failed"
+ffs = vfs_base.FS(FailingStore(db.StoreClient("test",[])))
+idata, vector = ffs.get_inode("test")
+try:
+	ffs.put_data("test",0,os.urandom(vfs_base.BLOCK_SZ))
+	print "failed batch put went unnoticed"
+	status = "FAILED"
+except RuntimeError:
+	pass
+if ffs.get_inode("test")[0] != idata:
+	print "inode changed after a failed batch put"
+	status = "FAILED"
+
 print "status = %s" % status
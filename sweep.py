@@ -0,0 +1,49 @@
+#!/usr/bin/python
+
+"""
+Copyright (c) 2010, Jeff Darcy <jeff@pl.atyp.us>
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""
+
+import getopt
+import os
+import sys
+
+db = __import__(os.getenv("VOLDFS_DB","voldemort"))
+
+import vfs_base
+import vfs_gc
+
+# Delete every block that can't be reached from the root, e.g. after a
+# mount went away with retired keys still queued.  The filesystem must not
+# be mounted anywhere while this runs; see vfs_gc.mark_and_sweep.
+#
+# -n	just count what would be deleted
+# -r	root directory key (default "root")
+dry_run = False
+root = "root"
+opts, args = getopt.getopt(sys.argv[1:],"nr:")
+for opt, value in opts:
+	if opt == "-n":
+		dry_run = True
+	elif opt == "-r":
+		root = value
+
+s = db.StoreClient("test",[("localhost",6666)])
+fs = vfs_base.FS(s)
+garbage = vfs_gc.mark_and_sweep(fs,root,dry_run)
+if dry_run:
+	print "%d unreachable blocks" % len(garbage)
+else:
+	print "deleted %d unreachable blocks" % len(garbage)
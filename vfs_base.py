@@ -14,45 +14,206 @@ ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 """
 
+import bisect
+import hashlib
+import itertools
+import random
 import stat
 import struct
 import sys
+import threading
 import time
 
 import jlog
 log = jlog.logger(jlog.NORMAL)
+import vfs_cache
+import vfs_codec
 
-# mode, ino, dev, nlink, uid, gid, size, atime, mtime, ctime, tree_depth
-INODE_FMT = "!IQQIIIQIIII"
+# mode, ino, dev, nlink, uid, gid, size, atime, mtime, ctime, flags,
+# tree_depth.  Flags used to be the high half of a 32-bit depth, so old
+# inodes read back with no flags set.
+INODE_FMT = "!IQQIIIQIIIHH"
 INODE_SZ = struct.calcsize(INODE_FMT)
 
 # A pointer is a 16-bit node, 16-bit boot generation, and 32-bit sequence number
 PTR_FMT = "!HHI"
 PTR_SZ = struct.calcsize(PTR_FMT)
 
+# Instead of a pointer tree with one pointer per block, the inode holds a
+# map of extents, each pointing into a variable-sized chunk.  See the
+# emap_* functions in FS.
+FLAG_EXTENTS = 0x0001
+
+# For a directory, new direct buckets use vfs_dir's compact format.
+FLAG_COMPACT_DIR = 0x0002
+
+# For a directory, each top-level bucket is stored under its own key (see
+# vfs_dir.shard_key) instead of in the inode's value.
+FLAG_SHARDED_DIR = 0x0004
+
+# Extent map nodes (including the root, in the inode) are a count followed
+# by records, all in ptr_blk_sz bytes.  At depth zero the records are
+# extents: logical offset, length, offset within the chunk, chunk key.
+# Above that they're index entries: first logical offset under the child,
+# child key.
+EMAP_HDR_FMT = "!H6x"
+EMAP_HDR_SZ = struct.calcsize(EMAP_HDR_FMT)
+EXTENT_FMT = "!QII%ds" % PTR_SZ
+EXTENT_SZ = struct.calcsize(EXTENT_FMT)
+INDEX_FMT = "!Q%ds" % PTR_SZ
+INDEX_SZ = struct.calcsize(INDEX_FMT)
+
+# Data and pointer blocks are COW, so whatever we fetched under a key is
+# good for as long as we care to keep it.  This cache is shared by every FS
+# in the process and bounded in bytes.  Inodes are updated in place, so
+# they never go in here, and neither do leaves on a filesystem that allows
+# updating them in place (SUPER_IN_PLACE), because another client could
+# change one at any time.  Different stores can use the same keys, so
+# entries are keyed by the store's tag (see store_tag) as well.
+BLOCK_CACHE = 16 << 20
+block_cache = vfs_cache.LRU(BLOCK_CACHE,len)
+
+# Clients for the same named store see the same data, so they can share
+# cache entries.  Anything without a name gets a tag of its own.
+anon_tags = itertools.count(1)
+def store_tag (store):
+	try:
+		return store.store_name
+	except AttributeError:
+		return "#%d" % anon_tags.next()
+
+# Defaults, for when there's no superblock to tell us otherwise.
 BLOCK_SZ = 1024	# for debugging
 assert (BLOCK_SZ % PTR_SZ) == 0
 PTRS_PER_BLOCK = BLOCK_SZ / PTR_SZ
 
+# The superblock records the geometry chosen at mkfs time: data block size,
+# pointers per pointer block (which is also the number in the inode), and
+# the directory bucket shift (zero means vfs_dir's default).  Pointer
+# blocks and the inode's pointer area don't have to be the same size as
+# data blocks, so big data blocks don't mean huge inodes.  Version 2 adds
+# the codec every other value is stored with (see vfs_codec).  Version 3
+# adds flags for things every client has to agree on.  The superblock
+# itself is never encoded.
+SUPER_KEY = "super"
+SUPER_MAGIC = "VFSb"
+SUPER_VERSION = 3
+SUPER_FMT = "!4sHIII"
+SUPER_SZ = struct.calcsize(SUPER_FMT)
+SUPER2_FMT = "!H"
+SUPER2_SZ = struct.calcsize(SUPER2_FMT)
+SUPER3_FMT = "!H"
+SUPER3_SZ = struct.calcsize(SUPER3_FMT)
+# Data blocks may be updated in place (see FS.update_block).
+SUPER_IN_PLACE = 0x0001
+
 # In a pointer, indicates that the pointer is Nil.
 INVALID_NODE = 0
+HOLE_PTR = struct.pack(PTR_FMT,INVALID_NODE,0,0)
+
+def is_hole (ptr):
+	return struct.unpack(PTR_FMT,ptr)[0] == INVALID_NODE
+
+# Zero-filled data blocks aren't stored at all, and neither are pointer
+# blocks with nothing but holes under them.
+def is_zero (data):
+	return not data.strip("\0")
 
-# Values for generating new keys.
+# Values for generating new keys.  Each node has a record (under
+# ALLOC_KEY_FMT) holding its boot generation and the next sequence number
+# nobody has leased yet.  Taking a lease of LEASE_SZ sequence numbers is
+# one conditional put on that record, so clients that share a node ID
+# still never get the same keys.  When the sequence numbers run out, the
+# next lease moves to a new boot generation.
 NODE_ID = 1
-boot_gen = 0
-sequence = 0
+ALLOC_KEY_FMT = "alloc%d"
+ALLOC_FMT = "!HI"
+LEASE_SZ = 1024
+MAX_BOOT = 0xffff
+MAX_SEQ = 0xffffffff
 
-def get_new_key ():
-	global sequence
-	sequence += 1
-	return struct.pack(PTR_FMT,NODE_ID,boot_gen,sequence)
+# With FS.dedup set, full data blocks are stored under a key made from
+# their contents instead of a new one, so identical blocks anywhere in the
+# filesystem are stored once.  These keys use a node number no allocator
+# ever hands out, and the rest of the pointer is the first six bytes of
+# the block's SHA-1.  That's short enough to collide now and then, so a
+# write always compares against what's already there and falls back to an
+# ordinary key if it's different.  Since these blocks can be shared, they
+# are never updated in place and can only be freed by something that
+# looks at every reference (see the GC).
+#
+# TBD: two writers with different colliding blocks at the same moment.
+DEDUP_NODE = 0xffff
+
+def content_key (data):
+	return struct.pack("!H",DEDUP_NODE) + hashlib.sha1(data).digest()[:6]
+
+class KeyAllocator:
+	def __init__ (self, fs, node_id=NODE_ID, lease_sz=LEASE_SZ):
+		self.fs = fs
+		self.node_id = node_id
+		self.lease_sz = lease_sz
+		self.key = ALLOC_KEY_FMT % node_id
+		# Each thread uses up its own lease, so handing out a key
+		# doesn't need a lock.  Threads taking leases at the same
+		# time are sorted out by the conditional put.
+		self.local = threading.local()
+		self.leases = 0
+	def new_key (self):
+		local = self.local
+		try:
+			seq = local.next
+		except AttributeError:
+			seq = local.last = 0
+		if seq >= local.last:
+			local.boot, seq, local.last = self.lease()
+		local.next = seq + 1
+		return struct.pack(PTR_FMT,self.node_id,local.boot,seq)
+	def lease (self):
+		boot, seq = self.fs.commit("lease",self.lease_once)
+		self.leases += 1
+		log.it(jlog.DEBUG,"leased %d/%d/%d-%d" % (self.node_id,
+			boot, seq, seq+self.lease_sz-1))
+		return boot, seq, seq + self.lease_sz
+	# Two clients creating the record at once are sorted out by
+	# add_value, which makes one of them retry.  mkfs creates the record
+	# for the default node ahead of time anyway.
+	def lease_once (self):
+		try:
+			data, vector = self.fs.get_value(self.key)
+			boot, seq = struct.unpack(ALLOC_FMT,data)
+		except NoSuchKeyExc:
+			vector = None
+			boot, seq = 1, 1
+		if seq > MAX_SEQ - self.lease_sz:
+			boot += 1
+			seq = 1
+			if boot > MAX_BOOT:
+				raise RuntimeError, \
+					"out of keys for node %d" % self.node_id
+		data = struct.pack(ALLOC_FMT,boot,seq+self.lease_sz)
+		if vector:
+			self.fs.put_value(self.key,data,vector)
+		else:
+			self.fs.add_value(self.key,data)
+		return boot, seq
+	def create_record (self):
+		try:
+			self.fs.add_value(self.key,struct.pack(ALLOC_FMT,1,1))
+		except ConflictExc:
+			pass
 
 class BlockSet:
-	def __init__ (self, getter):
+	def __init__ (self, getter, allocator):
 		self.get_func = getter
+		self.alloc_func = allocator
 		self.old_blocks = []
 		self.new_blocks = {}
 		self.free_list = []
+		# Existing blocks never change under the same key, so anything
+		# we've fetched is still good after a conflict.  A retry only
+		# goes back to the store for blocks someone else replaced.
+		self.fetched = {}
 	def get (self, key):
 		# We very much do *not* want to store an existing key into
 		# new_blocks here, because that would lead to write-in-place
@@ -62,25 +223,82 @@ class BlockSet:
 		try:
 			return self.new_blocks[key]
 		except KeyError:
-			return self.get_func(key)[0]
+			pass
+		try:
+			return self.fetched[key]
+		except KeyError:
+			data = self.get_func(key)[0]
+			self.fetched[key] = data
+			return data
+	# Get a batch of blocks we're about to need in one round trip.
+	def prefetch (self, keys, multi_getter):
+		keys = [k for k in keys
+			if (k not in self.new_blocks) and (k not in self.fetched)]
+		if keys:
+			for key, value in multi_getter(keys).items():
+				self.fetched[key] = value[0]
+	# Replacing an existing block leaves the old one for the GC.
 	def put (self, key, value):
 		if key not in self.new_blocks:
+			if not is_hole(key):
+				self.old_blocks.append(key)
 			key = self.alloc()
 		self.new_blocks[key] = value
 		return key
+	# A block that's no longer referenced.  If we made it ourselves it
+	# never has to be written at all.
+	def drop (self, key):
+		if key in self.new_blocks:
+			del self.new_blocks[key]
+			self.free_list.append(key)
+		else:
+			self.old_blocks.append(key)
 	def alloc (self):
 		try:
 			return self.free_list.pop()
 		except IndexError:
-			return get_new_key()
+			return self.alloc_func()
 	def reset (self):
 		self.old_blocks = []
 		self.free_list += self.new_blocks.keys()
 		self.new_blocks = {}
 	def flush (self, putter):
-		for k, v in self.new_blocks.items():
-			putter(k,v)
-		# TBD: GC anything in old_blocks/free_list
+		putter(self.new_blocks.items())
+	# Once the commit has gone through: blocks the new version doesn't
+	# use, plus any we wrote along the way and ended up not needing.
+	def garbage (self):
+		return self.old_blocks + self.free_list
+
+class NoSuchKeyExc (Exception):
+	def __init__ (self, key):
+		self.key = key
+
+class BadSuperExc (Exception):
+	pass
+
+# A conditional put lost to someone else's update.
+class ConflictExc (Exception):
+	def __init__ (self, key):
+		self.key = key
+
+# Backoff between attempts at an optimistic commit starts at RETRY_BASE
+# seconds and doubles up to RETRY_MAX, with each actual wait picked at
+# random below that so that colliding writers spread out.  After
+# RETRY_LIMIT conflicts in a row we give up and pass the last one on.
+RETRY_BASE = 0.001
+RETRY_MAX = 0.5
+RETRY_LIMIT = 50
+
+# Per-operation counters for FS.commit.
+class RetryStats:
+	def __init__ (self):
+		self.commits = 0
+		self.conflicts = 0
+		self.failures = 0
+		self.waited = 0.0
+	def __repr__ (self):
+		return "commits=%d conflicts=%d failures=%d waited=%.3fs" % (
+			self.commits, self.conflicts, self.failures, self.waited)
 
 class IoOp:
 	def __init__ (self, op, key):
@@ -97,11 +315,149 @@ class IoOp:
 		self.version = vec
 
 class FS:
-	def __init__ (self, store):
+	def __init__ (self, store, block_sz=None, ptrs_per_block=None,
+			new_store=None):
+		# Most store clients (Voldemort's, memcache's) aren't
+		# thread-safe, so if we're given a way to make more then each
+		# thread gets its own.  The one passed in belongs to whoever
+		# created us.
 		self.store = store
+		self.new_store = new_store
+		self.tag = store_tag(store)
+		self.local = threading.local()
+		self.local.store = store
+		self.codec = None
+		# Only set from the superblock, because everyone who might
+		# have a leaf cached needs to know.
+		self.update_in_place = False
+		if block_sz:
+			self.set_geometry(block_sz,ptrs_per_block)
+		else:
+			self.set_geometry(BLOCK_SZ)
+			self.load_super()
+		# Blocks fetched in the background by read-ahead (see
+		# vfs_readahead).  Only the read-ahead worker's own FS sets
+		# fill_pool, so ordinary reads don't push things out.
+		self.pool = None
+		self.fill_pool = False
+		self.dedup = False
+		# Where superseded keys go (see vfs_gc).  Without one they're
+		# just left in the store.
+		self.gc = None
+		self.retry_lock = threading.Lock()
+		self.retry_stats = {}
+		self.allocator = KeyAllocator(self)
+	def new_key (self):
+		return self.allocator.new_key()
+	# Run an optimistic operation until its conditional put goes through.
+	# The attempt does all of its own reads, so a retry sees whatever
+	# changed; "reset" gets a chance to throw away per-attempt state
+	# first.  Only conflicts are retried.  Anything else is a real error
+	# and goes straight back to the caller.
+	def commit (self, name, attempt, reset=None):
+		delay = RETRY_BASE
+		conflicts = 0
+		waited = 0.0
+		while True:
+			try:
+				result = attempt()
+			except ConflictExc:
+				conflicts += 1
+				if conflicts >= RETRY_LIMIT:
+					self.count_retries(name,conflicts,
+						waited,True)
+					raise
+				log.it(jlog.DEBUG,"%s conflict #%d" % (
+					name, conflicts))
+				if reset:
+					reset()
+				pause = random.uniform(0,delay)
+				time.sleep(pause)
+				waited += pause
+				delay = min(delay*2,RETRY_MAX)
+				continue
+			self.count_retries(name,conflicts,waited,False)
+			return result
+	def count_retries (self, name, conflicts, waited, failed):
+		self.retry_lock.acquire()
+		try:
+			try:
+				stats = self.retry_stats[name]
+			except KeyError:
+				stats = RetryStats()
+				self.retry_stats[name] = stats
+			if failed:
+				stats.failures += 1
+			else:
+				stats.commits += 1
+			stats.conflicts += conflicts
+			stats.waited += waited
+		finally:
+			self.retry_lock.release()
+	def client (self):
+		if not self.new_store:
+			return self.store
+		try:
+			return self.local.store
+		except AttributeError:
+			self.local.store = self.new_store()
+			return self.local.store
+	def set_geometry (self, block_sz, ptrs_per_block=None, dir_shift=0):
+		if not ptrs_per_block:
+			ptrs_per_block = block_sz / PTR_SZ
+		self.block_sz = block_sz
+		self.ptrs_per_block = ptrs_per_block
+		self.ptr_blk_sz = ptrs_per_block * PTR_SZ
+		# Data can live in the inode until it outgrows either the
+		# pointer area or a single block.
+		self.embed_sz = min(self.ptr_blk_sz,block_sz)
+		self.dir_shift = dir_shift
+	def load_super (self):
+		try:
+			data, vector = self.get_value(SUPER_KEY)
+		except NoSuchKeyExc:
+			return False
+		magic, version, block_sz, ptrs, dir_shift = struct.unpack(
+			SUPER_FMT,data[:SUPER_SZ])
+		if (magic != SUPER_MAGIC) or (version > SUPER_VERSION):
+			raise BadSuperExc
+		self.set_geometry(block_sz,ptrs,dir_shift)
+		if version >= 2:
+			codec = struct.unpack(SUPER2_FMT,
+				data[SUPER_SZ:SUPER_SZ+SUPER2_SZ])[0]
+			self.set_codec(codec)
+		if version >= 3:
+			offset = SUPER_SZ + SUPER2_SZ
+			flags = struct.unpack(SUPER3_FMT,
+				data[offset:offset+SUPER3_SZ])[0]
+			self.update_in_place = bool(flags & SUPER_IN_PLACE)
+		return True
+	def write_super (self):
+		data = struct.pack(SUPER_FMT,SUPER_MAGIC,SUPER_VERSION,
+			self.block_sz,self.ptrs_per_block,self.dir_shift)
+		if self.codec:
+			codec = self.codec.number
+		else:
+			codec = vfs_codec.CODEC_NONE
+		data += struct.pack(SUPER2_FMT,codec)
+		flags = 0
+		if self.update_in_place:
+			flags |= SUPER_IN_PLACE
+		data += struct.pack(SUPER3_FMT,flags)
+		return self.put_value(SUPER_KEY,data)
+	# With no codec, values are stored exactly as given and have no
+	# header at all.
+	def set_codec (self, number):
+		if number == vfs_codec.CODEC_NONE:
+			self.codec = None
+		else:
+			self.codec = vfs_codec.Codec(number)
 	def get_value (self, key):
 		# This might throw a VoldemortException.
-		versions = self.store.get(key)
+		return self.check_versions(self.client().get(key),key)
+	def check_versions (self, versions, key=None):
+		if not versions:
+			raise NoSuchKeyExc(key)
 		if len(versions) != 1:
 			for data, clock in versions:
 				for e in clock:
@@ -111,29 +467,175 @@ class FS:
 		first = versions[0]
 		if len(first) != 2:
 			raise RuntimeError, "malformed data/version tuple"
+		if self.codec and (key != SUPER_KEY):
+			return self.codec.decode(first[0]), first[1]
 		return first
+	# Multi-key versions of get_value/put_value.  Stores that can do a
+	# whole batch in one round trip provide get_many/put_many; for the
+	# rest we just loop.  Missing keys are an error here, same as for a
+	# single get.
+	def get_values (self, keys):
+		result = self.find_values(keys)
+		for key in keys:
+			if key not in result:
+				raise RuntimeError, "missing key %s" % repr(key)
+		return result
+	# Same, except that missing keys are just left out.
+	def find_values (self, keys):
+		result = {}
+		try:
+			getter = self.client().get_many
+		except AttributeError:
+			for key in keys:
+				try:
+					result[key] = self.get_value(key)
+				except NoSuchKeyExc:
+					pass
+			return result
+		for key, versions in getter(keys).items():
+			if versions:
+				result[key] = self.check_versions(versions,key)
+		return result
+	# These are all unconditional, so the only way a put can fail is if
+	# the store itself does, and then we raise the same as put_many does.
+	def put_values (self, items):
+		if not items:
+			return
+		if self.codec:
+			items = self.codec.encode_many(items)
+		try:
+			putter = self.client().put_many
+		except AttributeError:
+			for key, data in items:
+				if self.client().put(key,data,None) is False:
+					raise RuntimeError, \
+						"put failed for %s" % repr(key)
+			return
+		putter(items)
+	# Stores that can't delete just keep everything.
+	def delete_values (self, keys):
+		try:
+			deleter = self.client().delete_many
+		except AttributeError:
+			try:
+				deleter = self.client().delete
+			except AttributeError:
+				return
+			for key in keys:
+				deleter(key)
+		else:
+			deleter(keys)
+		for key in keys:
+			block_cache.discard((self.tag,key))
+	# Only some stores can list what they have, but the GC's sweep needs
+	# to.
+	def list_keys (self):
+		try:
+			lister = self.client().keys
+		except AttributeError:
+			raise RuntimeError, "store can't list its keys"
+		return lister()
+	# Keys that nothing points to any more.
+	def retire (self, keys):
+		if self.gc and keys:
+			self.gc.retire(keys)
 	def get_inode (self, key):
 		data, vector = self.get_value(key)
 		if len(data) < INODE_SZ:
 			raise RuntimeError, "bad inode size"
 		return data, vector
-	def get_block (self, key):
+	# Data blocks are block_sz, pointer blocks ptr_blk_sz.  Callers
+	# fetching pointer blocks have to say so, and a size of None is how
+	# we know that it's a leaf.
+	def get_block (self, key, size=None):
 		node, boot, seq = struct.unpack(PTR_FMT,key)
 		if node == INVALID_NODE:
 			return False, None
+		data = self.cached_block(key,size)
+		if data:
+			return data, None
+		stamp = block_cache.stamp()
 		data, vector = self.get_value(key)
-		if len(data) != BLOCK_SZ:
+		if len(data) != (size or self.block_sz):
 			raise RuntimeError, "bad block size %u" % len(data)
+		if self.cacheable(size):
+			block_cache.put((self.tag,key),data,stamp)
 		return data, vector
+	def get_blocks (self, keys, size=None):
+		result = {}
+		missing = []
+		for key in keys:
+			data = self.cached_block(key,size)
+			if data:
+				result[key] = (data, None)
+			else:
+				missing.append(key)
+		if self.fill_pool:
+			stamp = self.pool.stamp()
+		else:
+			stamp = block_cache.stamp()
+		fetched = self.get_values(missing)
+		for key, value in fetched.items():
+			if len(value[0]) != (size or self.block_sz):
+				raise RuntimeError, "bad block size %u" % len(value[0])
+			if not self.cacheable(size):
+				continue
+			if self.fill_pool:
+				self.pool.put(key,value[0],stamp)
+			else:
+				block_cache.put((self.tag,key),value[0],stamp)
+		result.update(fetched)
+		return result
+	def cacheable (self, size):
+		return (size != None) or not self.update_in_place
+	# Something that's the wrong size for what the caller wants can't
+	# be the right block, so it's a miss.
+	def cached_block (self, key, size):
+		if not self.cacheable(size):
+			return None
+		data = block_cache.get((self.tag,key))
+		if (not data) and self.pool:
+			data = self.pool.get(key)
+		if data and (len(data) == (size or self.block_sz)):
+			return data
+		return None
 	def put_value (self, key, data, version=None):
-		if version != None:
-			version.entries[0].version += 1
-		return self.store.put(key,data,version)
-	def create_inode (self, key, mode, size=0, depth=0, entries=[]):
+		if self.codec and (key != SUPER_KEY):
+			data = self.codec.encode(data)
+		if version == None:
+			return self.client().put(key,data,version)
+		version.entries[0].version += 1
+		# Voldemort raises on an obsolete version; other stores just
+		# tell us.
+		try:
+			result = self.client().put(key,data,version)
+		except Exception, e:
+			if "ObsoleteVersion" in e.__class__.__name__:
+				raise ConflictExc(key)
+			raise
+		if result is False:
+			raise ConflictExc(key)
+		return result
+	# Create a value that mustn't already exist.  Stores that can't do
+	# that conditionally just get a plain put.
+	#
+	# TBD: Voldemort, which would need a vector clock made from scratch
+	def add_value (self, key, data):
+		if self.codec and (key != SUPER_KEY):
+			data = self.codec.encode(data)
+		try:
+			adder = self.client().add
+		except AttributeError:
+			return self.client().put(key,data,None)
+		if not adder(key,data):
+			raise ConflictExc(key)
+		return True
+	def create_inode (self, key, mode, size=0, depth=0, entries=[],
+			flags=0):
 		mode &= 0777
 		idata = struct.pack(INODE_FMT,stat.S_IFREG|mode,0,0,0,0,0,
-			size,0,0,0,depth)
-		idata += struct.pack('%ds'%BLOCK_SZ,'')
+			size,0,0,0,flags,depth)
+		idata += struct.pack('%ds'%self.ptr_blk_sz,'')
 		for index, dst in entries:
 			pdata = struct.pack(PTR_FMT,NODE_ID,0,dst)
 			offset = INODE_SZ + index * PTR_SZ
@@ -152,79 +654,402 @@ class FS:
 		left = size - offset
 		if length > left:
 			length = left
-		left = BLOCK_SZ - (offset % BLOCK_SZ)
+		left = self.block_sz - (offset % self.block_sz)
 		if length > left:
 			length = left
-		depth = inode[10]
+		depth = inode[11]
+		if inode[10] & FLAG_EXTENTS:
+			return self.emap_read(idata,depth,offset,length)
 		if not depth:
 			log.it(jlog.DEBUG,"embedded: %d at %d" % (
 				length, offset))
 			# TBD: atime
 			return idata[INODE_SZ+offset:INODE_SZ+offset+length]
-		bnum = offset / BLOCK_SZ
-		offset %= BLOCK_SZ
+		bnum = offset / self.block_sz
+		offset %= self.block_sz
 		path = []
 		while depth:
-			path.insert(0,bnum%PTRS_PER_BLOCK)
-			bnum /= PTRS_PER_BLOCK
+			path.insert(0,bnum%self.ptrs_per_block)
+			bnum /= self.ptrs_per_block
 			depth -= 1
 		log.it(jlog.DEBUG,"indirect: path %s" % repr(path))
-		ptr_off = INODE_SZ + path[0] * PTR_SZ
-		new_key = idata[ptr_off:ptr_off+PTR_SZ]
-		try:
-			data, vector = self.get_value(new_key)
-		except:	# TBD: catch specific missing-data exception(s)
-			# Fell into a hole.
-			return struct.pack('%ds'%length,'')
-		for index in path[1:]:
-			ptr_off = index * PTR_SZ
+		data = idata[INODE_SZ:]
+		for i in range(len(path)):
+			ptr_off = path[i] * PTR_SZ
 			new_key = data[ptr_off:ptr_off+PTR_SZ]
-			try:
-				data, vector = self.get_value(new_key)
-			except:	# TBD: catch specific missing-data exception(s)
+			if i < (len(path) - 1):
+				size = self.ptr_blk_sz
+			else:
+				size = None
+			data, vector = self.get_block(new_key,size)
+			if not data:
 				# Fell into a hole.
 				return struct.pack('%ds'%length,'')
 		return data[offset:offset+length]
-	def ensure_size (self, key, new_size):
+	# Walk the pointer tree one level at a time, fetching only the
+	# pointer blocks that cover blocks first..last, and return a list of
+	# (block number, key) for every leaf that's actually there.
+	def get_leaves (self, idata, depth, first, last):
+		level = [(idata[INODE_SZ:],0)]
 		while True:
+			span = self.ptrs_per_block ** (depth - 1)
+			found = []
+			for data, base in level:
+				lo = max(first-base,0) / span
+				hi = min((last-base)/span,
+					self.ptrs_per_block-1)
+				for i in range(lo,hi+1):
+					p_off = i * PTR_SZ
+					ptr = data[p_off:p_off+PTR_SZ]
+					node, boot, seq = struct.unpack(PTR_FMT,
+						ptr)
+					if node == INVALID_NODE:
+						continue
+					found.append((base+i*span,ptr))
+			depth -= 1
+			if not depth:
+				return found
+			blocks = self.get_blocks([ptr for base, ptr in found],
+				self.ptr_blk_sz)
+			level = []
+			for base, ptr in found:
+				level.append((blocks[ptr][0],base))
+	# Unlike get_data, this isn't limited to one block.  The inode is
+	# only read once and each pointer block only once per call, however
+	# many leaves hang off it.  Holes come back as zeroes without any
+	# trip to the store.  A caller that already has the inode (e.g. an
+	# open file handle) can pass it in to save even that.
+	def get_range (self, key, offset, length, io=None, inode=None):
+		if not io:
+			io = IoOp("get",key)
+		if inode:
+			idata, vector = inode
+		else:
 			idata, vector = self.get_inode(key)
-			inode = struct.unpack(INODE_FMT,idata[:INODE_SZ])
-			old_size = inode[6]
-			if new_size <= old_size:
-				return idata, vector
-			old_depth = inode[10]
-			new_depth = 0
-			blocks = (new_size + BLOCK_SZ - 1) / BLOCK_SZ
-			while blocks > 1:
-				new_depth += 1
-				blocks += (PTRS_PER_BLOCK - 1)
-				blocks /= PTRS_PER_BLOCK
-			if new_depth <= old_depth:
-				return idata, vector
-			log.it(jlog.DEBUG, "expanding from %d" % old_depth)
-			new_key = get_new_key()
-			self.put_value(new_key,idata[INODE_SZ:])
-			old_inode = struct.unpack(INODE_FMT,idata[:INODE_SZ])
-			new_inode = old_inode[:10] + (old_inode[10]+1,)
-			new_idata = apply(struct.pack,(INODE_FMT,)+new_inode)
-			new_idata += new_key
-			new_idata += struct.pack('%ds'%(BLOCK_SZ-PTR_SZ),'')
-			try:
-				self.put_value(key,new_idata,vector)
-				old_depth += 1
-				if old_depth >= new_depth:
-					log.it(jlog.DEBUG,
-						"new depth = %d" % new_depth)
-					return new_idata, vector
-			except:	# TBD: catch conflict-specific error(s)
-				pass	# TBD: delete new_key
+		io.set_version(vector)
+		inode = struct.unpack(INODE_FMT,idata[:INODE_SZ])
+		size = inode[6]
+		if offset >= size:
+			log.it(jlog.DEBUG,"beyond EOF")
+			return ''
+		if length > (size - offset):
+			length = size - offset
+		depth = inode[11]
+		if inode[10] & FLAG_EXTENTS:
+			return self.emap_read(idata,depth,offset,length)
+		if not depth:
+			# TBD: atime
+			return idata[INODE_SZ+offset:INODE_SZ+offset+length]
+		first = offset / self.block_sz
+		last = (offset + length - 1) / self.block_sz
+		leaves = self.get_leaves(idata,depth,first,last)
+		fetched = self.get_blocks([ptr for bnum, ptr in leaves])
+		blocks = {}
+		for bnum, ptr in leaves:
+			blocks[bnum] = fetched[ptr][0]
+		hole = struct.pack('%ds'%self.block_sz,'')
+		pieces = []
+		for bnum in range(first,last+1):
+			pieces.append(blocks.get(bnum,hole))
+		b_off = offset % self.block_sz
+		return ''.join(pieces)[b_off:b_off+length]
+	# Like lseek's SEEK_DATA and SEEK_HOLE, so that copies can skip over
+	# holes.  Offsets at or past EOF give None (ENXIO), and there's always
+	# a hole at EOF.  Blocks are data if they're there, whatever is in
+	# them; this only looks at pointers, never at data blocks.
+	def seek_data (self, key, offset):
+		for lo, hi in self.data_spans(key,offset) or []:
+			if hi > offset:
+				return max(lo,offset)
+		return None
+	def seek_hole (self, key, offset):
+		spans = self.data_spans(key,offset)
+		if spans == None:
+			return None
+		pos = offset
+		for lo, hi in spans:
+			if lo > pos:
+				break
+			pos = max(pos,hi)
+		return pos
+	# The parts of the file from offset on that hold data, as a list of
+	# (start,end) in order, or None if offset is past EOF.
+	def data_spans (self, key, offset):
+		idata, vector = self.get_inode(key)
+		inode = struct.unpack(INODE_FMT,idata[:INODE_SZ])
+		size = inode[6]
+		depth = inode[11]
+		if offset >= size:
+			return None
+		if inode[10] & FLAG_EXTENTS:
+			found = self.emap_find(idata[INODE_SZ:],depth,offset,size)
+			spans = [(e[0], e[0]+e[1]) for e in found]
+		elif not depth:
+			spans = [(0, size)]
+		else:
+			leaves = self.get_leaves(idata,depth,
+				offset/self.block_sz,(size-1)/self.block_sz)
+			spans = [(bnum*self.block_sz, (bnum+1)*self.block_sz)
+				for bnum, ptr in leaves]
+		result = []
+		for lo, hi in spans:
+			hi = min(hi,size)
+			if result and (result[-1][1] >= lo):
+				result[-1] = (result[-1][0], max(result[-1][1],hi))
+			else:
+				result.append((lo,hi))
+		return result
+	# Set a file's size.  Growing just makes a hole.  Shrinking unlinks
+	# everything past the new EOF, whole subtrees of pointer blocks at a
+	# time, zeroes the rest of the last block, and makes the tree as
+	# shallow as the new size allows (down to embedded data).  Whatever
+	# is no longer linked goes in the BlockSet's old_blocks for the GC.
+	# Returns the new inode and version.
+	def truncate (self, key, new_size):
+		idata, vector = self.get_inode(key)
+		flags = struct.unpack(INODE_FMT,idata[:INODE_SZ])[10]
+		hints = [(idata, vector)]
+		bset = BlockSet(self.get_value,self.new_key)
+		before = []
+		# Someone else might have shrunk the file since the last try,
+		# so growing the tree has to be redone every time.
+		def attempt ():
+			if hints:
+				hint = hints.pop()
+			else:
+				hint = None
+			if flags & FLAG_EXTENTS:
+				if hint:
+					idata, vector = hint
+				else:
+					idata, vector = self.get_inode(key)
+			else:
+				idata, vector = self.ensure_size(key,new_size,
+					hint)
+			before[:] = [idata]
+			idata = self.truncate_once(idata,new_size,bset)
+			bset.flush(self.put_values)
+			self.put_value(key,idata,vector)
+			return idata, vector
+		result = self.commit("truncate",attempt,bset.reset)
+		garbage = bset.garbage()
+		if flags & FLAG_EXTENTS:
+			old_size = struct.unpack(INODE_FMT,
+				before[0][:INODE_SZ])[6]
+			garbage += self.emap_garbage(before[0],result[0],
+				[(new_size,old_size)])
+		self.retire(garbage)
+		return result
+	def truncate_once (self, idata, new_size, bset):
+		inode = struct.unpack(INODE_FMT,idata[:INODE_SZ])
+		old_size = inode[6]
+		depth = inode[11]
+		if new_size < old_size:
+			if inode[10] & FLAG_EXTENTS:
+				idata = self.emap_truncate(idata,new_size,bset)
+			elif not depth:
+				# Keep the tail zeroed for when it grows again.
+				idata = idata[:INODE_SZ+new_size] + \
+					struct.pack('%ds'%(old_size-new_size),'') + \
+					idata[INODE_SZ+old_size:]
+			else:
+				idata = self.prune_tree(idata,new_size,bset)
+		return self.fix_size(idata,new_size)
+	def prune_tree (self, idata, new_size, bset):
+		depth = struct.unpack(INODE_FMT,idata[:INODE_SZ])[11]
+		keep = (new_size + self.block_sz - 1) / self.block_sz
+		tail = new_size % self.block_sz
+		new_depth = self.depth_for(new_size)
+		# If it's going back into the inode, that takes care of it.
+		if tail and new_depth:
+			leaves = self.get_leaves(idata,depth,keep-1,keep-1)
+			if leaves:
+				old_key = leaves[0][1]
+				data = self.get_block(old_key)[0][:tail]
+				data += struct.pack('%ds'%(self.block_sz-tail),'')
+				if is_zero(data):
+					new_key = HOLE_PTR
+				else:
+					new_key = bset.alloc()
+					bset.new_blocks[new_key] = data
+				idata = self.put_block(idata,keep-1,new_key,bset)
+		area = idata[INODE_SZ:INODE_SZ+self.ptr_blk_sz]
+		area = self.prune(area,depth,0,keep,bset)
+		while depth > new_depth:
+			# Everything's under the first pointer now.
+			ptr = area[:PTR_SZ]
+			if is_hole(ptr):
+				area = struct.pack('%ds'%self.ptr_blk_sz,'')
+			elif depth > 1:
+				area = bset.get(ptr)
+				self.unlinked(bset,[ptr])
+			else:
+				# Back to embedded data.
+				area = self.get_block(ptr)[0][:new_size]
+				area += struct.pack('%ds'%(
+					self.ptr_blk_sz-new_size),'')
+				self.unlinked(bset,[ptr])
+			depth -= 1
+		inode = struct.unpack(INODE_FMT,idata[:INODE_SZ])
+		new_inode = inode[:11] + (depth,)
+		return apply(struct.pack,(INODE_FMT,)+new_inode) + area + \
+			idata[INODE_SZ+self.ptr_blk_sz:]
+	# Drop every pointer in a pointer block (or the inode's pointer area)
+	# to blocks from "keep" on.  "base" is the first block it covers, and
+	# depth is the number of levels from here down to data blocks.
+	def prune (self, data, depth, base, keep, bset):
+		span = self.ptrs_per_block ** (depth - 1)
+		dropped = []
+		for i in range(self.ptrs_per_block):
+			lo = base + i * span
+			if (lo + span) <= keep:
+				continue
+			p_off = i * PTR_SZ
+			ptr = data[p_off:p_off+PTR_SZ]
+			if is_hole(ptr):
+				continue
+			if lo >= keep:
+				dropped.append(ptr)
+				new_ptr = HOLE_PTR
+			else:
+				child = bset.get(ptr)
+				new_child = self.prune(child,depth-1,lo,keep,bset)
+				if new_child == child:
+					continue
+				if is_zero(new_child):
+					self.unlinked(bset,[ptr])
+					new_ptr = HOLE_PTR
+				else:
+					new_ptr = bset.put(ptr,new_child)
+			data = data[:p_off] + new_ptr + data[p_off+PTR_SZ:]
+		self.unlinked(bset,self.tree_keys(dropped,depth-1))
+		return data
+	# The given keys and everything under them, where "levels" is how
+	# many levels of pointer blocks they start with.
+	def tree_keys (self, ptrs, levels):
+		keys = list(ptrs)
+		while ptrs and (levels > 0):
+			blocks = self.get_blocks(ptrs,self.ptr_blk_sz)
+			below = []
+			for ptr in ptrs:
+				data = blocks[ptr][0]
+				for i in range(self.ptrs_per_block):
+					child = data[i*PTR_SZ:(i+1)*PTR_SZ]
+					if not is_hole(child):
+						below.append(child)
+			keys += below
+			ptrs = below
+			levels -= 1
+		return keys
+	# Every value a file's data is in, not counting the inode itself.
+	# Dedup blocks are included, and might appear more than once.
+	def file_keys (self, idata):
+		inode = struct.unpack(INODE_FMT,idata[:INODE_SZ])
+		depth = inode[11]
+		if inode[10] & FLAG_EXTENTS:
+			return self.emap_keys(idata[INODE_SZ:],depth)
+		if not depth:
+			return []
+		ptrs = []
+		for i in range(self.ptrs_per_block):
+			ptr = idata[INODE_SZ+i*PTR_SZ:INODE_SZ+(i+1)*PTR_SZ]
+			if not is_hole(ptr):
+				ptrs.append(ptr)
+		return self.tree_keys(ptrs,depth-1)
+	# Hand an unlinked file over to the GC, inode and all.  Shared
+	# (dedup) blocks are left for the sweep.
+	# TBD: directories, which would leave their entries unreachable
+	def free_file (self, key):
+		if not self.gc:
+			return
+		idata, vector = self.get_inode(key)
+		if stat.S_ISDIR(struct.unpack(INODE_FMT,idata[:INODE_SZ])[0]):
+			return
+		keys = {}
+		for ptr in self.file_keys(idata):
+			if struct.unpack(PTR_FMT,ptr)[0] != DEDUP_NODE:
+				keys[ptr] = True
+		self.retire(keys.keys()+[key])
+	# Blocks this file doesn't use any more, except shared (dedup) ones
+	# that might still be in use elsewhere.
+	def unlinked (self, bset, keys):
+		for key in keys:
+			if struct.unpack(PTR_FMT,key)[0] != DEDUP_NODE:
+				bset.drop(key)
+	# Make the tree deep enough for new_size, one level per conditional
+	# put.  Returns the inode as it was left.
+	def ensure_size (self, key, new_size, hint=None):
+		hints = []
+		if hint:
+			hints.append(hint)
+		def attempt ():
+			if hints:
+				idata, vector = hints.pop()
+			else:
+				idata, vector = self.get_inode(key)
+			while True:
+				new_idata = self.grow_once(key,idata,vector,
+					new_size)
+				if not new_idata:
+					return idata, vector
+				idata = new_idata
+		return self.commit("grow",attempt)
+	# Returns None if the inode's already deep enough.  Otherwise adds a
+	# level, and vector is updated along with the stored inode.
+	def grow_once (self, key, idata, vector, new_size):
+		inode = struct.unpack(INODE_FMT,idata[:INODE_SZ])
+		old_size = inode[6]
+		old_depth = inode[11]
+		if (new_size <= old_size) or \
+		   (self.depth_for(new_size) <= old_depth):
+			return None
+		log.it(jlog.DEBUG, "expanding from %d" % old_depth)
+		new_block = idata[INODE_SZ:INODE_SZ+self.ptr_blk_sz]
+		if not old_depth:
+			# Embedded data becomes block zero.
+			new_block = new_block[:self.embed_sz]
+			new_block += struct.pack('%ds'%(
+				self.block_sz-self.embed_sz),'')
+		if is_zero(new_block):
+			new_key = HOLE_PTR
+		else:
+			new_key = self.new_key()
+			self.put_value(new_key,new_block)
+		new_inode = inode[:11] + (old_depth+1,)
+		new_idata = apply(struct.pack,(INODE_FMT,)+new_inode)
+		new_idata += new_key
+		new_idata += struct.pack('%ds'%(self.ptr_blk_sz-PTR_SZ),'')
+		try:
+			self.put_value(key,new_idata,vector)
+		except ConflictExc:
+			if not is_hole(new_key):
+				self.retire([new_key])
+			raise
+		return new_idata
+	def depth_for (self, size):
+		if size <= self.embed_sz:
+			return 0
+		blocks = (size + self.block_sz - 1) / self.block_sz
+		depth = 1
+		while blocks > self.ptrs_per_block:
+			depth += 1
+			blocks += (self.ptrs_per_block - 1)
+			blocks /= self.ptrs_per_block
+		return depth
+	# Linking a hole (an invalid dkey) never creates pointer blocks, and a
+	# pointer block left with nothing in it becomes a hole itself, so a
+	# sparse file only has pointer blocks where it has data.
 	def link_one (self, key, path, dkey, bset):
 		if len(path) == 0:
+			if (key != dkey) and not is_hole(key):
+				self.unlinked(bset,[key])
 			return dkey
 		my_index = path.pop()
 		node, boot, seq = struct.unpack(PTR_FMT,key)
 		if node == INVALID_NODE:
-			data = struct.pack('%ds'%BLOCK_SZ,'')
+			if is_hole(dkey):
+				return key
+			data = struct.pack('%ds'%self.ptr_blk_sz,'')
 		else:
 			data = bset.get(key)
 		offset = my_index * PTR_SZ
@@ -235,14 +1060,18 @@ class FS:
 		except:
 			import pdb
 			pdb.set_trace()
+		if is_zero(data):
+			if node != INVALID_NODE:
+				bset.drop(key)
+			return HOLE_PTR
 		return bset.put(key,data)
 	def put_block (self, idata, bnum, dkey, bset):
 		inode = struct.unpack(INODE_FMT,idata[:INODE_SZ])
 		path = []
-		for i in range(inode[10]):
+		for i in range(inode[11]):
 			# NB: order is from least significant to most
-			path.append(bnum%PTRS_PER_BLOCK)
-			bnum /= PTRS_PER_BLOCK
+			path.append(bnum%self.ptrs_per_block)
+			bnum /= self.ptrs_per_block
 		assert len(path) > 0
 		my_index = path.pop()
 		offset = INODE_SZ + my_index * PTR_SZ
@@ -250,110 +1079,246 @@ class FS:
 		ckey = self.link_one(ckey,path,dkey,bset)
 		idata = idata[:offset] + ckey + idata[offset+PTR_SZ:]
 		return idata
-	def put_once (self, io, idata, data, chunks, bset):
+	# On a retry, the chunks still have the blocks uploaded last time.
+	# Whole blocks can be used as they are.  Partial ones were merged with
+	# whatever block was there before ("base"), so they only need to be
+	# redone if someone else has replaced that block since.  A chunk that
+	# came out as a hole has no block of its own, and needs one if the
+	# redo makes it non-zero.
+	def put_once (self, idata, chunks, bset):
 		# Make sure every block is in store, not necessarily linked.
-		index = 0
-		for mem_off, dsk_off, length, key in chunks:
-			if length == BLOCK_SZ:
+		depth = struct.unpack(INODE_FMT,idata[:INODE_SZ])[11]
+		uploads = []
+		dedups = []
+		for chunk in chunks:
+			bnum, pieces, key, base = chunk
+			if key and is_hole(key):
+				key = None
+			covered = 0
+			for b_off, piece in pieces:
+				covered += len(piece)
+			if covered == self.block_sz:
 				if key:
 					continue
-				new_data = data[mem_off:(mem_off+length)]
+				pieces.sort()
+				new_data = ''.join([p for b_off, p in pieces])
 			else:
-				tmp_off = (dsk_off / BLOCK_SZ) * BLOCK_SZ
-				old_data = self.get_data(io.key,tmp_off,
-					BLOCK_SZ, io)
-				short = BLOCK_SZ - len(old_data)
-				if short:
-					extra = struct.pack('%ds'%short,'')
-					old_data += extra
-				tmp_off = dsk_off % BLOCK_SZ
-				new_data = old_data[:tmp_off] +\
-					   data[mem_off:(mem_off+length)] +\
-					   old_data[tmp_off+length:]
+				leaves = self.get_leaves(idata,depth,bnum,bnum)
+				if leaves:
+					base = leaves[0][1]
+				else:
+					base = None
+				# With in-place updates, the base can change
+				# without getting a new key.
+				if key and (base == chunk[3]) and \
+				   not self.update_in_place:
+					continue
+				if base:
+					new_data = self.get_block(base)[0]
+				else:
+					new_data = struct.pack('%ds'%
+						self.block_sz,'')
+				for b_off, piece in pieces:
+					new_data = new_data[:b_off] + piece + \
+						   new_data[b_off+len(piece):]
+				chunk[3] = base
+			if is_zero(new_data):
+				# Leave (or make) a hole instead.  Nothing can
+				# have linked what we uploaded last time.
+				if key and (struct.unpack(PTR_FMT,key)[0] !=
+						DEDUP_NODE):
+					self.retire([key])
+				chunk[2] = HOLE_PTR
+				continue
+			if self.dedup:
+				dedups.append((chunk,new_data))
+				continue
 			if not key:
-				key = get_new_key()
-			self.put_value(key,new_data)
-			chunks[index][3] = key
-			index += 1
+				key = self.new_key()
+			uploads.append((key,new_data))
+			chunk[2] = key
+		if dedups:
+			uploads += self.dedup_blocks(dedups)
+		self.put_values(uploads)
 		# Link each block to the inode.
-		for mem_off, dsk_off, length, key in chunks:
-			idata = self.put_block(idata,dsk_off/BLOCK_SZ,key,bset)
+		for bnum, pieces, key, base in chunks:
+			idata = self.put_block(idata,bnum,key,bset)
 		return idata
+	# Give each (chunk,data) its content key, and return whatever actually
+	# needs to be stored.  Existing blocks are checked for in one batch.
+	# The block cache isn't good enough for this, because something might
+	# have been freed since we read it.
+	def dedup_blocks (self, dedups):
+		for chunk, data in dedups:
+			chunk[2] = content_key(data)
+		keys = dict([(chunk[2], True) for chunk, data in dedups]).keys()
+		stored = {}
+		for key, value in self.find_values(keys).items():
+			stored[key] = value[0]
+		uploads = []
+		for chunk, data in dedups:
+			key = chunk[2]
+			have = stored.get(key)
+			if have == data:
+				continue
+			if have != None:
+				log.it(jlog.DEBUG,"content key collision")
+				key = self.new_key()
+				chunk[2] = key
+			else:
+				stored[key] = data
+			uploads.append((key,data))
+		return uploads
 	def fix_size (self, idata, new_size):
 		inode = list(struct.unpack(INODE_FMT,idata[:INODE_SZ]))
 		inode[6] = new_size
 		idata = apply(struct.pack, (INODE_FMT,) + tuple(inode)) + \
 			idata[INODE_SZ:]
 		return idata
+	# This is the "update single allocated block" optimization.  If a
+	# write falls within one block that already exists and doesn't change
+	# the size, nothing above that block needs to change, so we do a
+	# conditional put of the block itself instead of COW all the way up
+	# to the inode.  If that put fails, nothing has changed and the
+	# caller can fall back to the slow path.
+	#
+	# The inode still gets a conditional put, with nothing changed but
+	# its version.  If someone else has changed it since the caller read
+	# it, the leaf we updated might not be in the file any more, so we
+	# raise a conflict and the write is retried; redoing the same write on
+	# top of our own is harmless.  Otherwise, a COW writer that merged
+	# its data with the block before our put now loses its own conditional
+	# put, and merges again with ours on the retry.
+	#
+	# This is only done on filesystems made with it turned on (see
+	# SUPER_IN_PLACE), and those don't cache leaves at all.
+	def update_block (self, key, idata, vector, chunk):
+		bnum, pieces = chunk[:2]
+		depth = struct.unpack(INODE_FMT,idata[:INODE_SZ])[11]
+		leaves = self.get_leaves(idata,depth,bnum,bnum)
+		if not leaves:
+			# It's a hole, so there's no block to update.
+			return False
+		leaf = leaves[0][1]
+		if struct.unpack(PTR_FMT,leaf)[0] == DEDUP_NODE:
+			# Other files might be using it too.
+			return False
+		try:
+			data, l_vector = self.get_value(leaf)
+			for b_off, piece in pieces:
+				data = data[:b_off] + piece + \
+				       data[b_off+len(piece):]
+			if is_zero(data):
+				# Better to turn it into a hole.
+				return False
+			self.put_value(leaf,data,l_vector)
+		except ConflictExc:
+			return False
+		# Leaves aren't cached when this is allowed, but something
+		# might have been fetching this one just now.
+		block_cache.discard((self.tag,leaf))
+		if self.pool:
+			self.pool.discard(leaf)
+		self.put_value(key,idata,vector)
+		log.it(jlog.DEBUG,"updated block %d in place" % bnum)
+		return True
+	# Break a list of extents into per-block lists of pieces, so that
+	# two extents landing in the same block get a single read-modify-
+	# write between them.  Each entry is [bnum, [(offset,data)...], key,
+	# base]; see put_once for the last two.
+	def make_chunks (self, extents):
+		blocks = {}
+		chunks = []
+		for offset, data in extents:
+			mem_off = 0
+			while mem_off < len(data):
+				bnum = (offset + mem_off) / self.block_sz
+				b_off = (offset + mem_off) % self.block_sz
+				this_len = min(self.block_sz-b_off,
+					len(data)-mem_off)
+				try:
+					chunk = blocks[bnum]
+				except KeyError:
+					chunk = [bnum,[],None,None]
+					blocks[bnum] = chunk
+					chunks.append(chunk)
+				chunk[1].append((b_off,
+					data[mem_off:mem_off+this_len]))
+				mem_off += this_len
+		return chunks
 	def put_data (self, key, offset, data):
-		io = IoOp("put",key)
-		new_size = offset + len(data)
-		idata, vector = self.ensure_size(key,new_size)
-		io.set_version(vector)
+		self.put_extents(key,[(offset,data)])
+		return len(data)
+	# Write any number of (offset,data) extents with a single inode
+	# update.  The extents must not overlap.  If the caller has what it
+	# thinks is the current inode, it can pass that in; if it's stale
+	# we'll just fail the conditional put and refetch.  Either way, we
+	# return the inode as we left it.
+	def put_extents (self, key, extents, inode=None):
+		new_size = 0
+		for offset, data in extents:
+			new_size = max(new_size,offset+len(data))
+		if not inode:
+			inode = self.get_inode(key)
+		flags = struct.unpack(INODE_FMT,inode[0][:INODE_SZ])[10]
+		if flags & FLAG_EXTENTS:
+			return self.emap_put(key,extents,new_size,inode)
+		# Make a list of block-level operations.
+		chunks = self.make_chunks(extents)
+		bset = BlockSet(self.get_value,self.new_key)
+		hints = [inode]
+		def attempt ():
+			if hints:
+				hint = hints.pop()
+			else:
+				hint = None
+			idata, vector = self.ensure_size(key,new_size,hint)
+			return self.put_tree(key,idata,vector,new_size,chunks,
+				bset)
+		result = self.commit("write",attempt,bset.reset)
+		self.retire(bset.garbage())
+		return result
+	def put_tree (self, key, idata, vector, new_size, chunks, bset):
 		inode = struct.unpack(INODE_FMT,idata[:INODE_SZ])
 		old_size = inode[6]
-		depth = inode[10]
 		# Try the easy path if we can.
-		while (depth == 0) and (new_size <= BLOCK_SZ):
+		if (inode[11] == 0) and (new_size <= self.embed_sz):
 			log.it(jlog.DEBUG,"taking short path")
-			b_offset = INODE_SZ + offset
-			e_offset = INODE_SZ + new_size
-			try:
-				if new_size > old_size:
-					idata = self.fix_size(idata, new_size)
-				idata = idata[:b_offset] + \
-					data + idata[e_offset:]
-				self.put_value(key,idata,vector)
-				return len(data)
-			except:	# TBD: catch conflict-specific error(s)
-				idata, vector = self.get_inode(key)
-		# We don't want anyone manipulating inode below here.
-		del inode
-		# Make a list of block-level operations.
-		chunks = []
-		mem_offset = 0
-		dsk_offset = offset
-		total_len = len(data)
-		while total_len > 0:
-			in_block = BLOCK_SZ - (dsk_offset % BLOCK_SZ)
-			if total_len <= in_block:
-				this_len = total_len
-			else:
-				this_len = in_block
-			chunks.append([mem_offset,dsk_offset,this_len,None])
-			mem_offset += this_len
-			dsk_offset += this_len
-			total_len -= this_len
-		bset = BlockSet(self.get_value)
-		# Try to apply the list until we succeed.
-		while True:
-			try:
-				idata = self.put_once(io,idata,data,
-							chunks,bset)
-				bset.flush(self.put_value)
-				if new_size > old_size:
-					idata = self.fix_size(idata,new_size)
-				self.put_value(key,idata,io.version)
-				break
-			except:	# TBD: catch conflict-specific error(s)
-				bset.reset()
-				idata, vector = self.get_inode(key)
-				new_old_size = struct.unpack(INODE_FMT,
-					idata[:INODE_SZ])[6]
-				if new_old_size != old_size:
-					old_size = new_old_size
-		return len(data)
+			if new_size > old_size:
+				idata = self.fix_size(idata, new_size)
+			# Everything's in block zero, so offsets within the
+			# block are offsets within the embedded data.
+			for b_off, data in chunks[0][1]:
+				b_offset = INODE_SZ + b_off
+				e_offset = b_offset + len(data)
+				idata = idata[:b_offset] + data + idata[e_offset:]
+			self.put_value(key,idata,vector)
+			return idata, vector
+		if self.update_in_place and (len(chunks) == 1) and \
+		   (new_size <= old_size):
+			if self.update_block(key,idata,vector,chunks[0]):
+				return idata, vector
+		idata = self.put_once(idata,chunks,bset)
+		bset.flush(self.put_values)
+		if new_size > old_size:
+			idata = self.fix_size(idata,new_size)
+		self.put_value(key,idata,vector)
+		return idata, vector
 	def dump_pointers (self, data, offset, cur_depth, max_depth):
 		if cur_depth >= max_depth:
 			return
 		i = 0
-		while i < PTRS_PER_BLOCK:
+		while i < self.ptrs_per_block:
 			raw = data[offset:(offset+PTR_SZ)]
 			node, boot, seq = struct.unpack(PTR_FMT,raw)
 			if node != INVALID_NODE:
 				log.it(jlog.DEBUG,"%*s %u -> %u:%u:%u" % (
 					cur_depth*2,"",i, node, boot, seq))
-				data2, vector = self.get_block(raw)
+				if (cur_depth + 1) < max_depth:
+					size = self.ptr_blk_sz
+				else:
+					size = None
+				data2, vector = self.get_block(raw,size)
 				self.dump_pointers(data2,0,cur_depth+1,
 					max_depth)
 			offset += PTR_SZ
@@ -363,6 +1328,246 @@ class FS:
 		idata, vector = self.get_inode(key)
 		inode = struct.unpack(INODE_FMT,idata[:INODE_SZ])
 		log.it(jlog.DEBUG,"mode %o, size %u, depth %u" % (
-			inode[0], inode[6], inode[10]))
-		self.dump_pointers(idata,INODE_SZ,0,inode[10])
+			inode[0], inode[6], inode[11]))
+		if inode[10] & FLAG_EXTENTS:
+			for e in self.emap_find(idata[INODE_SZ:],inode[11],
+						0,inode[6]):
+				log.it(jlog.DEBUG,"  %u+%u -> %s+%u" % (
+					e[0], e[1], repr(e[3]), e[2]))
+			return
+		self.dump_pointers(idata,INODE_SZ,0,inode[11])
+
+	# Extent-mapped files.  The map is a B-tree whose root is in the
+	# inode; see EXTENT_FMT/INDEX_FMT.  Reads find the extents they need
+	# in O(log n) node fetches, and writes rewrite (COW) only the nodes
+	# covering the range they touch.  Chunks are at most block_sz, and a
+	# write that starts right where an extent ends gets merged with it
+	# until that limit, so sequential writes (especially via write-back)
+	# produce few extents.
+	def emap_cap (self, depth):
+		if depth:
+			return (self.ptr_blk_sz - EMAP_HDR_SZ) / INDEX_SZ
+		return (self.ptr_blk_sz - EMAP_HDR_SZ) / EXTENT_SZ
+	def emap_unpack (self, data, depth):
+		if depth:
+			fmt, size = INDEX_FMT, INDEX_SZ
+		else:
+			fmt, size = EXTENT_FMT, EXTENT_SZ
+		count = struct.unpack(EMAP_HDR_FMT,data[:EMAP_HDR_SZ])[0]
+		items = []
+		offset = EMAP_HDR_SZ
+		for i in range(count):
+			items.append(struct.unpack(fmt,data[offset:offset+size]))
+			offset += size
+		return items
+	def emap_pack (self, items, depth):
+		if depth:
+			fmt = INDEX_FMT
+		else:
+			fmt = EXTENT_FMT
+		data = struct.pack(EMAP_HDR_FMT,len(items))
+		for item in items:
+			data += apply(struct.pack,(fmt,)+tuple(item))
+		return data + struct.pack('%ds'%(self.ptr_blk_sz-len(data)),'')
+	# All extents overlapping [lo,hi), in order.
+	def emap_find (self, data, depth, lo, hi):
+		items = self.emap_unpack(data,depth)
+		if not depth:
+			return [e for e in items if (e[0] < hi) and (e[0]+e[1] > lo)]
+		firsts = [item[0] for item in items]
+		i0 = max(bisect.bisect_right(firsts,lo)-1,0)
+		i1 = bisect.bisect_left(firsts,hi) - 1
+		if i1 < i0:
+			return []
+		keys = [item[1] for item in items[i0:i1+1]]
+		nodes = self.get_blocks(keys,self.ptr_blk_sz)
+		found = []
+		for key in keys:
+			found += self.emap_find(nodes[key][0],depth-1,lo,hi)
+		return found
+	# The single extent containing offset, if any, as seen through bset.
+	def emap_lookup (self, items, depth, offset, bset):
+		while depth:
+			firsts = [item[0] for item in items]
+			index = bisect.bisect_right(firsts,offset) - 1
+			if index < 0:
+				return None
+			items = self.emap_unpack(bset.get(items[index][1]),
+				depth-1)
+			depth -= 1
+		for e in items:
+			if (e[0] <= offset) and (offset < e[0]+e[1]):
+				return e
+		return None
+	# Index nodes and chunks under a node, for the GC.
+	def emap_keys (self, data, depth):
+		items = self.emap_unpack(data,depth)
+		if not depth:
+			return [e[3] for e in items]
+		keys = [item[1] for item in items]
+		nodes = self.get_blocks(keys,self.ptr_blk_sz)
+		result = list(keys)
+		for key in keys:
+			result += self.emap_keys(nodes[key][0],depth-1)
+		return result
+	def emap_read (self, idata, depth, offset, length):
+		end = offset + length
+		found = self.emap_find(idata[INODE_SZ:],depth,offset,end)
+		chunks = self.get_values(list(set([e[3] for e in found])))
+		pieces = []
+		pos = offset
+		for loff, elen, coff, ckey in found:
+			start = max(loff,offset)
+			stop = min(loff+elen,end)
+			if start > pos:
+				pieces.append(struct.pack('%ds'%(start-pos),''))
+			c_off = coff + start - loff
+			pieces.append(chunks[ckey][0][c_off:c_off+stop-start])
+			pos = stop
+		if pos < end:
+			pieces.append(struct.pack('%ds'%(end-pos),''))
+		return ''.join(pieces)
+	# Replace whatever's in [lo,hi) with the new extents, below a node
+	# whose records are given.  Returns the node's new records, which
+	# might be too many for one node; the caller deals with that.
+	# Replaced nodes go to the GC; chunks are sorted out after the
+	# commit (see emap_garbage).
+	def emap_rewrite (self, items, depth, lo, hi, new, bset):
+		if not depth:
+			result = []
+			for e in items:
+				e_end = e[0] + e[1]
+				if (e_end <= lo) or (e[0] >= hi):
+					result.append(e)
+					continue
+				if e[0] < lo:
+					result.append((e[0],lo-e[0],e[2],e[3]))
+				if e_end > hi:
+					result.append((hi,e_end-hi,
+						e[2]+hi-e[0],e[3]))
+			result += new
+			result.sort()
+			return result
+		# Children whose ranges include lo-1 (so we see an extent
+		# ending at lo) through those starting before hi.
+		firsts = [item[0] for item in items]
+		i0 = max(bisect.bisect_left(firsts,lo)-1,0)
+		i1 = max(bisect.bisect_left(firsts,hi)-1,i0)
+		i1 = min(i1,len(items)-1)
+		children = []
+		for item in items[i0:i1+1]:
+			children += self.emap_unpack(bset.get(item[1]),depth-1)
+			bset.drop(item[1])
+		children = self.emap_rewrite(children,depth-1,lo,hi,new,bset)
+		return items[:i0] + self.emap_store(children,depth-1,bset) + \
+			items[i1+1:]
+	# Spread records over as few nodes as will hold them, and return
+	# index entries for those nodes.
+	def emap_store (self, items, depth, bset):
+		cap = self.emap_cap(depth)
+		count = (len(items) + cap - 1) / cap
+		entries = []
+		start = 0
+		for i in range(count):
+			stop = len(items) * (i + 1) / count
+			part = items[start:stop]
+			start = stop
+			key = bset.alloc()
+			bset.new_blocks[key] = self.emap_pack(part,depth)
+			entries.append((part[0][0],key))
+		return entries
+	def emap_write (self, idata, offset, data, bset):
+		inode = struct.unpack(INODE_FMT,idata[:INODE_SZ])
+		depth = inode[11]
+		root = self.emap_unpack(idata[INODE_SZ:],depth)
+		lo = offset
+		hi = offset + len(data)
+		if lo:
+			prev = self.emap_lookup(root,depth,lo-1,bset)
+			if prev and ((prev[0] + prev[1]) == lo) and \
+			   ((prev[1] + len(data)) <= self.block_sz):
+				chunk = bset.get(prev[3])
+				data = chunk[prev[2]:prev[2]+prev[1]] + data
+				lo = prev[0]
+		# New chunks go out with the new nodes, so the keys from an
+		# attempt that loses are used again by the retry, or end up
+		# in the garbage if it doesn't need them.
+		new = []
+		pos = 0
+		while pos < len(data):
+			piece = data[pos:pos+self.block_sz]
+			ckey = bset.alloc()
+			bset.new_blocks[ckey] = piece
+			new.append((lo+pos,len(piece),0,ckey))
+			pos += len(piece)
+		root = self.emap_rewrite(root,depth,lo,hi,new,bset)
+		while len(root) > self.emap_cap(depth):
+			root = self.emap_store(root,depth,bset)
+			depth += 1
+		new_inode = inode[:11] + (depth,)
+		return apply(struct.pack,(INODE_FMT,)+new_inode) + \
+			self.emap_pack(root,depth)
+	# Drop everything from new_size on, and take away levels while the
+	# root has only one child.
+	def emap_truncate (self, idata, new_size, bset):
+		inode = struct.unpack(INODE_FMT,idata[:INODE_SZ])
+		depth = inode[11]
+		root = self.emap_unpack(idata[INODE_SZ:],depth)
+		root = self.emap_rewrite(root,depth,new_size,inode[6],[],bset)
+		while depth and (len(root) <= 1):
+			if root:
+				child = root[0][1]
+				root = self.emap_unpack(bset.get(child),depth-1)
+				bset.drop(child)
+			depth -= 1
+		new_inode = inode[:11] + (depth,)
+		return apply(struct.pack,(INODE_FMT,)+new_inode) + \
+			self.emap_pack(root,depth)
+	def emap_put (self, key, extents, new_size, inode):
+		bset = BlockSet(self.get_value,self.new_key)
+		hints = [inode]
+		before = []
+		def attempt ():
+			if hints:
+				idata, vector = hints.pop()
+			else:
+				idata, vector = self.get_inode(key)
+			before[:] = [idata]
+			new_idata = idata
+			for offset, data in extents:
+				new_idata = self.emap_write(new_idata,offset,
+					data,bset)
+			old_size = struct.unpack(INODE_FMT,idata[:INODE_SZ])[6]
+			if new_size > old_size:
+				new_idata = self.fix_size(new_idata,new_size)
+			bset.flush(self.put_values)
+			self.put_value(key,new_idata,vector)
+			return new_idata, vector
+		result = self.commit("write",attempt,bset.reset)
+		ranges = [(offset,offset+len(data)) for offset, data in extents]
+		self.retire(bset.garbage() +
+			self.emap_garbage(before[0],result[0],ranges))
+		return result
+	# Chunks that a committed change left unused.  A chunk can be shared,
+	# but only by pieces of the one write that made it, so all of its
+	# extents are within a block of each other.  Anything the old version
+	# had near a changed range that the new one doesn't have within
+	# another block of it is gone for good.
+	def emap_garbage (self, old_idata, new_idata, ranges):
+		old_depth = struct.unpack(INODE_FMT,old_idata[:INODE_SZ])[11]
+		new_depth = struct.unpack(INODE_FMT,new_idata[:INODE_SZ])[11]
+		garbage = {}
+		for lo, hi in ranges:
+			lo = max(lo-self.block_sz,0)
+			hi += self.block_sz
+			found = self.emap_find(old_idata[INODE_SZ:],old_depth,
+				lo,hi)
+			if not found:
+				continue
+			gone = dict([(e[3], True) for e in found])
+			for e in self.emap_find(new_idata[INODE_SZ:],new_depth,
+					max(lo-self.block_sz,0),hi+self.block_sz):
+				gone.pop(e[3],None)
+			garbage.update(gone)
+		return garbage.keys()
 
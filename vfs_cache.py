@@ -0,0 +1,120 @@
+"""
+Copyright (c) 2010, Jeff Darcy <jeff@pl.atyp.us>
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""
+
+import collections
+import threading
+
+# How many recent discards an LRU remembers for put's stamp check.
+DISCARD_HISTORY = 1024
+
+# A simple LRU map.  By default the limit is a number of entries, but if a
+# sizer is given then it's applied to each value and the limit is in
+# whatever units that returns (usually bytes).  The lock is there because
+# some of these are shared with background threads.
+#
+# A value that was being fetched while someone discarded its key might be
+# stale, and putting it would bring the stale copy back.  So whoever fetches
+# takes a stamp() first and passes it to put, which quietly drops the value
+# if the key has been discarded since.  Only the last DISCARD_HISTORY
+# discards are remembered; anything older than that is refused outright.
+class LRU:
+	def __init__ (self, limit, sizer=None):
+		self.lock = threading.RLock()
+		self.limit = limit
+		self.sizer = sizer
+		self.used = 0
+		self.items = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.serial = 0
+		self.discards = collections.OrderedDict()
+		self.forgotten = 0
+	def __len__ (self):
+		return len(self.items)
+	def __contains__ (self, key):
+		return key in self.items
+	def size (self, value):
+		if self.sizer:
+			return self.sizer(value)
+		return 1
+	def get (self, key, default=None):
+		self.lock.acquire()
+		try:
+			try:
+				value = self.items.pop(key)
+			except KeyError:
+				self.misses += 1
+				return default
+			self.items[key] = value
+			self.hits += 1
+			return value
+		finally:
+			self.lock.release()
+	def stamp (self):
+		return self.serial
+	def put (self, key, value, stamp=None):
+		self.lock.acquire()
+		try:
+			if (stamp != None) and self.discarded_since(key,stamp):
+				return
+			self.remove(key)
+			self.items[key] = value
+			self.used += self.size(value)
+			self.trim()
+		finally:
+			self.lock.release()
+	def discarded_since (self, key, stamp):
+		if self.forgotten > stamp:
+			return True
+		return self.discards.get(key,0) > stamp
+	def discard (self, key):
+		self.lock.acquire()
+		try:
+			self.serial += 1
+			self.discards.pop(key,None)
+			self.discards[key] = self.serial
+			if len(self.discards) > DISCARD_HISTORY:
+				old_key, self.forgotten = \
+					self.discards.popitem(last=False)
+			self.remove(key)
+		finally:
+			self.lock.release()
+	def remove (self, key):
+		try:
+			value = self.items.pop(key)
+		except KeyError:
+			return
+		self.used -= self.size(value)
+	def trim (self):
+		self.lock.acquire()
+		try:
+			while (self.used > self.limit) and self.items:
+				key, value = self.items.popitem(last=False)
+				self.used -= self.size(value)
+				self.evictions += 1
+		finally:
+			self.lock.release()
+	def clear (self):
+		self.lock.acquire()
+		try:
+			self.items.clear()
+			self.used = 0
+			self.serial += 1
+			self.discards.clear()
+			self.forgotten = self.serial
+		finally:
+			self.lock.release()
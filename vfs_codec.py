@@ -0,0 +1,110 @@
+"""
+Copyright (c) 2010, Jeff Darcy <jeff@pl.atyp.us>
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""
+
+
+import bz2
+import struct
+import threading
+import zlib
+from multiprocessing.pool import ThreadPool
+
+import jlog
+log = jlog.logger(jlog.NORMAL)
+
+# When a filesystem has a codec (recorded in the superblock), every value
+# but the superblock itself starts with a one-byte codec number.  Values
+# that don't get any smaller are stored as CODEC_NONE, so reading never
+# costs more than a byte.  The header says how a value was written, so a
+# filesystem can switch codecs without rewriting anything.
+HDR_FMT = "!B"
+HDR_SZ = struct.calcsize(HDR_FMT)
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_BZ2 = 2
+
+ZLIB_LEVEL = 6
+
+# Values at least this big get compressed on the worker pool when there's
+# more than one of them in a batch.  zlib and bz2 let go of the GIL while
+# they work, so this actually runs in parallel.
+POOL_MIN = 16384
+POOL_THREADS = 4
+
+# number => (name, compress, decompress)
+codecs = {}
+
+def register (number, name, compress, decompress):
+	codecs[number] = (name, compress, decompress)
+
+register(CODEC_NONE,"none",None,None)
+register(CODEC_ZLIB,"zlib",lambda data: zlib.compress(data,ZLIB_LEVEL),
+	zlib.decompress)
+register(CODEC_BZ2,"bz2",bz2.compress,bz2.decompress)
+
+def by_name (name):
+	for number, info in codecs.items():
+		if info[0] == name:
+			return number
+	raise KeyError, "unknown codec %s" % name
+
+# This has to be started lazily because FUSE forks when it daemonizes,
+# and threads don't survive that.
+pool = None
+pool_lock = threading.Lock()
+
+def get_pool ():
+	global pool
+	pool_lock.acquire()
+	try:
+		if not pool:
+			pool = ThreadPool(POOL_THREADS)
+		return pool
+	finally:
+		pool_lock.release()
+
+class Codec:
+	def __init__ (self, number):
+		self.number = number
+		self.name, self.compress_func, junk = codecs[number]
+	def encode (self, data):
+		if self.compress_func:
+			packed = self.compress_func(data)
+			if len(packed) < len(data):
+				return struct.pack(HDR_FMT,self.number) + packed
+		return struct.pack(HDR_FMT,CODEC_NONE) + data
+	def decode (self, data):
+		number = struct.unpack(HDR_FMT,data[:HDR_SZ])[0]
+		if number == CODEC_NONE:
+			return data[HDR_SZ:]
+		try:
+			decompress = codecs[number][2]
+		except KeyError:
+			raise RuntimeError, "unknown codec %d" % number
+		return decompress(data[HDR_SZ:])
+	# Same as encode for a list of (key,data).
+	def encode_many (self, items):
+		big = [data for key, data in items if len(data) >= POOL_MIN]
+		if len(big) < 2:
+			return [(key, self.encode(data)) for key, data in items]
+		packed = iter(get_pool().map(self.encode,big))
+		result = []
+		for key, data in items:
+			if len(data) >= POOL_MIN:
+				result.append((key,packed.next()))
+			else:
+				result.append((key,self.encode(data)))
+		return result
@@ -14,11 +14,15 @@ ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 """
 
+import collections
 import hashlib
 import stat
 import struct
 import sys
+import threading
+import time
 from vfs_base import *
+import vfs_cache
 
 import jlog
 log = jlog.logger(jlog.NORMAL)
@@ -35,7 +39,9 @@ BUCKET_DSZ = BUCKET_SZ - BUCKET_HDR_SZ
 log.it(jlog.DEBUG,
 	"bucket size = %d header + %d data" % (BUCKET_HDR_SZ, BUCKET_DSZ))
 
-# Get our total size between 0.75x and 1.5x BLOCK_SZ.
+# Get our total size between 0.75x and 1.5x BLOCK_SZ.  This is only the
+# default; mkfs can record a different shift in the superblock, so the
+# code below should use DirOp.bucket_shift and friends instead.
 BUCKET_AREA = (BLOCK_SZ - INODE_SZ) * 3 / 4
 BUCKET_SHIFT = 0
 while (BUCKET_SZ << BUCKET_SHIFT) <= BUCKET_AREA:
@@ -57,6 +63,88 @@ log.it(jlog.DEBUG,"directory block size = %d (plus %d for inode)" % (
 PROTO_DBUCKET = struct.pack(BUCKET_FMT,'D')
 PROTO_IBUCKET = struct.pack(BUCKET_FMT,'I')
 
+# Compact direct buckets ('C') hold variable-length entries instead of
+# ENTRIES_PER_BUCKET fixed ones.  Each is a slot number, the name's length,
+# a 16-bit tag from the part of the name's hash that isn't used for
+# indexing (so most mismatches are rejected without comparing names), the
+# pointer, and then the name itself.  A zero length ends the list.  Slot
+# numbers are what go into enumeration cookies, so they stay put when
+# other entries come and go.  FLAG_COMPACT_DIR at mkdir time decides which
+# kind of direct bucket a directory gets, but both can be read anywhere.
+CENTRY_FMT = "!BBH%ds" % PTR_SZ
+CENTRY_SZ = struct.calcsize(CENTRY_FMT)
+COMPACT_SLOTS = 32
+PROTO_CBUCKET = struct.pack(BUCKET_FMT,'C')
+
+# In a sharded directory (FLAG_SHARDED_DIR) the top-level buckets aren't in
+# the directory's own value, which is just the inode.  Each one is a value
+# of its own, at a key derived from the directory's, so adding or removing
+# an entry only has to win a conditional put on the one bucket it hashes
+# to.  Dentry cache revalidation is per shard too.
+def shard_key (key, index):
+	return key + struct.pack("!H",index)
+
+# Directory flags never change after mkdir, and keys are never reused, so
+# once we've seen a directory's inode we can remember which kind it is.
+formats = vfs_cache.LRU(4096)
+
+# The low half of the hash picks buckets; the tag comes from the other.
+def hash_name (name):
+	hashobj = hashlib.md5()
+	hashobj.update(name)
+	hash, other = struct.unpack("QQ",hashobj.digest())
+	return hash, other & 0xffff
+
+# Entries are (slot, name, ptr, tag), in slot order.
+def compact_entries (bdata):
+	result = []
+	offset = BUCKET_HDR_SZ
+	while (offset + CENTRY_SZ) <= BUCKET_SZ:
+		slot, nlen, tag, ptr = struct.unpack(CENTRY_FMT,
+			bdata[offset:offset+CENTRY_SZ])
+		if not nlen:
+			break
+		offset += CENTRY_SZ
+		result.append((slot,bdata[offset:offset+nlen],ptr,tag))
+		offset += nlen
+	return result
+
+# Like compact_entries, but only looks at names whose tags match.
+def compact_find (bdata, name):
+	tag = hash_name(name)[1]
+	offset = BUCKET_HDR_SZ
+	while (offset + CENTRY_SZ) <= BUCKET_SZ:
+		slot, nlen, tag2, ptr = struct.unpack(CENTRY_FMT,
+			bdata[offset:offset+CENTRY_SZ])
+		if not nlen:
+			break
+		offset += CENTRY_SZ
+		if (tag2 == tag) and (bdata[offset:offset+nlen] == name):
+			return ptr
+		offset += nlen
+	return None
+
+def pack_compact (entries):
+	parts = [struct.pack(BUCKET_HDR_FMT,'C')]
+	for slot, name, ptr, tag in entries:
+		parts.append(struct.pack(CENTRY_FMT,slot,len(name),tag,ptr))
+		parts.append(name)
+	bdata = ''.join(parts)
+	return bdata + struct.pack('%ds'%(BUCKET_SZ-len(bdata)),'')
+
+# Either kind of direct bucket, as (slot, name, ptr) for the entries in use.
+def direct_entries (bdata):
+	if bdata[0] == 'C':
+		return [e[:3] for e in compact_entries(bdata)]
+	result = []
+	e_off = BUCKET_HDR_SZ
+	for i in range(ENTRIES_PER_BUCKET):
+		name, ptr = struct.unpack(ENTRY_FMT,bdata[e_off:e_off+ENTRY_SZ])
+		e_off += ENTRY_SZ
+		if name != "":
+			result.append((i,name,ptr))
+	return result
+
 class DupFileExc (Exception):
 	def __init__ (self, name):
 		self.name = name
@@ -64,36 +152,204 @@ class DupFileExc (Exception):
 class BadStateExc (Exception):
 	pass
 
+# One link or unlink, as queued for DirOp.add_many.
+class DirChange:
+	def __init__ (self, name, ptr):
+		self.name = name
+		self.ptr = ptr
+		self.error = None
+		self.done = False
+
+DCACHE_SIZE = 4096
+DCACHE_TTL = 1.0
+
+# Entries are (ptr,epoch) keyed by (parent,name), with ptr=None for a
+# negative entry.  Directory versions are tracked separately, per parent,
+# along with the time they were last checked and an epoch number.  An entry
+# is only good while its epoch matches its parent's, so when a directory
+# changes behind our back we bump the epoch instead of hunting down all of
+# its entries.  When we change a directory ourselves we can just advance
+# the version and fix the one entry involved.  Negative entries can have
+# a shorter lifetime than positive ones.  With several threads, a fetch
+# that started before one of our own changes can get here after it, so
+# versions older than the one we have are ignored, and entries only come
+# from a fetch of the version we're trusting.
+class DentryCache:
+	def __init__ (self, size=DCACHE_SIZE, ttl=DCACHE_TTL, neg_ttl=None):
+		self.entries = vfs_cache.LRU(size)
+		self.dirs = vfs_cache.LRU(size)
+		self.ttl = ttl
+		if neg_ttl == None:
+			neg_ttl = ttl
+		self.neg_ttl = neg_ttl
+		self.epoch = 0
+		# The LRUs lock themselves, but the directory info is changed
+		# in place and has to stay consistent with the entries.
+		self.lock = threading.RLock()
+	def configure (self, size=None, ttl=None, neg_ttl=None):
+		if size != None:
+			self.entries.limit = size
+			self.dirs.limit = size
+			self.entries.trim()
+			self.dirs.trim()
+		if ttl != None:
+			self.ttl = ttl
+		if neg_ttl != None:
+			self.neg_ttl = neg_ttl
+	def get (self, parent, name, now=None):
+		if now == None:
+			now = time.time()
+		self.lock.acquire()
+		try:
+			dinfo = self.dirs.get(parent)
+			if not dinfo:
+				return False, None
+			if (now - dinfo[1]) > self.ttl:
+				return False, None
+			einfo = self.entries.get((parent,name))
+			if (not einfo) or (einfo[1] != dinfo[2]):
+				return False, None
+			if (einfo[0] == None) and \
+			   ((now - dinfo[1]) > self.neg_ttl):
+				return False, None
+			return True, einfo[0]
+		finally:
+			self.lock.release()
+	def check (self, parent, version):
+		self.lock.acquire()
+		try:
+			dinfo = self.dirs.get(parent)
+			if dinfo and (dinfo[0] == version):
+				dinfo[1] = time.time()
+				return
+			if dinfo and (dinfo[0] > version):
+				return
+			self.epoch += 1
+			self.dirs.put(parent,[version,time.time(),self.epoch])
+		finally:
+			self.lock.release()
+	def update (self, parent, old_version, new_version, changes):
+		self.lock.acquire()
+		try:
+			dinfo = self.dirs.get(parent)
+			if not dinfo:
+				return
+			if dinfo[0] != old_version:
+				self.dirs.discard(parent)
+				return
+			dinfo[0] = new_version
+			dinfo[1] = time.time()
+			for name, ptr in changes:
+				self.entries.put((parent,name),(ptr,dinfo[2]))
+		finally:
+			self.lock.release()
+	# Entries found by looking in (or listing) the directory.  These are
+	# only good if what we looked at was the version we're trusting.
+	def fill (self, parent, version, name, ptr):
+		self.lock.acquire()
+		try:
+			dinfo = self.dirs.get(parent)
+			if dinfo and (dinfo[0] == version):
+				self.entries.put((parent,name),(ptr,dinfo[2]))
+		finally:
+			self.lock.release()
+	def forget (self, parent, name=None):
+		if name == None:
+			self.dirs.discard(parent)
+		else:
+			self.entries.discard((parent,name))
+	def clear (self):
+		self.entries.clear()
+		self.dirs.clear()
+
+dcache = DentryCache()
+
 class DirOp:
 	def __init__ (self, fs, key):
 		self.fs = fs
 		self.key = key
-		self.cache = {}
+		self.bucket_shift = fs.dir_shift or BUCKET_SHIFT
+		self.buckets_per_block = 1 << self.bucket_shift
+		self.proto = PROTO_DBUCKET
+		self.sharded = False
+		# The key the dentry cache tracks versions under; for a sharded
+		# directory it's whichever shard we're looking at.
+		self.dkey = key
 
-	def create (self, mode):
+	def create (self, mode, flags=0):
 		mode &= 0777
 		idata = struct.pack(INODE_FMT,stat.S_IFDIR|mode,
-			0,0,0,0,0,0,0,0,0,0)
+			0,0,0,0,0,0,0,0,0,flags,0)
+		self.set_format(idata)
+		if self.sharded:
+			shards = []
+			for b_idx in range(self.buckets_per_block):
+				shards.append((shard_key(self.key,b_idx),
+					self.proto))
+			self.fs.put_values(shards)
+			return self.fs.put_value(self.key,idata)
 		return self.fs.put_value(self.key,
-			idata + PROTO_DBUCKET * BUCKETS_PER_BLOCK)
+			idata + self.proto * self.buckets_per_block)
+
+	# New direct buckets (including new sub-blocks) follow the flags in
+	# the directory's inode.
+	def set_format (self, idata):
+		flags = struct.unpack(INODE_FMT,idata[:INODE_SZ])[10]
+		formats.put(self.key,flags)
+		self.set_flags(flags)
+
+	def set_flags (self, flags):
+		if flags & FLAG_COMPACT_DIR:
+			self.proto = PROTO_CBUCKET
+		else:
+			self.proto = PROTO_DBUCKET
+		self.sharded = bool(flags & FLAG_SHARDED_DIR)
+
+	# Same thing when we don't otherwise need the inode.
+	def get_format (self):
+		flags = formats.get(self.key)
+		if flags == None:
+			idata, vector = self.fs.get_value(self.key)
+			self.set_format(idata)
+		else:
+			self.set_flags(flags)
 
 	def split (self, bdata, used):
 		log.it(jlog.DEBUG,"*** BEGIN SPLIT")
 		new_bdata = PROTO_IBUCKET
-		e_off = BUCKET_HDR_SZ
-		for i in range(ENTRIES_PER_BUCKET):
-			name, ptr = struct.unpack(ENTRY_FMT,
-				bdata[e_off:e_off+ENTRY_SZ])
-			e_off += ENTRY_SZ
+		for slot, name, ptr in direct_entries(bdata):
 			log.it(jlog.DEBUG,"pushing %s down" % name)
-			hashobj = hashlib.md5()
-			hashobj.update(name)
-			hash = struct.unpack('QQ',hashobj.digest())[0]
+			hash, tag = hash_name(name)
 			new_bdata = self.add_indirect(new_bdata,hash,used,
 				name,ptr)
 		log.it(jlog.DEBUG,"*** END SPLIT")
 		return new_bdata
 
+	def add_compact (self, bdata, hash, used, name, ptr):
+		log.it(jlog.DEBUG,"in add_compact(0x%x/%d,%s)" % (
+			hash, used, name))
+		entries = compact_entries(bdata)
+		for i in range(len(entries)):
+			if entries[i][1] == name:
+				if ptr == None:
+					del entries[i]
+					return pack_compact(entries)
+				raise DupFileExc(name)
+		if ptr == None:
+			raise DupFileExc(name)
+		room = BUCKET_SZ - BUCKET_HDR_SZ
+		taken = {}
+		for slot, name2, ptr2, tag2 in entries:
+			room -= CENTRY_SZ + len(name2)
+			taken[slot] = True
+		free = [s for s in range(COMPACT_SLOTS) if s not in taken]
+		if (not free) or (room < (CENTRY_SZ + len(name))):
+			bdata = self.split(bdata,used)
+			return self.add_indirect(bdata,hash,used,name,ptr)
+		entries.append((free[0],name,ptr,hash_name(name)[1]))
+		entries.sort()
+		return pack_compact(entries)
+
 	def add_direct (self, bdata, hash, used, name, ptr):
 		log.it(jlog.DEBUG,"in add_direct(0x%x/%d,%s)" % (
 			hash, used, name))
@@ -105,8 +361,9 @@ class DirOp:
 				bdata[e_off:e_off+ENTRY_SZ])
 			log.it(jlog.DEBUG,"comparing %s to %s" % (name2, name))
 			if is_del:
-				found = i + 1
-				break
+				if name2 == name:
+					found = i + 1
+					break
 			else:
 				if name2 == name:
 					raise DupFileExc(name)
@@ -139,73 +396,270 @@ class DirOp:
 		node, boot, seq = struct.unpack(PTR_FMT,old_key)
 		if node == INVALID_NODE:
 			log.it(jlog.DEBUG,"  creating new sub-block")
-			nk_data = PROTO_DBUCKET * BUCKETS_PER_BLOCK
+			nk_data = self.proto * self.buckets_per_block
 		else:
 			log.it(jlog.DEBUG,
 				"  getting old sub-block %s" % repr(old_key))
 			nk_data = self.bset.get(old_key)
 		nk_data = self.add_once(nk_data,0,hash,used,name,ptr)
+		if ptr == None:
+			new_bdata = self.collapse(bdata,p_off,nk_data)
+			if new_bdata:
+				return new_bdata
 		new_key = self.bset.put(old_key,nk_data)
 		log.it(jlog.DEBUG,"new_key = %s" % repr(new_key))
 		return bdata[:p_off] + new_key + bdata[p_off+PTR_SZ:]
 
+	# All the entries in a block, or None if it has indirect buckets.
+	def block_entries (self, data):
+		result = []
+		for b_idx in range(self.buckets_per_block):
+			bdata = data[BUCKET_SZ*b_idx:BUCKET_SZ*(b_idx+1)]
+			if bdata[0] not in ('D','C'):
+				return None
+			result.extend(direct_entries(bdata))
+		return result
+
+	# Build a direct bucket in this directory's format, or return None if
+	# the entries won't fit in one.
+	def make_direct (self, entries):
+		if self.proto == PROTO_CBUCKET:
+			if len(entries) > COMPACT_SLOTS:
+				return None
+			room = BUCKET_SZ - BUCKET_HDR_SZ
+			packed = []
+			for slot, name, ptr in entries:
+				room -= CENTRY_SZ + len(name)
+				packed.append((len(packed),name,ptr,
+					hash_name(name)[1]))
+			if room < 0:
+				return None
+			return pack_compact(packed)
+		if len(entries) > ENTRIES_PER_BUCKET:
+			return None
+		bdata = struct.pack(BUCKET_HDR_FMT,'D')
+		for slot, name, ptr in entries:
+			bdata += struct.pack(ENTRY_FMT,name,ptr)
+		return bdata + PROTO_DBUCKET[len(bdata):]
+
+	# After a removal leaves the sub-block at p_off holding nk_data, see
+	# whether the indirect bucket it hangs off can shrink.  An empty
+	# sub-block is just dropped, and if everything under the bucket now
+	# fits in a single direct bucket the whole thing collapses into one.
+	# This is applied at each level on the way back up, so a directory
+	# that empties out gets shallower again.  Returns the new bucket, or
+	# None to leave things as they are.
+	def collapse (self, bdata, p_off, nk_data):
+		mine = self.block_entries(nk_data)
+		if mine == None:
+			return None
+		old_key = bdata[p_off:p_off+PTR_SZ]
+		siblings = []
+		for slot, key in self.sub_blocks(bdata):
+			if slot * PTR_SZ + BUCKET_HDR_SZ != p_off:
+				siblings.append(key)
+		if not mine:
+			log.it(jlog.DEBUG,"dropping empty sub-block")
+			self.bset.drop(old_key)
+			if not siblings:
+				return self.proto
+			bdata = bdata[:p_off] + \
+				struct.pack(PTR_FMT,INVALID_NODE,0,0) + \
+				bdata[p_off+PTR_SZ:]
+		# Entries hash evenly, so the siblings probably look like this
+		# one.  Don't go fetching them unless it's likely to pay off.
+		if self.proto == PROTO_CBUCKET:
+			room = COMPACT_SLOTS
+		else:
+			room = ENTRIES_PER_BUCKET
+		if len(mine) * (len(siblings) + 1) > room:
+			return None
+		self.bset.prefetch(siblings,self.fs.get_values)
+		entries = mine
+		for key in siblings:
+			more = self.block_entries(self.bset.get(key))
+			if more == None:
+				break
+			entries = entries + more
+		else:
+			new_bdata = self.make_direct(entries)
+			if new_bdata:
+				log.it(jlog.DEBUG,"collapsing %d sub-blocks" % (
+					len(siblings) + 1))
+				if mine:
+					self.bset.drop(old_key)
+				for key in siblings:
+					self.bset.drop(key)
+				return new_bdata
+		if mine:
+			return None
+		return bdata
+
+	# (index, key) for the sub-blocks an indirect bucket points to.
+	def sub_blocks (self, bdata):
+		result = []
+		offset = BUCKET_HDR_SZ
+		for p_idx in range(PTRS_PER_BUCKET):
+			key = bdata[offset:offset+PTR_SZ]
+			offset += PTR_SZ
+			node, boot, seq = struct.unpack(PTR_FMT,key)
+			if node != INVALID_NODE:
+				result.append((p_idx,key))
+		return result
+
+	# Shards and sub-blocks: every value the directory uses besides its
+	# own.  This is for the GC's sweep, so it doesn't go through the
+	# dentry cache or worry about consistency across shards.
+	def block_keys (self):
+		data, vector = self.fs.get_value(self.key)
+		self.set_format(data)
+		result = []
+		buckets = []
+		blocks = []
+		if self.sharded:
+			for b_idx in range(self.buckets_per_block):
+				result.append(shard_key(self.key,b_idx))
+			shards = self.fs.get_values(result)
+			for key in result:
+				buckets.append(shards[key][0][:BUCKET_SZ])
+		else:
+			blocks = [data[INODE_SZ:]]
+		while buckets or blocks:
+			for data in blocks:
+				for b_idx in range(self.buckets_per_block):
+					b_off = BUCKET_SZ * b_idx
+					buckets.append(data[b_off:b_off+BUCKET_SZ])
+			subs = []
+			for bdata in buckets:
+				if bdata[0] == 'I':
+					for p_idx, key in self.sub_blocks(bdata):
+						subs.append(key)
+			result += subs
+			found = self.fs.get_values(subs)
+			blocks = [found[key][0] for key in subs]
+			buckets = []
+		return result
+
 	def add_once (self, idata, offset, hash, used, name, ptr):
 		log.it(jlog.DEBUG,"in add_once(%d,0x%x/%d,%s)" % (
 			offset, hash, used, name))
-		index = (hash >> used) % BUCKETS_PER_BLOCK
+		index = (hash >> used) % self.buckets_per_block
 		log.it(jlog.DEBUG,"using bucket %d" % index)
-		used += BUCKET_SHIFT
+		used += self.bucket_shift
 		offset += BUCKET_SZ * index
 		bdata = idata[offset:offset+BUCKET_SZ]
+		bdata = self.add_bucket(bdata,hash,used,name,ptr)
+		return idata[:offset] + bdata + idata[offset+BUCKET_SZ:]
+
+	def add_bucket (self, bdata, hash, used, name, ptr):
 		state = struct.unpack(BUCKET_HDR_FMT,bdata[:BUCKET_HDR_SZ])[0]
 		if state == 'D':
-			bdata = self.add_direct(bdata,hash,used,name,ptr)
-		elif state == 'I':
-			bdata = self.add_indirect(bdata,hash,used,name,ptr)
-		else:
-			raise BadStateExc
-		return idata[:offset] + bdata + idata[offset+BUCKET_SZ:]
+			return self.add_direct(bdata,hash,used,name,ptr)
+		if state == 'C':
+			return self.add_compact(bdata,hash,used,name,ptr)
+		if state == 'I':
+			return self.add_indirect(bdata,hash,used,name,ptr)
+		raise BadStateExc
 
+	# Add an entry, or remove it if ptr is None.  Raises DupFileExc if
+	# the name is already there (or, for a removal, isn't).
 	def add (self, name, ptr):
-		if len(name) > MAX_NAME_LEN:
-			raise KeyError, "name too long"
-		hashobj = hashlib.md5()
-		hashobj.update(name)
-		hash = struct.unpack("QQ",hashobj.digest())[0]
-		log.it(jlog.DEBUG,"%s hashes to 0x%x" % (name, hash))
-		self.bset = BlockSet(self.fs.get_value)
-		while True:
+		change = DirChange(name,ptr)
+		self.add_many([change])
+		if change.error:
+			raise change.error
+
+	# Apply a batch of changes in one commit.  Each one that fails gets
+	# its exception in "error" without holding up the rest.  For a sharded
+	# directory they all have to be in the same shard.
+	def add_many (self, changes):
+		todo = []
+		for change in changes:
+			if len(change.name) > MAX_NAME_LEN:
+				change.error = KeyError("name too long")
+			else:
+				todo.append(change)
+		if not todo:
+			return
+		self.bset = BlockSet(self.fs.get_value,self.fs.new_key)
+		self.get_format()
+		if self.sharded:
+			attempt = self.add_shard(todo)
+		else:
+			attempt = self.add_root(todo)
+		self.fs.commit("dir",attempt,self.bset.reset)
+		self.fs.retire(self.bset.garbage())
+
+	# Each attempt starts again from what's in the store, so earlier
+	# results get thrown away along with everything else.
+	def apply (self, changes, data, offset, used):
+		done = []
+		for change in changes:
+			hash, tag = hash_name(change.name)
+			log.it(jlog.DEBUG,"%s hashes to 0x%x" % (
+				change.name, hash))
 			try:
-				idata, vector = self.fs.get_value(self.key)
-				idata = self.add_once(idata,INODE_SZ,
-					hash, 0, name, ptr)
-				self.bset.flush(self.fs.put_value)
-				self.fs.put_value(self.key,idata,vector)
-				break
+				if offset:
+					data = self.add_once(data,offset,hash,used,
+						change.name,change.ptr)
+				else:
+					data = self.add_bucket(data,hash,used,
+						change.name,change.ptr)
 			except DupFileExc:
-				etype, dfe, stack = sys.exc_info()
-				log.it(jlog.DEBUG,
-					"duplicate detected for %s" % dfe.name)
+				etype, change.error, stack = sys.exc_info()
+				log.it(jlog.DEBUG,"duplicate detected for %s" %
+					change.name)
+				continue
+			change.error = None
+			done.append((change.name,change.ptr))
+		return data, done
+
+	def add_root (self, changes):
+		def attempt ():
+			idata, vector = self.fs.get_value(self.key)
+			old_version = vector.entries[0].version
+			self.set_format(idata)
+			idata, done = self.apply(changes,idata,INODE_SZ,0)
+			if not done:
 				return
-			"""
-			except: # TBD: catch conflict-specific exception(s)
-				self.bset.reset()
-			"""
+			self.bset.flush(self.fs.put_values)
+			self.fs.put_value(self.key,idata,vector)
+			dcache.update(self.key,old_version,
+				vector.entries[0].version,done)
+		return attempt
+
+	def add_shard (self, changes):
+		skey = self.shard_for(hash_name(changes[0].name)[0])
+		def attempt ():
+			bdata, vector = self.fs.get_value(skey)
+			old_version = vector.entries[0].version
+			bdata, done = self.apply(changes,bdata,0,
+				self.bucket_shift)
+			if not done:
+				return
+			self.bset.flush(self.fs.put_values)
+			self.fs.put_value(skey,bdata,vector)
+			dcache.update(skey,old_version,
+				vector.entries[0].version,done)
+		return attempt
 
 	def lookup_one (self, name, data, offset, hash, used):
 		log.it(jlog.DEBUG,"in lookup_one(%s,%d,0x%x/%d)" % (
 			name, offset, hash, used))
-		index = (hash >> used) % BUCKETS_PER_BLOCK
-		used += BUCKET_SHIFT
+		index = (hash >> used) % self.buckets_per_block
+		used += self.bucket_shift
 		log.it(jlog.DEBUG,"  using bucket %d" % index)
 		b_off = offset + BUCKET_SZ * index
-		state = struct.unpack(BUCKET_HDR_FMT,
-			data[b_off:b_off+BUCKET_HDR_SZ])[0]
+		return self.lookup_bucket(name,data[b_off:b_off+BUCKET_SZ],
+			hash,used)
+
+	def lookup_bucket (self, name, bdata, hash, used):
+		state = struct.unpack(BUCKET_HDR_FMT,bdata[:BUCKET_HDR_SZ])[0]
 		if state == 'D':
-			e_off = b_off + BUCKET_HDR_SZ
+			e_off = BUCKET_HDR_SZ
 			for i in range(ENTRIES_PER_BUCKET):
 				name2, ptr = struct.unpack(ENTRY_FMT,
-					data[e_off:e_off+ENTRY_SZ])
+					bdata[e_off:e_off+ENTRY_SZ])
 				e_off += ENTRY_SZ
 				log.it(jlog.DEBUG,"  direct compare %s" % name2)
 				if name2 == name:
@@ -214,12 +668,14 @@ class DirOp:
 					return ptr
 			log.it(jlog.DEBUG,"  no match")
 			return None
+		if state == 'C':
+			return compact_find(bdata,name)
 		if state == 'I':
 			index = (hash >> used) % PTRS_PER_BUCKET
 			used += PTR_SHIFT
 			log.it(jlog.DEBUG,"  going to sub-block %d" % index)
-			p_off = b_off + BUCKET_HDR_SZ + PTR_SZ * index
-			key = data[p_off:p_off+PTR_SZ]
+			p_off = BUCKET_HDR_SZ + PTR_SZ * index
+			key = bdata[p_off:p_off+PTR_SZ]
 			node, boot, seq = struct.unpack(PTR_FMT,key)
 			if node == INVALID_NODE:
 				log.it(jlog.DEBUG,"  no such sub-block")
@@ -231,134 +687,185 @@ class DirOp:
 	def lookup (self, name):
 		if len(name) > MAX_NAME_LEN:
 			raise KeyError, "name too long"
-		hashobj = hashlib.md5()
-		hashobj.update(name)
-		hash = struct.unpack("QQ",hashobj.digest())[0]
+		hash, tag = hash_name(name)
 		log.it(jlog.DEBUG,"%s hashes to 0x%x" % (name, hash))
+		self.get_format()
+		if self.sharded:
+			bdata, vector = self.fs.get_value(self.shard_for(hash))
+			return self.lookup_bucket(name,bdata,hash,
+				self.bucket_shift)
 		data, vector = self.fs.get_value(self.key)
 		return self.lookup_one(name,data,INODE_SZ,hash,0)
 
-	# Unlike most other situations, we do want to keep using cached
-	# values so that a series of enum calls use a consistent view even
-	# if other modifications occur in the meantime.
-	def get_cached (self, key):
-		try:
-			data = self.cache[key]
-		except KeyError:
-			data, vector = self.fs.get_value(key)
-			self.cache[key] = data
-		return data
+	def shard_for (self, hash):
+		return shard_key(self.key,hash%self.buckets_per_block)
+
+	# Same as lookup, but through the dentry cache.  If our information
+	# about the directory has expired, we still have to fetch it to see
+	# if the version changed, but if it didn't then we're spared the
+	# sub-block fetches.
+	def lookup_cached (self, name):
+		if len(name) > MAX_NAME_LEN:
+			raise KeyError, "name too long"
+		hash, tag = hash_name(name)
+		self.get_format()
+		if self.sharded:
+			dkey = self.shard_for(hash)
+		else:
+			dkey = self.key
+		hit, ptr = dcache.get(dkey,name)
+		if hit:
+			return ptr
+		data, vector = self.fs.get_value(dkey)
+		version = vector.entries[0].version
+		dcache.check(dkey,version)
+		hit, ptr = dcache.get(dkey,name)
+		if hit:
+			return ptr
+		if self.sharded:
+			ptr = self.lookup_bucket(name,data,hash,
+				self.bucket_shift)
+		else:
+			ptr = self.lookup_one(name,data,INODE_SZ,hash,0)
+		dcache.fill(dkey,version,name,ptr)
+		return ptr
+
+	# Walk the whole directory, yielding (name,ptr,cookie) for each entry.
+	# A cookie is the entry's position in the hash tree plus two (0 and 1
+	# are for "." and ".."), so passing the last cookie we got back in as
+	# "entry" picks up right after it.  All of the state is in the
+	# generators' frames, so memory use depends on the depth of the tree
+	# and not the size of the directory.  Each sub-block is fetched
+	# exactly once, and since they're COW the whole walk sees the
+	# directory as it was when we started.  A sharded directory is only
+	# consistent shard by shard, with dkey/version tracking the one that
+	# the last entry came from.
+	def walk (self, entry=0):
+		data, vector = self.fs.get_value(self.key)
+		self.set_format(data)
+		self.dkey = self.key
+		self.version = vector.entries[0].version
+		dcache.check(self.key,self.version)
+		# TBD: check that it's a directory
+		# TBD: add real entries for . and .. during mkdir
+		if entry < 1:
+			yield ".", "", 1
+		if entry < 2:
+			yield "..", "", 2
+			seek = None
+		else:
+			seek = entry - 2
+		if self.sharded:
+			sub = self.walk_shards(seek)
+		else:
+			sub = self.walk_block(data,INODE_SZ,0,0,seek)
+		for item in sub:
+			yield item
+
+	# Like walk_block, except that each bucket is its own value.
+	def walk_shards (self, seek):
+		if seek != None:
+			index = seek % self.buckets_per_block
+		else:
+			index = 0
+		keys = []
+		for b_idx in range(index,self.buckets_per_block):
+			keys.append((b_idx,shard_key(self.key,b_idx)))
+		shards = self.fs.get_values([key for b_idx, key in keys])
+		for b_idx, key in keys:
+			bdata, vector = shards.pop(key)
+			self.dkey = key
+			self.version = vector.entries[0].version
+			dcache.check(key,self.version)
+			for item in self.walk_bucket(bdata,b_idx,
+					self.bucket_shift,seek):
+				yield item
+			seek = None
+
+	# While "seek" is set we're still following the path down to where
+	# the last walk left off; after that we start every bucket at zero.
+	def walk_block (self, data, offset, xhash, used, seek):
+		if seek != None:
+			index = (seek >> used) % self.buckets_per_block
+		else:
+			index = 0
+		mask = (1 << used) - 1
+		used += self.bucket_shift
+		for b_idx in range(index,self.buckets_per_block):
+			b_off = offset + BUCKET_SZ * b_idx
+			bdata = data[b_off:b_off+BUCKET_SZ]
+			yhash = (xhash & mask) | \
+				(b_idx << (used-self.bucket_shift))
+			for item in self.walk_bucket(bdata,yhash,used,seek):
+				yield item
+			seek = None
+
+	def walk_bucket (self, bdata, xhash, used, seek):
+		hdr = struct.unpack(BUCKET_HDR_FMT,bdata[:BUCKET_HDR_SZ])
+		if hdr[0] in ('D','C'):
+			return self.walk_direct(bdata,xhash,used,seek)
+		if hdr[0] == 'I':
+			return self.walk_indirect(bdata,xhash,used,seek)
+		raise BadStateExc
 
-	def enum_direct (self, bdata, xhash, used, first):
-		log.it(jlog.DEBUG,"enum_direct(0x%x/%d)" % (xhash, used))
-		if first:
-			index = (self.entry >> used) % ENTRIES_PER_BUCKET
+	def walk_direct (self, bdata, xhash, used, seek):
+		if bdata[0] == 'C':
+			slots = COMPACT_SLOTS
+		else:
+			slots = ENTRIES_PER_BUCKET
+		if seek != None:
+			index = (seek >> used) % slots
 		else:
 			index = 0
 		mask = (1 << used) - 1
-		offset = BUCKET_HDR_SZ + ENTRY_SZ * index
-		for e_idx in range(index,ENTRIES_PER_BUCKET):
-			log.it(jlog.DEBUG," e_idx = %d" % e_idx)
-			edata = bdata[offset:offset+ENTRY_SZ]
-			offset += ENTRY_SZ
-			mask = (1 << used) - 1
-			yhash = ((xhash & mask) | (e_idx << used)) + 2
-			log.it(jlog.DEBUG,'self.entry = 0x%x, yhash = 0x%x' % (
-				self.entry, yhash))
-			if yhash == (self.entry + 2):
-				if self.orig_entry >= 2:
-					log.it(jlog.DEBUG,"found last entry")
-					continue
-			name, ptr = struct.unpack(ENTRY_FMT,edata)
-			if name == "":
+		for slot, name, ptr in direct_entries(bdata):
+			if slot < index:
+				continue
+			yhash = ((xhash & mask) | (slot << used)) + 2
+			if (seek != None) and (yhash == (seek + 2)):
+				# The caller already has this one.
 				continue
-			if self.callback(name,ptr,yhash):
-				return True
-			self.cb_calls += 1
-		return False
-
-	def enum_indirect (self, bdata, xhash, used, first):
-		log.it(jlog.DEBUG,"enum_indirect(0x%x/%d)" % (xhash, used))
-		if first:
-			index = (self.entry >> used) % PTRS_PER_BUCKET
+			yield name, ptr, yhash
+
+	def walk_indirect (self, bdata, xhash, used, seek):
+		if seek != None:
+			index = (seek >> used) % PTRS_PER_BUCKET
 		else:
 			index = 0
 		mask = (1 << used) - 1
 		used += PTR_SHIFT
+		# Load all of the sub-blocks we're about to walk through at
+		# once, and let go of each as soon as we're done with it.
+		keys = []
 		offset = BUCKET_HDR_SZ + PTR_SZ * index
 		for p_idx in range(index,PTRS_PER_BUCKET):
-			log.it(jlog.DEBUG," p_idx = %d" % p_idx)
 			key = bdata[offset:offset+PTR_SZ]
 			offset += PTR_SZ
 			node, boot, seq = struct.unpack(PTR_FMT,key)
-			if node == INVALID_NODE:
-				continue
-			data = self.get_cached(key)
+			if node != INVALID_NODE:
+				keys.append((p_idx,key))
+		blocks = self.fs.get_values([key for p_idx, key in keys])
+		for p_idx, key in keys:
+			data = blocks.pop(key)[0]
 			yhash = (xhash & mask) | (p_idx << (used-PTR_SHIFT))
-			if self.enum_one(data,0,yhash,used,first):
-				return True
-			first = False
-		return False
-
-	def enum_one (self, data, offset, xhash, used, first):
-		log.it(jlog.DEBUG,"enum_one(0x%x/%d)" % (xhash, used))
-		if first:
-			index = (self.entry >> used) % BUCKETS_PER_BLOCK
-		else:
-			index = 0
-		mask = (1 << used) - 1
-		used += BUCKET_SHIFT
-		for b_idx in range(index,BUCKETS_PER_BLOCK):
-			log.it(jlog.DEBUG," b_idx = %d" % b_idx)
-			b_off = offset + BUCKET_SZ * b_idx
-			bdata = data[b_off:b_off+BUCKET_SZ]
-			hdr = struct.unpack(BUCKET_HDR_FMT,
-				bdata[:BUCKET_HDR_SZ])
-			yhash = (xhash & mask) | (b_idx << (used-BUCKET_SHIFT))
-			if hdr[0] == 'D':
-				if self.enum_direct(bdata,yhash,used,first):
-					return True
-			elif hdr[0] == 'I':
-				if self.enum_indirect(bdata,yhash,used,first):
-					return True
-			else:
-				raise BadStateExc
-			first = False
-		return False
+			for item in self.walk_block(data,0,yhash,used,seek):
+				yield item
+			seek = None
 
+	# Callback-style enumeration.  The callback returns true to stop, in
+	# which case we return False (not done) and the caller can come back
+	# with the last cookie it saw.
 	def enum (self, callback, entry=0):
-		log.it(jlog.DEBUG,"enum(0x%x)" % entry)
-		data = self.get_cached(self.key)
-		# TBD: check that it's a directory
-		# TBD: add real entries for . and .. during mkdir
-		self.orig_entry = entry
-		if entry == 0:
-			if callback(".","",1):
-				return
-			entry += 1
-		if entry == 1:
-			if callback("..","",2):
-				return
-			entry += 1
-		self.entry = entry - 2
-		self.callback = callback
-		self.cb_calls = 0
-		self.enum_one(data,INODE_SZ,0,0,True)
-		if self.cb_calls:
-			return False	# not done
-		self.cache = {}
+		for name, ptr, cookie in self.walk(entry):
+			if callback(name,ptr,cookie):
+				return False
 		return True
 
 	def dump_direct (self, indent, index, bdata):
 		log.it(jlog.DEBUG,"%*sdirect bucket %d" % (indent, '', index))
-		offset = BUCKET_HDR_SZ
-		for i in range(ENTRIES_PER_BUCKET):
-			edata = bdata[offset:offset+ENTRY_SZ]
-			offset += ENTRY_SZ
-			name, ptr = struct.unpack(ENTRY_FMT,edata)
-			if name != '':
-				log.it(jlog.DEBUG,"%*sentry %d => %s" % (
-					indent+1,'',i,name))
+		for i, name, ptr in direct_entries(bdata):
+			log.it(jlog.DEBUG,"%*sentry %d => %s" % (
+				indent+1,'',i,name))
 
 	def dump_indirect (self, indent, index, bdata):
 		log.it(jlog.DEBUG,"%*sindirect bucket %d" % (indent,'',index))
@@ -374,12 +881,18 @@ class DirOp:
 
 	def dump (self, key, indent=0, offset=INODE_SZ):
 		idata, vector = self.fs.get_value(key)
-		for i in range(BUCKETS_PER_BLOCK):
-			bdata = idata[offset:offset+BUCKET_SZ]
-			offset += BUCKET_SZ
+		if offset:
+			self.set_format(idata)
+		for i in range(self.buckets_per_block):
+			if offset and self.sharded:
+				bdata, vector = self.fs.get_value(
+					shard_key(key,i))
+			else:
+				bdata = idata[offset:offset+BUCKET_SZ]
+				offset += BUCKET_SZ
 			hdr = bdata[:BUCKET_HDR_SZ]
 			state = struct.unpack(BUCKET_HDR_FMT,hdr)[0]
-			if state == 'D':
+			if state in ('D','C'):
 				self.dump_direct(indent,i,bdata)
 			elif state == 'I':
 				self.dump_indirect(indent,i,bdata)
@@ -392,23 +905,199 @@ def lookup (fs, root, path):
 		if part == "":
 			continue
 		d = DirOp(fs,ptr)
-		ptr = d.lookup(part)
+		ptr = d.lookup_cached(part)
 		if ptr == None:
 			break
 	return ptr
 
-def mkdir (fs, key, mode):
+def mkdir (fs, key, mode, flags=0):
 	d = DirOp(fs,key)
-	return d.create(mode)
+	return d.create(mode,flags)
 
-def link (fs, parent, name, child):
+# Hand a directory that never got linked anywhere over to the GC.  Nothing
+# its entries point to is touched, so it should be empty.
+def free_dir (fs, key):
+	if not fs.gc:
+		return
+	d = DirOp(fs,key)
+	fs.retire(d.block_keys()+[key])
+
+# Changes to the same directory from different threads are serialized
+# here, so they don't just burn round trips failing each other's
+# conditional puts.  Everything else in a DirOp is per-call state, so
+# lookups and enumeration don't need any locking.  For a sharded directory
+# only changes to the same shard can collide, so that's what we serialize.
+#
+# Changes are queued per directory (or shard), and one thread at a time is
+# the committer for each.  It takes everything that's queued (up to
+# GROUP_MAX) and commits it all at once, so anything that arrives while a
+# commit is in flight goes out together in the next one.  Everyone else
+# waits for their own change to be done, or for their turn to commit.
+# GROUP_WINDOW adds a wait before each group commit, to let a batch build
+# up even when nothing's in flight.
+GROUP_MAX = 64
+GROUP_WINDOW = 0.0
+pending = {}
+committing = {}
+pending_cond = threading.Condition()
+
+def change (fs, parent, name, child):
 	d = DirOp(fs,parent)
-	return d.add(name,child)
+	d.get_format()
+	if d.sharded:
+		lkey = d.shard_for(hash_name(name)[0])
+	else:
+		lkey = parent
+	mine = DirChange(name,child)
+	pending_cond.acquire()
+	try:
+		pending.setdefault(lkey,[]).append(mine)
+		while (lkey in committing) and not mine.done:
+			pending_cond.wait()
+		if not mine.done:
+			committing[lkey] = True
+	finally:
+		pending_cond.release()
+	if not mine.done:
+		try:
+			while not mine.done:
+				group_commit(d,lkey)
+		finally:
+			pending_cond.acquire()
+			try:
+				del committing[lkey]
+				pending_cond.notifyAll()
+			finally:
+				pending_cond.release()
+	if mine.error:
+		raise mine.error
+
+def group_commit (d, lkey):
+	if GROUP_WINDOW:
+		time.sleep(GROUP_WINDOW)
+	pending_cond.acquire()
+	try:
+		queue = pending[lkey]
+		batch = queue[:GROUP_MAX]
+		if len(queue) > GROUP_MAX:
+			pending[lkey] = queue[GROUP_MAX:]
+		else:
+			del pending[lkey]
+	finally:
+		pending_cond.release()
+	try:
+		d.add_many(batch)
+	except:
+		# Everybody in the batch gets the bad news.
+		etype, error, stack = sys.exc_info()
+		for change in batch:
+			change.error = error
+	pending_cond.acquire()
+	try:
+		for change in batch:
+			change.done = True
+		pending_cond.notifyAll()
+	finally:
+		pending_cond.release()
+
+def link (fs, parent, name, child):
+	return change(fs,parent,name,child)
 
 def unlink (fs, parent, name):
-	d = DirOp(fs,parent)
-	return d.add(name,None)
+	return change(fs,parent,name,None)
 
 def enum (fs, key, callback, offset=0):
 	d = DirOp(fs,key)
 	return d.enum(callback,offset)
+
+CURSORS = 256
+CURSOR_HISTORY = 16
+CURSOR_TTL = 10.0
+# How far ahead of FUSE voldfs reads.  If FUSE takes none of a batch, the
+# next call resumes from the last entry of the batch before, so the history
+# needs room for that one too.
+READDIR_BATCH = CURSOR_HISTORY - 1
+
+# An unfinished walk, kept so that the next readdir on the same directory
+# can carry on instead of descending from the top again.  Callers like
+# FUSE may take one more entry than they can use, and voldfs reads ahead a
+# batch at a time, so we remember the last few entries handed out and can
+# go back to any of them.  Callers mustn't get further ahead than that.
+#
+# The blocks a walk hasn't got to yet can be retired as soon as it starts,
+# so a cursor is only good for a fraction of the GC's delay.  After that
+# the next readdir just starts a new walk.
+class Cursor:
+	def __init__ (self, d, offset):
+		self.key = d.key
+		self.dir = d
+		self.walk = d.walk(offset)
+		self.recent = collections.deque([],CURSOR_HISTORY)
+		self.started = time.time()
+	def expired (self, now=None):
+		if now == None:
+			now = time.time()
+		ttl = CURSOR_TTL
+		if self.dir.fs.gc:
+			ttl = min(ttl,self.dir.fs.gc.delay/2)
+		return (now - self.started) > ttl
+	# Entries already handed out after "offset", or None if we can't
+	# get back there from here.
+	def replay (self, offset):
+		result = None
+		for item in self.recent:
+			if result != None:
+				result.append(item)
+			elif item[2] == offset:
+				result = []
+		return result
+
+cursors = vfs_cache.LRU(CURSORS)
+cursor_lock = threading.Lock()
+
+def take_cursor (key, offset):
+	cursor_lock.acquire()
+	try:
+		cursor = cursors.get((key,offset))
+		if cursor:
+			for item in cursor.recent:
+				cursors.discard((key,item[2]))
+		return cursor
+	finally:
+		cursor_lock.release()
+
+def keep_cursor (cursor):
+	cursor_lock.acquire()
+	try:
+		for item in cursor.recent:
+			cursors.put((cursor.key,item[2]),cursor)
+	finally:
+		cursor_lock.release()
+
+# Generator version of enum, for readdir.  If the caller stops early the
+# cursor is kept under the cookies of the last few entries, so that
+# resuming from any of them is just a matter of carrying on.  Everything
+# we list also goes into the dentry cache, since a listing is usually
+# followed by lookups of the same names.
+def readdir (fs, key, offset=0):
+	cursor = take_cursor(key,offset)
+	replay = None
+	if cursor and not cursor.expired():
+		replay = cursor.replay(offset)
+	if replay == None:
+		cursor = Cursor(DirOp(fs,key),offset)
+		replay = []
+	done = False
+	try:
+		for item in replay:
+			yield item
+		for item in cursor.walk:
+			cursor.recent.append(item)
+			if item[1]:
+				dcache.fill(cursor.dir.dkey,
+					cursor.dir.version,item[0],item[1])
+			yield item
+		done = True
+	finally:
+		if not done:
+			keep_cursor(cursor)
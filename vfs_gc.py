@@ -0,0 +1,168 @@
+"""
+Copyright (c) 2010, Jeff Darcy <jeff@pl.atyp.us>
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""
+
+import collections
+import stat
+import struct
+import threading
+import time
+import traceback
+
+from vfs_base import *
+import vfs_dir
+
+import jlog
+log = jlog.logger(jlog.NORMAL)
+
+GC_DELAY = 60.0		# seconds before a retired key is deleted
+GC_RATE = 200		# deletes per second, at most
+GC_BATCH = 64
+GC_IDLE = 1.0
+
+# Keys that nothing points to any more, as of some commit.  They aren't
+# deleted right away, because anyone who read the old inode or directory
+# just before that commit might still be on their way to them.  GC_DELAY is
+# how long we give them.  Deletes go out in batches, paced so that the GC
+# never takes more than GC_RATE per second away from real work.
+#
+# Like read-ahead, the worker gets its own FS because the store clients
+# aren't thread-safe.  The queue is only in memory, so anything that's
+# retired but not yet deleted when we go away just stays in the store
+# until a sweep (below) finds it.  So do shared dedup blocks, which
+# nothing ever retires.
+class Collector:
+	def __init__ (self, fs, delay=GC_DELAY, rate=GC_RATE):
+		self.fs = fs
+		self.delay = delay
+		self.rate = rate
+		self.queue = collections.deque()
+		self.lock = threading.Lock()
+		self.worker = None
+		self.retired = 0
+		self.deleted = 0
+	# Separate from __init__ for the same reason as in ReadAhead: FUSE
+	# forks when it daemonizes, and threads don't survive that.
+	def start (self):
+		self.worker = threading.Thread(target=self.run)
+		self.worker.setDaemon(True)
+		self.worker.start()
+	def retire (self, keys):
+		now = time.time()
+		self.lock.acquire()
+		try:
+			for key in keys:
+				self.queue.append((now,key))
+			self.retired += len(keys)
+		finally:
+			self.lock.release()
+	# Up to "limit" keys whose time is up, oldest first.
+	def due (self, now, limit):
+		keys = []
+		self.lock.acquire()
+		try:
+			while self.queue and (len(keys) < limit):
+				when, key = self.queue[0]
+				if (when + self.delay) > now:
+					break
+				self.queue.popleft()
+				keys.append(key)
+		finally:
+			self.lock.release()
+		return keys
+	# Delete one batch, and return how many keys were in it.
+	def collect (self, now=None):
+		if now == None:
+			now = time.time()
+		keys = self.due(now,min(GC_BATCH,self.rate))
+		if keys:
+			self.fs.delete_values(keys)
+			self.lock.acquire()
+			try:
+				self.deleted += len(keys)
+			finally:
+				self.lock.release()
+		return len(keys)
+	# Everything that's due, without the pacing.  Mostly for tests.
+	def drain (self, now=None):
+		total = 0
+		while True:
+			count = self.collect(now)
+			if not count:
+				return total
+			total += count
+	def run (self):
+		while True:
+			try:
+				count = self.collect()
+			except:
+				# Whatever was in that batch is left for a sweep.
+				log.it(jlog.WARNING,"GC batch failed")
+				log.it(jlog.DEBUG,traceback.format_exc())
+				count = 0
+			if count:
+				time.sleep(float(count)/self.rate)
+			else:
+				time.sleep(GC_IDLE)
+
+# Offline recovery: everything that can be reached from the root directory
+# is live, and any other block is garbage.  This only works on stores that
+# can list their keys, and nothing else can be using the filesystem while
+# it runs, because blocks that have been written but not linked in yet
+# look just the same as ones nobody will ever link again.
+def mark (fs, root):
+	live = {root: True}
+	dirs = [root]
+	while dirs:
+		d = vfs_dir.DirOp(fs,dirs.pop())
+		for key in d.block_keys():
+			live[key] = True
+		for name, ptr, cookie in d.walk():
+			if (not ptr) or (ptr in live):
+				continue
+			live[ptr] = True
+			try:
+				idata, vector = fs.get_inode(ptr)
+			except NoSuchKeyExc:
+				log.it(jlog.WARNING,"%s points to missing %s" % (
+					name, repr(ptr)))
+				continue
+			mode = struct.unpack(INODE_FMT,idata[:INODE_SZ])[0]
+			if stat.S_ISDIR(mode):
+				dirs.append(ptr)
+			else:
+				for key in fs.file_keys(idata):
+					live[key] = True
+	return live
+
+# Only keys that look like block pointers are candidates.  The superblock,
+# allocation leases and shard keys are all some other shape, except that
+# a lease key for a big enough node number happens to be the same length.
+def sweep (fs, live, dry_run=False):
+	lease_prefix = ALLOC_KEY_FMT.split("%")[0]
+	garbage = []
+	for key in fs.list_keys():
+		if (len(key) != PTR_SZ) or (key in live) or \
+		   key.startswith(lease_prefix):
+			continue
+		if struct.unpack(PTR_FMT,key)[0] == INVALID_NODE:
+			continue
+		garbage.append(key)
+	if not dry_run:
+		fs.delete_values(garbage)
+	return garbage
+
+def mark_and_sweep (fs, root="root", dry_run=False):
+	return sweep(fs,mark(fs,root),dry_run)
@@ -0,0 +1,128 @@
+"""
+Copyright (c) 2010, Jeff Darcy <jeff@pl.atyp.us>
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""
+
+import Queue
+import struct
+import threading
+import traceback
+
+from vfs_base import *
+import vfs_cache
+
+import jlog
+log = jlog.logger(jlog.NORMAL)
+
+RA_WINDOW = 32		# blocks
+RA_POOL = 16 << 20	# bytes
+RA_FILES = 1024
+RA_QUEUE = 64
+
+# Per-file access pattern.  A read that starts where the last one ended
+# extends the run; anything else resets it.  "ahead" is the first block
+# we haven't already asked the worker for.
+class Stream:
+	def __init__ (self):
+		self.next = 0
+		self.run = 0
+		self.ahead = 0
+
+# Data and pointer blocks are COW, so a block fetched under a given key is
+# good for as long as we care to keep it.  That means the pool can just be
+# keyed by pointer and never needs invalidating.
+#
+# The worker gets its own FS (and therefore its own store client) because
+# the store clients aren't thread-safe.  The two only share the pool.
+class ReadAhead:
+	def __init__ (self, fs, window=RA_WINDOW, pool_size=RA_POOL):
+		self.fs = fs
+		self.window = window
+		self.pool = vfs_cache.LRU(pool_size,len)
+		self.fs.pool = self.pool
+		self.fs.fill_pool = True
+		self.streams = vfs_cache.LRU(RA_FILES)
+		self.queue = Queue.Queue(RA_QUEUE)
+		self.worker = None
+		self.lock = threading.Lock()
+	# This has to be separate from __init__ because FUSE forks when it
+	# daemonizes, and threads don't survive that.
+	def start (self):
+		self.worker = threading.Thread(target=self.run)
+		self.worker.setDaemon(True)
+		self.worker.start()
+	def note (self, key, offset, length):
+		if not self.window:
+			return
+		self.lock.acquire()
+		try:
+			self.note_locked(key,offset,length)
+		finally:
+			self.lock.release()
+	def note_locked (self, key, offset, length):
+		stream = self.streams.get(key)
+		if not stream:
+			stream = Stream()
+			self.streams.put(key,stream)
+		if offset == stream.next:
+			stream.run += 1
+		else:
+			stream.run = 0
+			stream.ahead = 0
+		stream.next = offset + length
+		if stream.run < 1:
+			return
+		cur = (offset + length - 1) / self.fs.block_sz
+		# Don't bother until at least half the window is used up, so
+		# the worker gets reasonably sized batches.
+		if (stream.ahead - cur) > (self.window / 2):
+			return
+		first = max(cur+1,stream.ahead)
+		last = cur + self.window
+		try:
+			self.queue.put_nowait((key,first,last))
+			stream.ahead = last + 1
+		except Queue.Full:
+			log.it(jlog.DEBUG,"read-ahead queue full")
+	def run (self):
+		while True:
+			key, first, last = self.queue.get()
+			try:
+				self.fetch(key,first,last)
+			except:
+				log.it(jlog.WARNING,"read-ahead failed for %s" %
+					repr(key))
+				log.it(jlog.DEBUG,traceback.format_exc())
+			self.queue.task_done()
+	def fetch (self, key, first, last):
+		idata, vector = self.fs.get_inode(key)
+		inode = struct.unpack(INODE_FMT,idata[:INODE_SZ])
+		size = inode[6]
+		depth = inode[11]
+		# TBD: read-ahead for extent-mapped files
+		if (not depth) or (not size) or (inode[10] & FLAG_EXTENTS):
+			return
+		eof = (size - 1) / self.fs.block_sz
+		if last > eof:
+			last = eof
+		if first > last:
+			return
+		log.it(jlog.DEBUG,"read-ahead %s %d-%d" % (
+			repr(key), first, last))
+		# get_leaves pulls the pointer blocks through get_blocks, so
+		# they land in the pool along with the leaves.
+		leaves = self.fs.get_leaves(idata,depth,first,last)
+		self.fs.get_blocks([ptr for bnum, ptr in leaves])
+	def wait (self):
+		self.queue.join()
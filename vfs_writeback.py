@@ -0,0 +1,78 @@
+"""
+Copyright (c) 2010, Jeff Darcy <jeff@pl.atyp.us>
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""
+
+import jlog
+log = jlog.logger(jlog.NORMAL)
+
+WB_LIMIT = 1 << 20	# bytes per file
+
+# Dirty data for one file, as a sorted list of (offset,data) extents that
+# neither overlap nor touch.  Overlapping or adjacent writes are merged as
+# they come in, so a run of small sequential writes turns into one big
+# extent and goes out through a single put_extents (i.e. a single inode
+# update) when we're asked to flush or we cross the limit.  Whoever owns the
+# buffer can supply its own writer, e.g. to keep track of the new inode.
+class WriteBuffer:
+	def __init__ (self, fs, key, limit=WB_LIMIT, writer=None):
+		self.fs = fs
+		self.key = key
+		self.limit = limit
+		self.writer = writer
+		self.extents = []
+		self.buffered = 0
+	def write (self, offset, data):
+		lo = offset
+		hi = offset + len(data)
+		keep = []
+		index = 0
+		for e_off, e_data in self.extents:
+			e_end = e_off + len(e_data)
+			if e_end < lo:
+				keep.append((e_off,e_data))
+				index += 1
+				continue
+			if e_off > hi:
+				keep.append((e_off,e_data))
+				continue
+			# Overlapping or adjacent; new data wins.
+			if e_off < lo:
+				data = e_data[:lo-e_off] + data
+				lo = e_off
+			if e_end > hi:
+				data = data + e_data[hi-e_off:]
+				hi = e_end
+			self.buffered -= len(e_data)
+		keep.insert(index,(lo,data))
+		self.extents = keep
+		self.buffered += len(data)
+		if self.buffered >= self.limit:
+			log.it(jlog.DEBUG,"write-back limit reached for %s" %
+				repr(self.key))
+			self.flush()
+	def end (self):
+		if not self.extents:
+			return 0
+		e_off, e_data = self.extents[-1]
+		return e_off + len(e_data)
+	def flush (self):
+		if not self.extents:
+			return
+		if self.writer:
+			self.writer(self.extents)
+		else:
+			self.fs.put_extents(self.key,self.extents)
+		self.extents = []
+		self.buffered = 0
@@ -17,10 +17,13 @@ OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 """
 
 import errno
+import hashlib
 import os
 import string
 import struct
 import sys
+import threading
+import time
 import traceback
 
 import fuse
@@ -29,50 +32,205 @@ fuse.fuse_python_api = (0,2)
 db = __import__(os.getenv("VOLDFS_DB","voldemort"))
 
 import vfs_base
+import vfs_cache
 import vfs_dir
+import vfs_gc
+import vfs_readahead
+import vfs_writeback
 
 class NullObject:
 	pass
 
-class Collector:
-	def __init__ (self):
-		self.result = []
-	def __call__ (self, name, ptr, hash):
-		self.result.append((name,hash))
+HANDLE_TTL = 1.0
+
+# Inode contents (the unpacked INODE_FMT part only) from getattr and
+# readdir, so that the getattr for each entry that usually follows a
+# listing doesn't have to go to the store.  Like the dentry cache, entries
+# are trusted for attr_timeout seconds, and our own changes drop them.
+# The same timeouts are passed on to FUSE so the kernel can cache too.
+ATTR_CACHE = 16384
+
+# The kernel only uses our inode numbers with use_ino.  Pointers are
+# unique and never reused, so they make good ones; anything else (like
+# the root) gets a hash.
+ROOT_INO = 1
+def ino_for (ptr):
+	if len(ptr) == vfs_base.PTR_SZ:
+		return struct.unpack("!Q",ptr)[0]
+	return struct.unpack("!Q",hashlib.md5(ptr).digest()[:8])[0] | 1
+
+# What open/create hand back to FUSE, so that later calls on the same file
+# don't have to walk the path again.  There's only one of these per file
+# no matter how many times it's opened, so that everyone sees the same
+# write-back buffer and cached inode.  The cached inode is trusted for
+# HANDLE_TTL seconds; our own writes refresh it, and if someone else has
+# changed the file in the meantime the conditional put on write will
+# catch it.  The lock serializes everything on the file within this
+# process, which also keeps threads from tripping over each other's
+# conditional puts.
+class FileHandle:
+	def __init__ (self, fs, ptr, wb_limit=0):
+		self.fs = fs
+		self.ptr = ptr
+		self.lock = threading.RLock()
+		self.refs = 0
+		# Set when the file's unlinked while open, so that the last
+		# release can free it.
+		self.unlinked = False
+		self.idata = None
+		self.vector = None
+		self.stamp = 0
+		if wb_limit:
+			self.wbuf = vfs_writeback.WriteBuffer(fs,ptr,wb_limit,
+				self.commit)
+		else:
+			self.wbuf = None
+	def inode (self):
+		now = time.time()
+		if (not self.idata) or ((now - self.stamp) > HANDLE_TTL):
+			self.idata, self.vector = self.fs.get_inode(self.ptr)
+			self.stamp = now
+		return self.idata, self.vector
+	def commit (self, extents):
+		try:
+			self.idata, self.vector = self.fs.put_extents(self.ptr,
+				extents,self.inode())
+		except:
+			self.idata = None
+			raise
+		self.stamp = time.time()
+	def read (self, offset, length):
+		self.lock.acquire()
+		try:
+			self.flush()
+			return self.fs.get_range(self.ptr,offset,length,
+				inode=self.inode())
+		finally:
+			self.lock.release()
+	def write (self, offset, data):
+		self.lock.acquire()
+		try:
+			if self.wbuf:
+				self.wbuf.write(offset,data)
+			else:
+				self.commit([(offset,data)])
+		finally:
+			self.lock.release()
+		return len(data)
+	def flush (self):
+		self.lock.acquire()
+		try:
+			if self.wbuf:
+				self.wbuf.flush()
+		finally:
+			self.lock.release()
+	# Anything still in the write-back buffer goes out first, so that it
+	# gets cut off too.
+	def truncate (self, size):
+		self.lock.acquire()
+		try:
+			self.flush()
+			try:
+				self.idata, self.vector = self.fs.truncate(
+					self.ptr,size)
+			except:
+				self.idata = None
+				raise
+			self.stamp = time.time()
+		finally:
+			self.lock.release()
+	def size (self):
+		self.lock.acquire()
+		try:
+			if self.wbuf:
+				return self.wbuf.end()
+			return 0
+		finally:
+			self.lock.release()
 
 class VoldFS (fuse.Fuse):
 	def __init__ (self, fs, root):
 		fuse.Fuse.__init__(self,dash_s_do="setsingle")
 		self.fs = fs
 		self.root = root
+		self.ra = None
+		self.gc = None
+		self.wb_limit = 0
+		self.handles = {}
+		self.handle_lock = threading.Lock()
+		self.attrs = vfs_cache.LRU(ATTR_CACHE)
+		self.attr_timeout = 1.0
+		self.file_flags = 0
+		self.dir_flags = 0
 
 	def fsinit (self):
+		if self.ra:
+			self.ra.start()
+		if self.gc:
+			self.gc.start()
 		try:
 			if self.fs.store.auto_mkfs:
-				vfs_dir.mkdir(self.fs,self.root,0755)
+				self.fs.write_super()
+				self.fs.allocator.create_record()
+				vfs_dir.mkdir(self.fs,self.root,0755,
+					self.dir_flags)
 		except:
 			print "This storage type requires mkfs first"
 
+	def fsdestroy (self):
+		for name, stats in self.fs.retry_stats.items():
+			print "%s: %s" % (name, stats)
+		cache = vfs_base.block_cache
+		print "block cache: %d hits, %d misses, %d evictions" % (
+			cache.hits, cache.misses, cache.evictions)
+		if self.gc:
+			print "gc: %d retired, %d deleted" % (
+				self.gc.retired, self.gc.deleted)
+
+	def get_attrs (self, ptr):
+		now = time.time()
+		cached = self.attrs.get(ptr)
+		if cached and ((now - cached[1]) <= self.attr_timeout):
+			return cached[0]
+		idata, vector = self.fs.get_inode(ptr)
+		inode = struct.unpack(vfs_base.INODE_FMT,
+			idata[:vfs_base.INODE_SZ])
+		self.attrs.put(ptr,(inode,now))
+		return inode
+
+	# One multi-get for a whole batch of readdir entries.  Entries that
+	# point at nothing just don't get cached.
+	def prefetch_attrs (self, ptrs):
+		now = time.time()
+		for ptr, (idata, vector) in self.fs.find_values(ptrs).items():
+			inode = struct.unpack(vfs_base.INODE_FMT,
+				idata[:vfs_base.INODE_SZ])
+			self.attrs.put(ptr,(inode,now))
+
 	def getattr (self, path):
 		ptr = vfs_dir.lookup(self.fs,self.root,path)
 		if ptr == None:
 			return -errno.ENOENT
 		try:
-			idata, vector = self.fs.get_inode(ptr)
-			inode = struct.unpack(vfs_base.INODE_FMT,
-				idata[:vfs_base.INODE_SZ])
+			inode = self.get_attrs(ptr)
 		except:
 			print "<<<%s>>>" % repr(ptr)
 			traceback.print_exc()
 			return -errno.EIO
 		it = NullObject()
 		it.st_mode = inode[0]
-		it.st_ino = inode[1]
+		if ptr == self.root:
+			it.st_ino = ROOT_INO
+		else:
+			it.st_ino = ino_for(ptr)
 		it.st_dev = inode[2]
 		it.st_nlink = inode[3]
 		it.st_uid = inode[4]
 		it.st_gid = inode[5]
 		it.st_size = inode[6]
+		fh = self.handles.get(ptr)
+		if fh:
+			it.st_size = max(it.st_size,fh.size())
 		it.st_atime = inode[7]
 		it.st_mtime = inode[8]
 		it.st_ctime = inode[9]
@@ -85,12 +243,15 @@ class VoldFS (fuse.Fuse):
 		pptr = vfs_dir.lookup(self.fs,self.root,parent)
 		if pptr == None:
 			return -errno.ENOENT
-		cptr = vfs_base.get_new_key()
-		vfs_dir.mkdir(self.fs,cptr,mode)
+		cptr = self.fs.new_key()
+		vfs_dir.mkdir(self.fs,cptr,mode,self.dir_flags)
 		try:
 			vfs_dir.link(self.fs,pptr,child,cptr)
 		except vfs_dir.DupFileExc:
+			vfs_dir.free_dir(self.fs,cptr)
 			return -errno.EEXIST
+		finally:
+			self.attrs.discard(pptr)
 
 	def opendir (self, path):
 		print "in opendir"
@@ -101,11 +262,29 @@ class VoldFS (fuse.Fuse):
 		if ptr == None:
 			raise IOError, "directory not found"
 			return
-		coll = Collector()
-		vfs_dir.enum(self.fs,ptr,coll,offset)
-		for name, hash in coll.result:
+		# Entries go to FUSE a batch at a time, with the inodes for
+		# each batch fetched together first.  The offset on each is
+		# what we'll be called with to continue after it.
+		batch = []
+		for item in vfs_dir.readdir(self.fs,ptr,offset):
+			batch.append(item)
+			if len(batch) >= vfs_dir.READDIR_BATCH:
+				for x in self.dir_batch(batch):
+					yield x
+				batch = []
+		for x in self.dir_batch(batch):
+			yield x
+
+	def dir_batch (self, batch):
+		self.prefetch_attrs([ptr for name, ptr, cookie in batch if ptr])
+		for name, ptr, cookie in batch:
 			x = fuse.Direntry(name)
-			x.ino = hash
+			if ptr:
+				x.ino = ino_for(ptr)
+			else:
+				# TBD: real inode numbers for . and ..
+				x.ino = cookie
+			x.offset = cookie
 			yield x
 
 	def create (self, path, flags, mode):
@@ -116,31 +295,98 @@ class VoldFS (fuse.Fuse):
 		pptr = vfs_dir.lookup(self.fs,self.root,parent)
 		if pptr == None:
 			return -errno.ENOENT
-		cptr = vfs_base.get_new_key()
-		self.fs.create_inode(cptr,mode)
+		cptr = self.fs.new_key()
+		self.fs.create_inode(cptr,mode,flags=self.file_flags)
 		try:
 			vfs_dir.link(self.fs,pptr,child,cptr)
 		except vfs_dir.DupFileExc:
+			self.fs.free_file(cptr)
 			return -errno.EEXIST
+		finally:
+			self.attrs.discard(pptr)
+		return self.get_handle(cptr)
 
-	def write (self, path, buf, offset, fh=None):
+	def get_handle (self, ptr):
+		self.handle_lock.acquire()
+		try:
+			try:
+				fh = self.handles[ptr]
+			except KeyError:
+				fh = FileHandle(self.fs,ptr,self.wb_limit)
+				self.handles[ptr] = fh
+			fh.refs += 1
+			return fh
+		finally:
+			self.handle_lock.release()
+
+	# For calls that come in by path instead of handle.  If the file is
+	# open we still want to go through its handle, but otherwise we make
+	# a throwaway one.
+	def find_handle (self, path):
 		ptr = vfs_dir.lookup(self.fs,self.root,path)
 		if ptr == None:
-			return -errno.ENOENT
-		return self.fs.put_data(ptr,offset,buf)
+			return None
+		try:
+			return self.handles[ptr]
+		except KeyError:
+			return FileHandle(self.fs,ptr)
 
-	def read (self, path, length, offset, fh=None):
+	def open (self, path, flags):
 		ptr = vfs_dir.lookup(self.fs,self.root,path)
 		if ptr == None:
 			return -errno.ENOENT
-		total = ''
-		while len(total) < length:
-			new_data = self.fs.get_data(ptr,offset,length)
-			if not len(new_data):
-				break
-			total += new_data
-			offset += len(new_data)
-		return total
+		return self.get_handle(ptr)
+
+	def write (self, path, buf, offset, fh=None):
+		if not fh:
+			fh = self.find_handle(path)
+			if not fh:
+				return -errno.ENOENT
+		result = fh.write(offset,buf)
+		self.attrs.discard(fh.ptr)
+		return result
+
+	def flush (self, path, fh=None):
+		if not fh:
+			fh = self.find_handle(path)
+			if not fh:
+				return -errno.ENOENT
+		try:
+			fh.flush()
+		except:
+			traceback.print_exc()
+			return -errno.EIO
+		finally:
+			self.attrs.discard(fh.ptr)
+		return 0
+
+	def fsync (self, path, isfsyncfile, fh=None):
+		return self.flush(path,fh)
+
+	def release (self, path, flags, fh=None):
+		if not fh:
+			return 0
+		result = self.flush(path,fh)
+		self.handle_lock.acquire()
+		try:
+			fh.refs -= 1
+			last = (fh.refs <= 0)
+			if last:
+				del self.handles[fh.ptr]
+		finally:
+			self.handle_lock.release()
+		if last and fh.unlinked:
+			self.free_file(fh.ptr)
+		return result
+
+	def read (self, path, length, offset, fh=None):
+		if not fh:
+			fh = self.find_handle(path)
+			if not fh:
+				return -errno.ENOENT
+		if self.ra:
+			self.ra.note(fh.ptr,offset,length)
+		return fh.read(offset,length)
 
 	def unlink (self, path):
 		print "in unlink(%s)" % path
@@ -150,7 +396,36 @@ class VoldFS (fuse.Fuse):
 		pptr = vfs_dir.lookup(self.fs,self.root,parent)
 		if pptr == None:
 			return -errno.ENOENT
-		return vfs_dir.unlink(self.fs,pptr,child)
+		cptr = vfs_dir.lookup(self.fs,pptr,child)
+		try:
+			vfs_dir.unlink(self.fs,pptr,child)
+		except vfs_dir.DupFileExc:
+			return -errno.ENOENT
+		finally:
+			self.attrs.discard(pptr)
+			if cptr:
+				self.attrs.discard(cptr)
+		if not cptr:
+			return 0
+		# An open file keeps its blocks until the last release.
+		self.handle_lock.acquire()
+		try:
+			fh = self.handles.get(cptr)
+			if fh:
+				fh.unlinked = True
+				return 0
+		finally:
+			self.handle_lock.release()
+		self.free_file(cptr)
+		return 0
+
+	# The name's already gone, so failing here just leaves garbage for
+	# the sweep.
+	def free_file (self, ptr):
+		try:
+			self.fs.free_file(ptr)
+		except:
+			traceback.print_exc()
 
 	def chmod (self, path, mode):
 		print "in chmod(%s,0x%x)" % (path, mode)
@@ -159,7 +434,28 @@ class VoldFS (fuse.Fuse):
 		print "in chown(%s,%d,%d)" % (path, user, group)
 
 	def truncate (self, path, len):
-		print "in truncate(%s,%d)" % (path, len)
+		return self.ftruncate(path,len)
+
+	# Unlike other calls by path, this goes through a real handle even if
+	# the file isn't open, so that it's serialized with everything else we
+	# do to the file.
+	def ftruncate (self, path, len, fh=None):
+		opened = None
+		if not fh:
+			ptr = vfs_dir.lookup(self.fs,self.root,path)
+			if ptr == None:
+				return -errno.ENOENT
+			fh = opened = self.get_handle(ptr)
+		try:
+			fh.truncate(len)
+		except:
+			traceback.print_exc()
+			return -errno.EIO
+		finally:
+			self.attrs.discard(fh.ptr)
+			if opened:
+				self.release(path,0,opened)
+		return 0
 
 	def utime (self, path, times):
 		print "in utimes(%s)" % path
@@ -167,8 +463,8 @@ class VoldFS (fuse.Fuse):
 	def statfs (self):
 		print "in statfs"
 		svf = NullObject()
-		svf.f_bsize   = vfs_base.BLOCK_SZ
-		svf.f_frsize  = vfs_base.BLOCK_SZ
+		svf.f_bsize   = self.fs.block_sz
+		svf.f_frsize  = self.fs.block_sz
 		svf.f_blocks  = 1000000
 		svf.f_bfree   = 800000
 		svf.f_bavail  = 100000
@@ -183,6 +479,15 @@ if __name__ == "__main__":
 	# I don't have enough patience for the hairball that is FUSE option
 	# parsing.  I have the actual arguments, I'll extract the ones I
 	# want myself thankyouverymuch.
+	ra_window = vfs_readahead.RA_WINDOW
+	ra_pool = vfs_readahead.RA_POOL
+	wb_limit = 0
+	file_flags = 0
+	dir_flags = 0
+	attr_timeout = 1.0
+	dedup = 0
+	gc_delay = vfs_gc.GC_DELAY
+	gc_rate = vfs_gc.GC_RATE
 	i = 0
 	while i < len(sys.argv):
 		this_arg = sys.argv[i]
@@ -202,13 +507,72 @@ if __name__ == "__main__":
 					print "<<port = %s>>" % value
 				elif key == "db":
 					print "<<db = %s>>" % value
+				elif key == "dcache":
+					vfs_dir.dcache.configure(size=int(value))
+				elif key in ("dcache_ttl","entry_timeout"):
+					vfs_dir.dcache.configure(
+						ttl=float(value))
+				elif key == "negative_timeout":
+					vfs_dir.dcache.configure(
+						neg_ttl=float(value))
+				elif key == "block_cache":
+					vfs_base.block_cache.limit = int(value)
+				elif key == "dedup":
+					dedup = int(value)
+				elif key == "gc_delay":
+					gc_delay = float(value)
+				elif key == "gc_rate":
+					# zero turns the GC off
+					gc_rate = int(value)
+				elif key == "attr_timeout":
+					attr_timeout = float(value)
+				elif key == "readahead":
+					ra_window = int(value)
+				elif key == "ra_pool":
+					ra_pool = int(value)
+				elif key == "writeback":
+					wb_limit = int(value)
+				elif key == "layout":
+					if value == "extent":
+						file_flags = vfs_base.FLAG_EXTENTS
+					else:
+						file_flags = 0
+				elif key == "dirs":
+					# e.g. dirs=compact+sharded
+					dir_flags = 0
+					for word in value.split("+"):
+						if word == "compact":
+							dir_flags |= \
+							  vfs_base.FLAG_COMPACT_DIR
+						elif word == "sharded":
+							dir_flags |= \
+							  vfs_base.FLAG_SHARDED_DIR
 				else:
 					print "unknown key/value %s" % opt
 		else:
 			i += 1
-	store = db.StoreClient("test",[("localhost",6666)])
-	fs = vfs_base.FS(store)
+	def new_store ():
+		return db.StoreClient("test",[("localhost",6666)])
+	fs = vfs_base.FS(new_store(),new_store=new_store)
 	vfs = VoldFS(fs,"root")
+	vfs.wb_limit = wb_limit
+	vfs.file_flags = file_flags
+	vfs.dir_flags = dir_flags
+	vfs.attr_timeout = attr_timeout
+	fs.dedup = dedup
+	if ra_window:
+		vfs.ra = vfs_readahead.ReadAhead(vfs_base.FS(new_store()),
+			ra_window,ra_pool)
+		fs.pool = vfs.ra.pool
+	if gc_rate:
+		vfs.gc = vfs_gc.Collector(vfs_base.FS(new_store()),gc_delay,
+			gc_rate)
+		fs.gc = vfs.gc
 	vfs.parse()
+	# Let the kernel cache as long as we do, and use our inode numbers.
+	vfs.fuse_args.add("use_ino")
+	vfs.fuse_args.add("entry_timeout",str(vfs_dir.dcache.ttl))
+	vfs.fuse_args.add("negative_timeout",str(vfs_dir.dcache.neg_ttl))
+	vfs.fuse_args.add("attr_timeout",str(attr_timeout))
 	vfs.main()
 